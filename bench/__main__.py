@@ -0,0 +1,170 @@
+import argparse
+import json
+import math
+import os
+import shutil
+import sqlite3
+import subprocess
+import sys
+import tempfile
+import time
+import yaml
+from collections import Counter
+from typing import Dict, List
+
+from bench.fakes import FakeCollection, FakeIPFSGateway, FakeOpenAI, FakeRPCNode
+
+ROOT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+def percentile(values: List[float], q: float) -> float:
+    # Nearest rank
+    ordered = sorted(values)
+    return ordered[max(0, math.ceil(q / 100 * len(ordered)) - 1)]
+
+def summarize(records: List[list]) -> Dict:
+    durations = [seconds for seconds, _ in records]
+    summary = {'count': len(records), 'errors': sum(1 for _, ok in records if not ok)}
+    if durations:
+        summary.update({
+            'mean': sum(durations) / len(durations),
+            'p50': percentile(durations, 50),
+            'p90': percentile(durations, 90),
+            'p99': percentile(durations, 99),
+            'max': max(durations),
+        })
+    return summary
+
+def get_commit() -> str:
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], cwd=ROOT_DIR, capture_output=True,
+                              text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return 'unknown'
+
+def make_config(args, work_dir: str, collection: FakeCollection,
+                rpc_nodes: List[FakeRPCNode], gateway: FakeIPFSGateway, openai: FakeOpenAI) -> Dict:
+    # The project config with every network address pointing to the stand-ins
+    with open(os.path.join(ROOT_DIR, 'config.yaml')) as f:
+        config = yaml.safe_load(f)
+
+    config['general'].update({'use_proxy': False, 'mode': args.mode})
+    config['blockchains'] = {
+        'bench': {
+            'rpc': [{'url': node.url} for node in rpc_nodes],
+            'confirmations': 12,
+            'contracts': [{'address': collection.address, 'from_block': collection.from_block, 'first_id': 1}],
+        }
+    }
+    config['ipfs']['gateways'] = [f'{gateway.url}/ipfs/']
+    config['openai']['base_url'] = f'{openai.url}/v1'
+    config['retry'].update({'base_delay': 0.1, 'max_delay': 1})
+    config['paths'] = {
+        'cache': {
+            'event_logs': os.path.join(work_dir, 'cache', 'events'),
+            'descriptions': os.path.join(work_dir, 'cache', 'descriptions.sqlite3'),
+            'metadata': os.path.join(work_dir, 'cache', 'metadata.sqlite3'),
+        },
+        'nft_images_dir': os.path.join(work_dir, 'nft_images'),
+    }
+    return config
+
+def count_described(db_path: str, min_len: int) -> int:
+    with sqlite3.connect(db_path) as connection:
+        return connection.execute(
+            'SELECT count(*) FROM nft_metadata WHERE length(ai_image_description) >= ?', (min_len,)
+        ).fetchone()[0]
+
+def run(args) -> Dict:
+    collection = FakeCollection(args.tokens)
+    # Failed requests go to another endpoint, as with the endpoints of the real config
+    rpc_nodes = [
+        FakeRPCNode(collection, latency=args.rpc_latency, error_rate=args.rpc_error_rate, seed=args.seed + i).start()
+        for i in range(args.rpc_endpoints)
+    ]
+    gateway = FakeIPFSGateway(collection, image_size=args.image_size, latency=args.gateway_latency,
+                              error_rate=args.gateway_error_rate, seed=args.seed).start()
+    openai = FakeOpenAI(latency=args.openai_latency, error_rate=args.openai_error_rate,
+                        requests_per_minute=args.openai_rpm, seed=args.seed).start()
+
+    work_dir = tempfile.mkdtemp(prefix='nft-bench-')
+    try:
+        config = make_config(args, work_dir, collection, rpc_nodes, gateway, openai)
+        with open(os.path.join(work_dir, 'config.yaml'), 'w') as f:
+            yaml.safe_dump(config, f)
+
+        db_path = os.path.join(work_dir, 'bench.sqlite3')
+        result_path = os.path.join(work_dir, 'result.json')
+        env = {
+            **os.environ,
+            'PYTHONPATH': os.pathsep.join(filter(None, [ROOT_DIR, os.environ.get('PYTHONPATH')])),
+            'DB_URI': f'sqlite:///{db_path}',
+            'OPENAI_API_KEY': 'bench',
+        }
+        log_path = os.path.join(work_dir, 'run.log')
+        print(f'Running {args.tokens} tokens in the {args.mode} mode, the log is in {log_path}', file=sys.stderr)
+        with open(log_path, 'w') as log_file:
+            process = subprocess.run([sys.executable, '-m', 'bench.instrumented', result_path, '--mode', args.mode],
+                                     cwd=work_dir, env=env, stdout=log_file, stderr=subprocess.STDOUT)
+
+        with open(result_path) as f:
+            child = json.load(f)
+        described = count_described(db_path, config['openai'].get('description_min_len', 100))
+        return {
+            'commit': get_commit(),
+            'timestamp': int(time.time()),
+            'params': {key: value for key, value in vars(args).items() if key not in ('output', 'keep')},
+            'exit_code': process.returncode,
+            'error': child['error'],
+            'wall_seconds': child['wall_seconds'],
+            'tokens': {
+                'total': args.tokens,
+                'described': described,
+                'per_second': described / child['wall_seconds'] if child['wall_seconds'] else 0,
+            },
+            'stages': {stage: summarize(records) for stage, records in child['timings'].items()},
+            'rpc': dict(sum((node.counts for node in rpc_nodes), Counter())),
+            'gateway': dict(gateway.counts),
+            'openai': dict(openai.counts),
+            'peak_rss_bytes': child['peak_rss_bytes'],
+            'children_peak_rss_bytes': child['children_peak_rss_bytes'],
+        }
+    finally:
+        for server in (*rpc_nodes, gateway, openai):
+            server.stop()
+        if args.keep:
+            print(f'The run directory is kept: {work_dir}', file=sys.stderr)
+        else:
+            shutil.rmtree(work_dir, ignore_errors=True)
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Run the whole program against local stand-ins of the node, the IPFS gateway and OpenAI')
+    parser.add_argument('--tokens', type=int, default=100, help='collection size')
+    parser.add_argument('--mode', choices=['sequential', 'pipeline'], default='sequential')
+    parser.add_argument('--rpc-latency', type=float, default=0.02, help='seconds per JSON-RPC request')
+    parser.add_argument('--rpc-endpoints', type=int, default=2, help='number of stand-in nodes in the pool')
+    parser.add_argument('--rpc-error-rate', type=float, default=0.0, help='share of requests answered with 503')
+    parser.add_argument('--gateway-latency', type=float, default=0.05)
+    parser.add_argument('--gateway-error-rate', type=float, default=0.0)
+    parser.add_argument('--openai-latency', type=float, default=0.5)
+    parser.add_argument('--openai-error-rate', type=float, default=0.0)
+    parser.add_argument('--openai-rpm', type=float,
+                        help='requests per minute the OpenAI stand-in allows, the rest get 429 with Retry-After')
+    parser.add_argument('--image-size', type=int, default=1024, help='side of the square source images in pixels')
+    parser.add_argument('--seed', type=int, default=1, help='seed of the injected errors')
+    parser.add_argument('--output', help='write the JSON report to this file instead of stdout')
+    parser.add_argument('--keep', action='store_true', help='keep the run directory with the log and the DB')
+    args = parser.parse_args()
+
+    report = run(args)
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2)
+    else:
+        json.dump(report, sys.stdout, indent=2)
+        print()
+    if report['exit_code'] != 0:
+        sys.exit(report['exit_code'])
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,348 @@
+import io
+import json
+import math
+import random
+import sys
+import threading
+import time
+from collections import Counter
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Any, Dict, List, Optional, Tuple
+
+from eth_abi import decode, encode
+from eth_utils import function_signature_to_4byte_selector, keccak, to_checksum_address
+from PIL import Image
+
+from src.abi import MULTICALL3_ADDRESS, TRANSFERSINGLE_EVENT_SIGNATURE
+
+BLOCK_TIME = 12
+GENESIS_TIMESTAMP = 1_600_000_000
+
+def _hex32(value: int) -> str:
+    return '0x' + value.to_bytes(32, 'big').hex()
+
+class FakeCollection:
+    # An ERC-1155 collection: token N is minted in block `from_block + N - 1`
+    def __init__(self, size: int, from_block: int = 1_000_000, name: str = 'Bench Collection'):
+        self.size = size
+        self.from_block = from_block
+        self.name = name
+        self.address = to_checksum_address('0x' + 'be' * 20)
+        self.latest_block = from_block + size + 100
+
+    def get_mint_block(self, token_id: int) -> int:
+        return self.from_block + token_id - 1
+
+    def get_token_uri(self, token_id: int) -> str:
+        return f'ipfs://bafybench{token_id:08d}/metadata.json'
+
+    def get_metadata(self, token_id: int) -> Dict:
+        return {
+            'name': f'Bench token #{token_id}',
+            'description': f'A generated token number {token_id} for the benchmark',
+            'image': f'ipfs://bafyimage{token_id:08d}/image.png',
+        }
+
+class QuietHTTPServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def handle_error(self, request, client_address):
+        # Clients drop connections on purpose, e.g. the slower one of two hedged requests
+        if not isinstance(sys.exc_info()[1], ConnectionError):
+            super().handle_error(request, client_address)
+
+class FakeServer:
+    # A local HTTP server with a configurable latency and share of failed requests
+    def __init__(self, name: str, latency: float = 0.0, error_rate: float = 0.0, seed: Optional[int] = None):
+        self.name = name
+        self.latency = latency
+        self.error_rate = error_rate
+        self.counts: Counter = Counter()
+        self._lock = threading.Lock()
+        self._random = random.Random(seed)
+
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+
+            def do_GET(self):
+                server._handle(self, None)
+
+            def do_POST(self):
+                body = self.rfile.read(int(self.headers.get('Content-Length', 0)))
+                server._handle(self, body)
+
+            def log_message(self, format, *args):
+                pass
+
+        self.httpd = QuietHTTPServer(('127.0.0.1', 0), Handler)
+        self._thread = threading.Thread(target=self.httpd.serve_forever, daemon=True)
+
+    @property
+    def url(self) -> str:
+        return f'http://127.0.0.1:{self.httpd.server_address[1]}'
+
+    def start(self) -> 'FakeServer':
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+    def count(self, key: str, amount: int = 1):
+        with self._lock:
+            self.counts[key] += amount
+
+    def _handle(self, handler: BaseHTTPRequestHandler, body: Optional[bytes]):
+        self.count('http_requests')
+        if self.latency:
+            time.sleep(self.latency)
+        with self._lock:
+            failed = self._random.random() < self.error_rate
+        headers = {}
+        if failed:
+            self.count('http_errors')
+            status, content_type, content = 503, 'text/plain', b'Service Unavailable'
+        else:
+            status, content_type, content = self.respond(handler.path, body)
+            headers = self.get_headers(status)
+
+        handler.send_response(status)
+        handler.send_header('Content-Type', content_type)
+        handler.send_header('Content-Length', str(len(content)))
+        for name, value in headers.items():
+            handler.send_header(name, value)
+        handler.end_headers()
+        handler.wfile.write(content)
+
+    def respond(self, path: str, body: Optional[bytes]) -> Tuple[int, str, bytes]:
+        raise NotImplementedError
+
+    def get_headers(self, status: int) -> Dict[str, str]:
+        # Extra headers of a response from `respond`
+        return {}
+
+class FakeRPCError(Exception):
+    # Answered as a JSON-RPC error
+    def __init__(self, code: int, message: str):
+        super().__init__(message)
+        self.code = code
+
+class FakeRPCNode(FakeServer):
+    # JSON-RPC methods used by the fetcher. Without `multicall` Multicall3 is not deployed, so URIs come in batches;
+    # with `multicall_error` every aggregate3 call reverts. uri() reverts for tokens that don't exist
+    def __init__(self, collection: FakeCollection, multicall: bool = False, multicall_error: bool = False,
+                 **kwargs: Any):
+        super().__init__('rpc', **kwargs)
+        self.collection = collection
+        self.multicall = multicall
+        self.multicall_error = multicall_error
+        self.selectors = {
+            function_signature_to_4byte_selector(signature).hex(): name
+            for name, signature in (('name', 'name()'), ('nextTokenId', 'nextTokenId()'), ('uri', 'uri(uint256)'),
+                                    ('aggregate3', 'aggregate3((address,bool,bytes)[])'))
+        }
+        self.event_topic = '0x' + keccak(text=TRANSFERSINGLE_EVENT_SIGNATURE).hex()
+
+    def respond(self, path: str, body: Optional[bytes]) -> Tuple[int, str, bytes]:
+        request = json.loads(body)
+        if isinstance(request, list):
+            response = [self._call(item) for item in request]
+        else:
+            response = self._call(request)
+        return 200, 'application/json', json.dumps(response).encode()
+
+    def _call(self, request: Dict) -> Dict:
+        method = request['method']
+        self.count(method)
+        handler = getattr(self, f'_{method}', None)
+        if handler is None:
+            return {'jsonrpc': '2.0', 'id': request.get('id'),
+                    'error': {'code': -32601, 'message': f'The method {method} does not exist'}}
+        try:
+            result = handler(*request.get('params', []))
+        except FakeRPCError as e:
+            return {'jsonrpc': '2.0', 'id': request.get('id'), 'error': {'code': e.code, 'message': str(e)}}
+        return {'jsonrpc': '2.0', 'id': request.get('id'), 'result': result}
+
+    def _web3_clientVersion(self):
+        return 'FakeNode/1.0'
+
+    def _eth_chainId(self):
+        return '0x1'
+
+    def _eth_blockNumber(self):
+        return hex(self.collection.latest_block)
+
+    def _eth_getCode(self, address: str, block: str):
+        if self.multicall and address.lower() == MULTICALL3_ADDRESS.lower():
+            return '0x6080'
+        return '0x'
+
+    def _eth_call(self, transaction: Dict, block: str = 'latest'):
+        data = transaction.get('data') or transaction.get('input')
+        function = self.selectors.get(data[2:10])
+        if function == 'aggregate3' and self.multicall:
+            return '0x' + self._aggregate3(bytes.fromhex(data[10:])).hex()
+        if function == 'name':
+            return '0x' + encode(['string'], [self.collection.name]).hex()
+        if function == 'nextTokenId':
+            return '0x' + encode(['uint256'], [self.collection.size + 1]).hex()
+        if function == 'uri':
+            token_id = int(data[10:74], 16)
+            if not 1 <= token_id <= self.collection.size:
+                raise FakeRPCError(3, 'execution reverted: nonexistent token')
+            return '0x' + encode(['string'], [self.collection.get_token_uri(token_id)]).hex()
+        return '0x'
+
+    def _aggregate3(self, arguments: bytes) -> bytes:
+        self.count('aggregate3')
+        if self.multicall_error:
+            raise FakeRPCError(-32000, 'out of gas')
+        results = []
+        for target, allow_failure, call_data in decode(['(address,bool,bytes)[]'], arguments)[0]:
+            try:
+                return_data = bytes.fromhex(self._eth_call({'to': target, 'data': '0x' + call_data.hex()})[2:])
+                results.append((True, return_data))
+            except FakeRPCError:
+                if not allow_failure:
+                    raise FakeRPCError(3, 'execution reverted: Multicall3: call failed')
+                results.append((False, b''))
+        return encode(['(bool,bytes)[]'], [results])
+
+    def _eth_getLogs(self, log_filter: Dict) -> List[Dict]:
+        from_block = max(int(log_filter['fromBlock'], 16), self.collection.from_block)
+        to_block = min(int(log_filter['toBlock'], 16), self.collection.get_mint_block(self.collection.size))
+        return [self._mint_log(block_number - self.collection.from_block + 1)
+                for block_number in range(from_block, to_block + 1)]
+
+    def _mint_log(self, token_id: int) -> Dict:
+        block_number = self.collection.get_mint_block(token_id)
+        owner = _hex32(token_id)
+        return {
+            'address': self.collection.address,
+            'blockHash': _hex32(block_number),
+            'blockNumber': hex(block_number),
+            'data': '0x' + encode(['uint256', 'uint256'], [token_id, 1]).hex(),
+            'logIndex': '0x0',
+            'removed': False,
+            # signature, operator, from, to
+            'topics': [self.event_topic, owner, _hex32(0), owner],
+            'transactionHash': _hex32(token_id),
+            'transactionIndex': '0x0',
+        }
+
+    def _eth_getBlockByNumber(self, block: str, full_transactions: bool = False) -> Dict:
+        block_number = int(block, 16)
+        return {
+            'number': hex(block_number),
+            'hash': _hex32(block_number),
+            'parentHash': _hex32(block_number - 1),
+            'timestamp': hex(GENESIS_TIMESTAMP + block_number * BLOCK_TIME),
+            'transactions': [],
+        }
+
+class FakeIPFSGateway(FakeServer):
+    # Metadata and a distinct image per token, so the description cache doesn't hide the OpenAI calls
+    def __init__(self, collection: FakeCollection, image_size: int = 1024, **kwargs: Any):
+        super().__init__('gateway', **kwargs)
+        self.collection = collection
+        self.image_size = image_size
+        self._images: Dict[int, bytes] = {}
+
+    def respond(self, path: str, body: Optional[bytes]) -> Tuple[int, str, bytes]:
+        cid, _, name = path[len('/ipfs/'):].partition('/')
+        if cid.startswith('bafybench') and name == 'metadata.json':
+            self.count('metadata')
+            content = json.dumps(self.collection.get_metadata(int(cid[len('bafybench'):]))).encode()
+            return 200, 'application/json', content
+        if cid.startswith('bafyimage') and name == 'image.png':
+            self.count('images')
+            return 200, 'image/png', self._get_image(int(cid[len('bafyimage'):]))
+        self.count('not_found')
+        return 404, 'text/plain', b'Not Found'
+
+    def _get_image(self, token_id: int) -> bytes:
+        with self._lock:
+            image = self._images.get(token_id)
+        if image is None:
+            # Random 8x8 blocks per token: the images differ enough to not count as near-duplicates
+            blocks = random.Random(token_id).randbytes(8 * 8 * 3)
+            picture = Image.frombytes('RGB', (8, 8), blocks).resize((self.image_size, self.image_size),
+                                                                    Image.Resampling.NEAREST)
+            buffer = io.BytesIO()
+            picture.save(buffer, format='PNG')
+            image = buffer.getvalue()
+            with self._lock:
+                self._images[token_id] = image
+        return image
+
+class FakeOpenAI(FakeServer):
+    # An OpenAI-compatible chat completions endpoint. With `requests_per_minute` it keeps a request bucket
+    # (a second's worth of burst) and answers 429 with `Retry-After` when it is empty, like the real API
+    def __init__(self, answer_len: int = 200, requests_per_minute: Optional[float] = None, **kwargs: Any):
+        super().__init__('openai', **kwargs)
+        self.answer = ('A generated description of the benchmark image. ' * (answer_len // 40 + 1))[:answer_len]
+        self.requests_per_minute = requests_per_minute
+        if requests_per_minute:
+            self.rate = requests_per_minute / 60
+            self.capacity = max(1.0, self.rate)
+            self.tokens = self.capacity
+            self.updated_at = time.monotonic()
+
+    def respond(self, path: str, body: Optional[bytes]) -> Tuple[int, str, bytes]:
+        if not path.endswith('/chat/completions'):
+            self.count('not_found')
+            return 404, 'application/json', b'{"error": {"message": "Not Found"}}'
+        if not self._take_request():
+            self.count('rate_limited')
+            error = {'message': f'Rate limit reached for requests, limit: {self.requests_per_minute:g} / min',
+                     'type': 'requests', 'code': 'rate_limit_exceeded'}
+            return 429, 'application/json', json.dumps({'error': error}).encode()
+        self.count('chat_completions')
+        request = json.loads(body)
+        response = {
+            'id': 'chatcmpl-bench',
+            'object': 'chat.completion',
+            'created': int(time.time()),
+            'model': request.get('model', 'bench'),
+            'choices': [{
+                'index': 0,
+                'message': {'role': 'assistant', 'content': self.answer},
+                'finish_reason': 'stop',
+            }],
+            'usage': {'prompt_tokens': 300, 'completion_tokens': 50, 'total_tokens': 350},
+        }
+        return 200, 'application/json', json.dumps(response).encode()
+
+    def _take_request(self) -> bool:
+        if not self.requests_per_minute:
+            return True
+        with self._lock:
+            now = time.monotonic()
+            self.tokens = min(self.capacity, self.tokens + (now - self.updated_at) * self.rate)
+            self.updated_at = now
+            if self.tokens < 1:
+                return False
+            self.tokens -= 1
+            return True
+
+    def get_headers(self, status: int) -> Dict[str, str]:
+        if not self.requests_per_minute:
+            return {}
+        with self._lock:
+            remaining = int(self.tokens)
+            # Until the next request is allowed, and until the bucket is full again
+            retry_after = max(0.0, (1 - self.tokens) / self.rate)
+            reset = (self.capacity - self.tokens) / self.rate
+        headers = {
+            'x-ratelimit-limit-requests': f'{self.requests_per_minute:g}',
+            'x-ratelimit-remaining-requests': str(remaining),
+            'x-ratelimit-reset-requests': f'{reset:.3f}s',
+        }
+        if status == 429:
+            headers['retry-after'] = f'{retry_after:.3f}'
+            headers['retry-after-ms'] = str(math.ceil(retry_after * 1000))
+        return headers
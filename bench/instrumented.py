@@ -0,0 +1,71 @@
+import functools
+import json
+import os
+import resource
+import runpy
+import sys
+import time
+from typing import Callable, Dict, List
+
+# Runs `main.py` with timers around its stages and writes them to a JSON file:
+# python -m bench.instrumented <result.json> [main.py arguments]
+
+ROOT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# Stage -> [(seconds, succeeded)]
+timings: Dict[str, List[list]] = {}
+
+def timed(stage: str, func: Callable, failed: Callable = lambda result: False) -> Callable:
+    records = timings.setdefault(stage, [])
+
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        started_at = time.perf_counter()
+        ok = False
+        try:
+            result = func(*args, **kwargs)
+            ok = not failed(result)
+            return result
+        finally:
+            records.append([time.perf_counter() - started_at, ok])
+    return wrapper
+
+def instrument():
+    # Before `main.py` and the pipeline import these names
+    import src.utils
+    from src.gpt import OpenAIImageToText
+    from src.nft import NFTMetadataFetcher
+
+    NFTMetadataFetcher.fetch_event_logs = timed('event_logs', NFTMetadataFetcher.fetch_event_logs)
+    NFTMetadataFetcher.fetch_metadata_for_token = timed('metadata', NFTMetadataFetcher.fetch_metadata_for_token)
+    src.utils.download_image = timed('image', src.utils.download_image)
+    OpenAIImageToText.get_text_from_image = timed('description', OpenAIImageToText.get_text_from_image,
+                                                  failed=lambda result: 'error' in result)
+
+def main():
+    result_path = sys.argv[1]
+    sys.argv = [os.path.join(ROOT_DIR, 'main.py')] + sys.argv[2:]
+    sys.path.insert(0, ROOT_DIR)
+
+    instrument()
+    error = None
+    started_at = time.perf_counter()
+    try:
+        runpy.run_path(sys.argv[0], run_name='__main__')
+    except BaseException as e:
+        error = f'{type(e).__name__}: {e}'
+        raise
+    finally:
+        result = {
+            'wall_seconds': time.perf_counter() - started_at,
+            'timings': timings,
+            # Kilobytes on Linux
+            'peak_rss_bytes': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024,
+            'children_peak_rss_bytes': resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss * 1024,
+            'error': error,
+        }
+        with open(result_path, 'w') as f:
+            json.dump(result, f)
+
+if __name__ == '__main__':
+    main()
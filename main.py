@@ -1,120 +1,430 @@
-from src.nft import NFTMetadataFetcher
-from src.gpt import OpenAIImageToText
+import argparse
+import time
+from functools import partial
+from itertools import groupby
+from typing import TYPE_CHECKING, Dict, List, Optional
 
 from src.proxy import setup_proxy
 from src.config import get_app_config, get_env_settings
-from src.db import DatabaseManager, NFTMetadata
+from src.db import DatabaseManager, NFTMetadataStore, DeadLetterStore, ImageHashStore, DEAD_LETTER_STAGES
+from src.planner import WorkPlanner
+from src.retry import RetryQueue, StageError, TransientError, PermanentError, get_retry_policy
+from src.workqueue import LeaseHeartbeat, WorkQueue
 
 from src.abi import ZORA1155_ABI, TRANSFERSINGLE_EVENT_SIGNATURE
 
 from src.log import log
-from src.utils import download_image, add_ntf_to_db
+from src.transcode import get_image_transcoder
+from src.metrics import get_metrics, start_metrics_exporter
+from src.utils import download_image, get_duplicate_description, get_token_tasks
+
+if TYPE_CHECKING:
+    # web3 and openai take seconds to import, so the modules using them are imported once there is work
+    from src.follow import ContractFollower
+    from src.gpt import OpenAIImageToText
+    from src.nft import NFTMetadataFetcher
 
 config = get_app_config()
 env = get_env_settings()
 
+parser = argparse.ArgumentParser(description='Retrieve NFT metadata and describe NFT images via AI')
+parser.add_argument('--mode', choices=['sequential', 'pipeline', 'batch'],
+                    default=config.general.get('mode', 'sequential'),
+                    help='process tokens one by one, in a concurrent staged pipeline, '
+                         'or fetch metadata one by one and describe images via the OpenAI Batch API')
+parser.add_argument('--retry-dead-letters', nargs='*', choices=DEAD_LETTER_STAGES, metavar='STAGE',
+                    help='only process the tokens that ran out of retries in previous runs, '
+                         f'optionally only those that failed at the given stages ({", ".join(DEAD_LETTER_STAGES)})')
+parser.add_argument('--follow', action='store_true',
+                    help='after processing the existing tokens, keep polling the contracts for new mints; '
+                         'a worker keeps waiting for queued tokens')
+parser.add_argument('--fresh-descriptions', action='store_true',
+                    help='describe every image via OpenAI, even if a nearly identical one is already described')
+parser.add_argument('--role', choices=['standalone', 'coordinator', 'worker'], default='standalone',
+                    help='process the tokens in this process, only queue them in the database, '
+                         'or process the queued tokens; any number of workers can run on several machines')
+args = parser.parse_args()
+if args.follow and args.mode == 'batch':
+    parser.error('--follow does not work with --mode batch')
+if args.role != 'standalone' and args.mode == 'batch':
+    parser.error(f'--role {args.role} does not work with --mode batch')
+if args.role == 'worker' and args.retry_dead_letters is not None:
+    parser.error('--retry-dead-letters only works for the coordinator, the workers take the queued tokens')
+
 setup_proxy()
 
 print('Initializing the database')
 db_manager = DatabaseManager(env.db_uri)
 session = db_manager.get_session()
 
+retry_policy = get_retry_policy()
+metrics = get_metrics()
+gpt: Optional['OpenAIImageToText'] = None
+
+def start_processing():
+    # Once some contract has work to do: runs that find nothing to do skip the transcoding processes,
+    # the OpenAI client, the metrics exporter and the full-text search index
+    global gpt
+    if gpt is not None:
+        return
+    if args.role != 'coordinator':
+        # Forked before any thread starts
+        get_image_transcoder()
+    from src.gpt import OpenAIImageToText
+    gpt = OpenAIImageToText(env.openai_api_key, config.openai['model'])
+    start_metrics_exporter()
+    db_manager.create_search_index()
+
+def process_token(
+        token_id: int,
+        store: NFTMetadataStore,
+        nft_fetcher: 'NFTMetadataFetcher',
+        image_hashes: ImageHashStore):
+    nft_row = store.get(token_id)
+
+    fetch_metadata, generate_description = get_token_tasks(
+        nft_row, config.openai.get('description_min_len', 100))
+    token = None
+    image_url = nft_row['image_url'] if nft_row else None
+    ai_desc = None
+
+    try:
+        if fetch_metadata:
+            log.print('Getting NFT metadata')
+            try:
+                with metrics.timer('nft_token_stage_seconds', stage='metadata'):
+                    token = nft_fetcher.fetch_metadata_for_token(token_id)
+            except Exception as e:
+                raise StageError('metadata', e)
+            image_url = token['image_url']
+
+        # In the batch mode the descriptions are generated after all the metadata is fetched
+        if generate_description and image_url and args.mode != 'batch':
+            log.print(f'Generating a description via `{config.openai["model"]}` model')
+            try:
+                with metrics.timer('nft_token_stage_seconds', stage='image'):
+                    image_base64, image_type, image_hash = download_image(
+                        image_url,
+                        config.paths.get('nft_images_dir'),
+                        config.openai.get('image_resolution', [512, 512])
+                    )
+            except Exception as e:
+                raise StageError('image', e)
+
+            duplicate = None
+            if image_hash is not None:
+                duplicate = get_duplicate_description(store, image_hashes, token_id, image_hash,
+                                                      config.openai.get('description_min_len', 100))
+            if duplicate:
+                log.print(f'Using the description of the similar token #{duplicate[0]}')
+                metrics.inc('nft_near_duplicate_descriptions_total')
+                ai_desc = duplicate[1]
+            else:
+                with metrics.timer('nft_token_stage_seconds', stage='description'):
+                    gpt_resp = gpt.get_text_from_image(image_base64, image_type, config.openai['prompt'])
+                if 'error' in gpt_resp:
+                    error_class = TransientError if gpt_resp.get('transient') else PermanentError
+                    raise StageError('description', error_class(f'OpenAI API Error: {gpt_resp["error"]}'))
+                ai_desc = gpt_resp['response']
+            if image_hash is not None:
+                image_hashes.add(token_id, image_hash)
+    finally:
+        # Whatever was done before a failure is kept, a retry goes on from there
+        store.save_token(token_id, nft_fetcher.collection_name, token, ai_desc)
+
+    if nft_row and not fetch_metadata and not generate_description:
+        log.print('Skipping')
+
+def create_fetcher(
+        chain_name: str,
+        contract: dict,
+        collection_name: Optional[str] = None,
+        next_token_id: Optional[int] = None) -> 'NFTMetadataFetcher':
+    from src.nft import NFTMetadataFetcher
+    return NFTMetadataFetcher(
+        network=chain_name,
+        contract_address=contract['address'],
+        abi=ZORA1155_ABI,
+        mint_event_signature=TRANSFERSINGLE_EVENT_SIGNATURE,
+        from_block=contract.get('from_block', 0),
+        first_id=contract.get('first_id', 1),
+        confirmations=chains[chain_name].get('confirmations', 12),
+        collection_name=collection_name,
+        next_token_id=next_token_id
+    )
+
+def process_tokens(
+        token_ids: List[int],
+        store: NFTMetadataStore,
+        nft_fetcher: 'NFTMetadataFetcher',
+        dead_letters: DeadLetterStore,
+        image_hashes: ImageHashStore,
+        retry_queue: Optional[RetryQueue] = None):
+    # With a retry queue (the follow mode) only the due retries are done, the rest wait for the next call
+    metrics.progress.plan(len(token_ids))
+    if args.mode == 'pipeline':
+        from src.pipeline import TokenPipeline
+        TokenPipeline(store, nft_fetcher, gpt, dead_letters, image_hashes, retry_queue).run(token_ids)
+        store.flush()
+        return
+
+    wait = retry_queue is None
+    if retry_queue is None:
+        retry_queue = RetryQueue(retry_policy)
+    for token_id, attempt in retry_queue.iterate(token_ids, wait):
+        log.set_params(token_id=token_id)
+        try:
+            process_token(token_id, store, nft_fetcher, image_hashes)
+        except StageError as e:
+            delay = retry_queue.schedule(token_id, attempt, e)
+            if delay is not None:
+                log.print(f"Can't get the {e.stage}: {e.error}. Try again in {delay:.0f} seconds")
+            else:
+                log.print(f"Can't get the {e.stage}: {e.error}. Moving to the dead letters")
+                dead_letters.add(token_id, e.stage, str(e.error), attempt)
+                metrics.finish_token('failed')
+        else:
+            dead_letters.remove(token_id)
+            metrics.finish_token()
+
+    store.flush()
+
 chains = config.blockchains
 
-for chain_name in chains:
-    for contract in chains[chain_name]['contracts']:
-        contract_address = contract['address']
-        from_block = contract.get('from_block', 0)
-        first_nft_id = contract.get('first_id', 1)
+planner = WorkPlanner(session, config.openai.get('description_min_len', 100),
+                      config.general.get('contract_state_ttl', 3600))
+planner.load_states()
+work_queue = None
+if args.role != 'standalone':
+    work_queue = WorkQueue(db_manager.Session,
+                           lease_seconds=config.queue.get('lease_seconds', 300),
+                           max_attempts=retry_policy.max_attempts)
 
-        print(f'The event log search will be from block #{from_block} for the `{chain_name}` blockchain')
+def create_store(chain_name: str, contract_address: str) -> NFTMetadataStore:
+    return NFTMetadataStore(session, chain_name, contract_address,
+                            batch_size=config.database.get('batch_size', 500),
+                            flush_interval=config.database.get('flush_interval', 5))
 
-        nft_fetcher = NFTMetadataFetcher(
-            network=chain_name,
-            contract_address=contract_address,
-            abi=ZORA1155_ABI,
-            mint_event_signature=TRANSFERSINGLE_EVENT_SIGNATURE,
-            from_block=from_block,
-            first_id=first_nft_id
-        )
+def create_image_hashes(chain_name: str, contract_address: str) -> ImageHashStore:
+    near_duplicates = config.near_duplicates
+    image_hashes = ImageHashStore(
+        session, chain_name, contract_address,
+        max_distance=near_duplicates.get('max_distance', 4),
+        reuse=near_duplicates.get('enabled', True) and not near_duplicates.get('force_fresh', False)
+        and not args.fresh_descriptions
+    )
+    image_hashes.load()
+    return image_hashes
 
-        nft_fetcher.fetch_event_logs()
+def enqueue_tokens(token_ids: List[int], chain_name: str, contract_address: str):
+    work_queue.enqueue(chain_name, contract_address, token_ids)
+    print(f'Queued {len(token_ids)} tokens of {contract_address}')
 
-        for token_id in range(first_nft_id, nft_fetcher.next_token_id):
-            log.set_params(network=chain_name, contract_address=contract_address,
-                           token_id=token_id, token_last_id=nft_fetcher.next_token_id - 1)
-            nft_row = session.query(NFTMetadata).filter(
-                NFTMetadata.network_name == chain_name,
-                NFTMetadata.contract_address == contract_address,
-                NFTMetadata.token_id == token_id
-            ).first()
-
-            fetch_metadata = False
-            generate_description = False
-            fetch_success = False
-            ai_desc = None
-
-            if nft_row:
-                if not nft_row.ai_image_description or \
-                    len(nft_row.ai_image_description) < config.openai.get('description_min_len', 100):
-                    generate_description = True
-                if not nft_row.collection_name or not nft_row.token_name or not \
-                    nft_row.description or not nft_row.image_url:
-                    fetch_metadata = True
+def run_contracts() -> List['ContractFollower']:
+    followers = []
+    for chain_name in chains:
+        for contract in chains[chain_name]['contracts']:
+            contract_address = contract['address']
+            first_nft_id = contract.get('first_id', 1)
+
+            # The network is only used when the DB can't tell what to do
+            nft_fetcher = None
+            state = planner.get_state(chain_name, contract_address)
+            if state is None:
+                nft_fetcher = create_fetcher(chain_name, contract)
+                state = planner.save_state(chain_name, contract_address,
+                                           nft_fetcher.collection_name, nft_fetcher.next_token_id)
+
+            dead_letters = DeadLetterStore(session, chain_name, contract_address)
+            dead_letters.load()
+            if args.retry_dead_letters is None:
+                token_ids = [token_id for token_id in range(first_nft_id, state.next_token_id)
+                             if token_id not in dead_letters]
             else:
-                fetch_metadata = True
-                generate_description = True
+                token_ids = dead_letters.get_token_ids(args.retry_dead_letters)
+                print(f'Retrying {len(token_ids)} tokens from the dead letters')
 
-            if fetch_metadata:
-                log.print('Getting NFT metadata')
-                token = nft_fetcher.fetch_metadata_for_token(token_id)
+            # In the batch mode the descriptions are generated after all the metadata is fetched
+            plan = planner.plan(chain_name, contract_address, token_ids, describe=args.mode != 'batch')
+            log.set_params(network=chain_name, contract_address=contract_address,
+                           token_last_id=state.next_token_id - 1)
+            print(f'`{chain_name}` {contract_address}: {len(plan.needs_metadata)} tokens need metadata, '
+                  f'{len(plan.needs_description)} need a description, {plan.complete} are complete')
+            if args.role == 'coordinator' and plan:
+                # The workers do the rest
+                enqueue_tokens(plan.token_ids, chain_name, contract_address)
+                plan = None
+            if not plan and not args.follow:
+                continue
+            start_processing()
 
-                if 'error' in token:
-                    log.print(f"Can't get the metadata: {token['error']}")
-                else:
-                    fetch_success = True
-
-            if generate_description and fetch_success:
-                log.print(f'Generating a description via `{config.openai["model"]}` model')
-                gpt = OpenAIImageToText(env.openai_api_key, config.openai['model'])
-                image_base64 = download_image(token['image_url'],
-                                              config.paths['nft_images_dir'],
-                                              config.openai.get('image_resolution', [512, 512]))
-                gpt_resp = gpt.get_text_from_image(image_base64, "image/png", config.openai['prompt'])
-                if 'error' in gpt_resp:
-                    log.print(f'OpenAI API Error: {gpt_resp["error"]}')
+            if nft_fetcher is None:
+                nft_fetcher = create_fetcher(chain_name, contract, state.collection_name, state.next_token_id)
+            # New tokens in the follow mode need the mint dates too
+            if (plan and plan.needs_metadata) or args.follow:
+                print(f'The event log search will be from block #{nft_fetcher.from_block} '
+                      f'for the `{chain_name}` blockchain')
+                nft_fetcher.fetch_event_logs()
+
+            store = create_store(chain_name, contract_address)
+            store.load()
+            image_hashes = create_image_hashes(chain_name, contract_address)
+            store.attach(dead_letters, image_hashes)
+
+            if plan:
+                process_tokens(plan.token_ids, store, nft_fetcher, dead_letters, image_hashes)
+
+            if args.follow:
+                from src.follow import ContractFollower
+                retry_queue = None
+                if args.role == 'coordinator':
+                    process_new_tokens = partial(enqueue_tokens, chain_name=chain_name,
+                                                 contract_address=contract_address)
                 else:
-                    ai_desc = gpt_resp['response']
-
-            if nft_row and fetch_success:
-                    nft_row.network_name = chain_name
-                    nft_row.contract_address = contract_address
-                    nft_row.collection_name = nft_fetcher.collection_name
-                    nft_row.token_id = token['token_id']
-                    nft_row.token_name = token['name']
-                    nft_row.description = token['description']
-                    nft_row.image_url = token['image_url']
-                    nft_row.mint_date = token['mint_date']
-                    session.commit()
-            elif not nft_row and fetch_success:
-                add_ntf_to_db(
-                    session,
-                    network=chain_name,
-                    contract_address=contract_address,
-                    collection_name=nft_fetcher.collection_name,
-                    token_id=token_id,
-                    token_name=token['name'],
-                    description=token['description'],
-                    image_url=token['image_url'],
-                    mint_date=token['mint_date'],
-                    ai_image_description=ai_desc
-                )
-            if nft_row and ai_desc:
-                nft_row.ai_image_description = ai_desc
-                session.commit()
-
-            if nft_row and not fetch_metadata and not generate_description:
-                log.print('Skipping')
+                    # One for the whole follow loop, so a failed token doesn't hold the polling up
+                    retry_queue = RetryQueue(retry_policy)
+                    process_new_tokens = partial(process_tokens, store=store, nft_fetcher=nft_fetcher,
+                                                 dead_letters=dead_letters, image_hashes=image_hashes,
+                                                 retry_queue=retry_queue)
+                followers.append(ContractFollower(session, planner, nft_fetcher, store, process_new_tokens,
+                                                  retry_queue))
+    return followers
+
+def follow_contracts(followers: List['ContractFollower']):
+    poll_interval = config.general.get('follow_poll_interval', 15)
+    print(f'Following {len(followers)} contracts for new mints every {poll_interval} seconds')
+    while True:
+        for follower in followers:
+            try:
+                follower.poll()
+            except Exception as e:
+                # The next poll starts from the last checkpoint
+                print(f'Follow error for {follower.nft_fetcher.contract_address}: {e}')
+        time.sleep(poll_interval)
+
+class WorkerContract:
+    # What a worker keeps per contract between the claimed batches
+    def __init__(self, chain_name: str, contract: dict):
+        state = planner.get_state(chain_name, contract['address'])
+        if state is None:
+            self.nft_fetcher = create_fetcher(chain_name, contract)
+            planner.save_state(chain_name, contract['address'],
+                               self.nft_fetcher.collection_name, self.nft_fetcher.next_token_id)
+        else:
+            self.nft_fetcher = create_fetcher(chain_name, contract, state.collection_name, state.next_token_id)
+        self.store = create_store(chain_name, contract['address'])
+        self.dead_letters = DeadLetterStore(session, chain_name, contract['address'])
+        self.image_hashes = create_image_hashes(chain_name, contract['address'])
+        self.store.attach(self.dead_letters, self.image_hashes)
+
+    def prepare(self, token_ids: List[int]):
+        # Other workers may have processed these tokens before
+        self.store.load(token_ids)
+        self.dead_letters.load(token_ids)
+        needs_metadata = [
+            token_id for token_id in token_ids
+            if get_token_tasks(self.store.get(token_id), config.openai.get('description_min_len', 100))[0]
+        ]
+        if not needs_metadata:
+            return
+        if self.nft_fetcher.event_logs is None:
+            self.nft_fetcher.fetch_event_logs()
+        if any(token_id not in self.nft_fetcher.mint_index for token_id in needs_metadata):
+            # Minted after the logs were fetched
+            self.nft_fetcher.refresh_event_logs()
+
+def claim_jobs(batch_size: int) -> List[Dict]:
+    # Empty when there is nothing left to do
+    while True:
+        jobs = work_queue.claim(batch_size)
+        # The coordinator may still be adding tokens
+        if jobs or not (args.follow or work_queue.has_open_jobs()):
+            return jobs
+        time.sleep(config.queue.get('poll_interval', 5))
+
+def run_worker():
+    contracts = {
+        (chain_name, contract['address']): contract
+        for chain_name in chains
+        for contract in chains[chain_name]['contracts']
+    }
+    batch_size = config.queue.get('batch_size', 20)
+    worker_contracts = {}
+    processed = 0
+    print(f'Worker {work_queue.worker_id} is waiting for tokens')
+
+    jobs = claim_jobs(batch_size)
+    if jobs:
+        # Before the heartbeat thread
+        start_processing()
+    with LeaseHeartbeat(work_queue, config.queue.get('heartbeat_interval', 60)) as heartbeat:
+        while jobs:
+            heartbeat.job_ids = [job['id'] for job in jobs]
+
+            for key, contract_jobs in groupby(jobs, key=lambda job: (job['network_name'], job['contract_address'])):
+                contract_jobs = list(contract_jobs)
+                chain_name, contract_address = key
+                if key not in contracts:
+                    for job in contract_jobs:
+                        work_queue.fail(job['id'], f'`{chain_name}` {contract_address} is not in the config')
+                    continue
+                if key not in worker_contracts:
+                    worker_contracts[key] = WorkerContract(chain_name, contracts[key])
+                worker_contract = worker_contracts[key]
+                worker_contract.prepare([job['token_id'] for job in contract_jobs])
+                log.set_params(network=chain_name, contract_address=contract_address,
+                               token_last_id=worker_contract.nft_fetcher.next_token_id - 1)
+
+                done = []
+                for job in contract_jobs:
+                    token_id = job['token_id']
+                    log.set_params(token_id=token_id)
+                    try:
+                        process_token(token_id, worker_contract.store, worker_contract.nft_fetcher,
+                                      worker_contract.image_hashes)
+                    except StageError as e:
+                        delay = retry_policy.next_delay(e, job['attempts'])
+                        if delay is None:
+                            worker_contract.dead_letters.add(token_id, e.stage, str(e.error), job['attempts'])
+                        # The saved progress and the dead letter have to be in the DB before the job is let go
+                        worker_contract.store.flush()
+                        if delay is not None:
+                            log.print(f"Can't get the {e.stage}: {e.error}. Try again in {delay:.0f} seconds")
+                            work_queue.release(job['id'], str(e), delay)
+                        else:
+                            log.print(f"Can't get the {e.stage}: {e.error}. Moving to the dead letters")
+                            work_queue.fail(job['id'], str(e))
+                            metrics.finish_token('failed')
+                    else:
+                        worker_contract.dead_letters.remove(token_id)
+                        done.append(job['id'])
+                        metrics.finish_token()
+
+                worker_contract.store.flush()
+                work_queue.complete(done)
+                processed += len(done)
+            heartbeat.job_ids = []
+            jobs = claim_jobs(batch_size)
+
+    print(f'Worker {work_queue.worker_id} processed {processed} tokens. '
+          f'Queue: {work_queue.get_counts()}')
+
+if args.role == 'worker':
+    run_worker()
+else:
+    followers = run_contracts()
+    if args.role == 'coordinator':
+        print(f'Queue: {work_queue.get_counts()}')
+    if args.follow:
+        follow_contracts(followers)
+
+if args.mode == 'batch':
+    from src.batch import OpenAIBatchDescriber
+    OpenAIBatchDescriber(session, env.openai_api_key, config.openai['model'], [
+        (chain_name, contract['address'])
+        for chain_name in chains
+        for contract in chains[chain_name]['contracts']
+    ]).run()
 
 session.close()
-print('\nDone')
\ No newline at end of file
+print('\nDone')
@@ -23,4 +23,36 @@ ZORA1155_ABI = [
         'outputs': [{'name': '', 'type': 'string'}],
         'type': 'function'
     }
-]
\ No newline at end of file
+]
+
+# Deployed at the same address on most EVM chains: https://www.multicall3.com
+MULTICALL3_ADDRESS = '0xcA11bde05977b3631167028862bE2a173976CA11'
+
+MULTICALL3_ABI = [
+    {
+        'inputs': [
+            {
+                'components': [
+                    {'name': 'target', 'type': 'address'},
+                    {'name': 'allowFailure', 'type': 'bool'},
+                    {'name': 'callData', 'type': 'bytes'}
+                ],
+                'name': 'calls',
+                'type': 'tuple[]'
+            }
+        ],
+        'name': 'aggregate3',
+        'outputs': [
+            {
+                'components': [
+                    {'name': 'success', 'type': 'bool'},
+                    {'name': 'returnData', 'type': 'bytes'}
+                ],
+                'name': 'returnData',
+                'type': 'tuple[]'
+            }
+        ],
+        'stateMutability': 'payable',
+        'type': 'function'
+    }
+]
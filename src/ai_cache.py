@@ -0,0 +1,85 @@
+import base64
+import hashlib
+import os
+import sqlite3
+import threading
+import time
+from typing import Optional
+
+from src.config import get_app_config
+
+class DescriptionCache:
+    def __init__(self, path: str, ttl: int = 0, max_entries: int = 0):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self._lock = threading.Lock()
+
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        self.conn = sqlite3.connect(path, check_same_thread=False)
+        self.conn.execute('''
+            CREATE TABLE IF NOT EXISTS descriptions (
+                key TEXT PRIMARY KEY,
+                description TEXT NOT NULL,
+                created_at REAL NOT NULL,
+                used_at REAL NOT NULL
+            )
+        ''')
+        self.conn.execute('CREATE INDEX IF NOT EXISTS descriptions_used_at ON descriptions (used_at)')
+        self.conn.commit()
+
+    @staticmethod
+    def make_key(image_base64: str, prompt: str, model: str) -> str:
+        digest = hashlib.sha256()
+        for part in (model.encode(), prompt.encode(), base64.b64decode(image_base64)):
+            # Length prefixes keep the parts from running into each other
+            digest.update(len(part).to_bytes(8, 'big'))
+            digest.update(part)
+        return digest.hexdigest()
+
+    def get(self, key: str) -> Optional[str]:
+        now = time.time()
+        with self._lock:
+            row = self.conn.execute(
+                'SELECT description, created_at FROM descriptions WHERE key = ?', (key,)
+            ).fetchone()
+            if row is None:
+                return None
+            description, created_at = row
+            if self.ttl and now - created_at > self.ttl:
+                self.conn.execute('DELETE FROM descriptions WHERE key = ?', (key,))
+                self.conn.commit()
+                return None
+            self.conn.execute('UPDATE descriptions SET used_at = ? WHERE key = ?', (now, key))
+            self.conn.commit()
+            return description
+
+    def put(self, key: str, description: str):
+        now = time.time()
+        with self._lock:
+            self.conn.execute(
+                'INSERT OR REPLACE INTO descriptions (key, description, created_at, used_at) VALUES (?, ?, ?, ?)',
+                (key, description, now, now)
+            )
+            if self.ttl:
+                self.conn.execute('DELETE FROM descriptions WHERE created_at < ?', (now - self.ttl,))
+            if self.max_entries:
+                # Evict the least recently used entries
+                self.conn.execute('''
+                    DELETE FROM descriptions WHERE key IN (
+                        SELECT key FROM descriptions ORDER BY used_at DESC LIMIT -1 OFFSET ?
+                    )
+                ''', (self.max_entries,))
+            self.conn.commit()
+
+def get_description_cache() -> Optional[DescriptionCache]:
+    config = get_app_config()
+    path = config.paths.get('cache', {}).get('descriptions')
+    if not path:
+        return None
+    return DescriptionCache(
+        path,
+        ttl=config.openai.get('description_cache_ttl', 0),
+        max_entries=config.openai.get('description_cache_max_entries', 0)
+    )
@@ -0,0 +1,195 @@
+import datetime
+import json
+import os
+import tempfile
+import time
+from openai import OpenAI
+from sqlalchemy import and_, func, or_
+from sqlalchemy.orm import Session
+from typing import Dict, Iterable, List, Optional, Tuple
+
+from src.ai_cache import get_description_cache
+from src.config import get_app_config
+from src.db import NFTMetadata, AIBatchJob, AIBatchItem
+from src.gpt import OpenAIImageToText
+from src.log import log
+from src.utils import download_image
+
+BATCH_FINAL_STATUSES = ('completed', 'failed', 'expired', 'cancelled')
+
+class OpenAIBatchDescriber:
+    def __init__(self, session: Session, api_key: str, model: str, contracts: Iterable[Tuple[str, str]]):
+        self.session = session
+        self.model = model
+        # (network, contract address) pairs of the configured contracts; other rows in the DB are left alone
+        self.contracts = list(contracts)
+
+        self.config = get_app_config()
+        self.client = OpenAI(api_key=api_key, base_url=self.config.openai.get('base_url'))
+        self.prompt = self.config.openai['prompt']
+        self.min_len = self.config.openai.get('description_min_len', 100)
+        self.max_attempts = self.config.openai.get('max_attempts', 5)
+        self.batch_size = self.config.openai.get('batch_size', 500)
+        self.poll_interval = self.config.openai.get('batch_poll_interval', 60)
+        self.cache = get_description_cache()
+        # Rows whose images couldn't be downloaded in this run
+        self.skipped_ids = set()
+
+    def run(self):
+        # Batches submitted by a previous run that died before collecting them
+        for job in self.session.query(AIBatchJob).filter(AIBatchJob.status != 'collected').all():
+            print(f'Resuming the batch job {job.batch_id}')
+            self._wait_and_collect(job)
+
+        while True:
+            rows = [row for row in self._get_rows_to_describe() if row.id not in self.skipped_ids]
+            if not rows:
+                break
+            for i in range(0, len(rows), self.batch_size):
+                job = self._submit(rows[i:i + self.batch_size])
+                if job:
+                    self._wait_and_collect(job)
+
+    def _get_rows_to_describe(self) -> List[NFTMetadata]:
+        if not self.contracts:
+            return []
+        attempts = self.session.query(
+            AIBatchItem.nft_id, func.count(AIBatchItem.id).label('attempts')
+        ).group_by(AIBatchItem.nft_id).subquery()
+
+        return self.session.query(NFTMetadata).outerjoin(
+            attempts, attempts.c.nft_id == NFTMetadata.id
+        ).filter(
+            or_(*(
+                and_(NFTMetadata.network_name == network, NFTMetadata.contract_address == contract_address)
+                for network, contract_address in self.contracts
+            )),
+            or_(
+                NFTMetadata.ai_image_description.is_(None),
+                func.length(NFTMetadata.ai_image_description) < self.min_len
+            ),
+            NFTMetadata.image_url.isnot(None),
+            # Short answers are re-queued, but not forever
+            or_(attempts.c.attempts.is_(None), attempts.c.attempts <= self.max_attempts)
+        ).order_by(NFTMetadata.id).all()
+
+    def _submit(self, rows: List[NFTMetadata]) -> Optional[AIBatchJob]:
+        items = []
+        fd, input_path = tempfile.mkstemp(suffix='.jsonl')
+        try:
+            with os.fdopen(fd, 'w') as f:
+                for row in rows:
+                    log.set_params(network=row.network_name, contract_address=row.contract_address,
+                                   token_id=row.token_id)
+                    try:
+                        image_base64, image_type, _ = download_image(
+                            row.image_url,
+                            self.config.paths.get('nft_images_dir'),
+                            self.config.openai.get('image_resolution', [512, 512])
+                        )
+                    except Exception as e:
+                        log.print(f"Can't get the image: {e}")
+                        self.skipped_ids.add(row.id)
+                        continue
+
+                    cache_key = None
+                    if self.cache:
+                        cache_key = self.cache.make_key(image_base64, self.prompt, self.model)
+                        text = self.cache.get(cache_key)
+                        if text is not None:
+                            log.print('Using a cached description')
+                            row.ai_image_description = text
+                            continue
+
+                    f.write(json.dumps(self._make_request_line(row, image_base64, image_type)) + '\n')
+                    items.append((row.id, cache_key))
+            self.session.commit()
+
+            if not items:
+                return None
+
+            print(f'Submitting a batch of {len(items)} requests')
+            with open(input_path, 'rb') as f:
+                input_file = self.client.files.create(file=f, purpose='batch')
+        finally:
+            os.remove(input_path)
+
+        batch = self.client.batches.create(
+            input_file_id=input_file.id,
+            endpoint='/v1/chat/completions',
+            completion_window='24h'
+        )
+
+        now = datetime.datetime.now(datetime.timezone.utc)
+        job = AIBatchJob(batch_id=batch.id, input_file_id=input_file.id, status=batch.status,
+                         created_at=now, updated_at=now)
+        self.session.add(job)
+        self.session.flush()
+        self.session.add_all(AIBatchItem(job_id=job.id, nft_id=nft_id, cache_key=cache_key)
+                             for nft_id, cache_key in items)
+        self.session.commit()
+        print(f'The batch job {batch.id} has been submitted')
+        return job
+
+    def _make_request_line(self, row: NFTMetadata, image_base64: str, image_type: str) -> Dict:
+        return {
+            'custom_id': f'nft-{row.id}',
+            'method': 'POST',
+            'url': '/v1/chat/completions',
+            'body': {
+                'model': self.model,
+                'messages': OpenAIImageToText.build_messages(image_base64, image_type, self.prompt),
+            }
+        }
+
+    def _wait_and_collect(self, job: AIBatchJob):
+        while True:
+            batch = self.client.batches.retrieve(job.batch_id)
+            self._update_job(job, batch.status, batch.output_file_id)
+            if batch.status in BATCH_FINAL_STATUSES:
+                break
+            counts = batch.request_counts
+            if counts:
+                print(f'The batch job {job.batch_id} is {batch.status}: '
+                      f'{counts.completed}/{counts.total} done, {counts.failed} failed')
+            time.sleep(self.poll_interval)
+
+        if batch.status != 'completed':
+            print(f'The batch job {job.batch_id} is {batch.status}, its requests will be submitted again')
+        elif batch.output_file_id:
+            self._collect(job, batch.output_file_id)
+        self._update_job(job, 'collected', batch.output_file_id)
+
+    def _collect(self, job: AIBatchJob, output_file_id: str):
+        cache_keys = dict(
+            self.session.query(AIBatchItem.nft_id, AIBatchItem.cache_key).filter(AIBatchItem.job_id == job.id)
+        )
+        saved = 0
+        with self.client.files.with_streaming_response.content(output_file_id) as response:
+            for line in response.iter_lines():
+                if not line:
+                    continue
+                result = json.loads(line)
+                nft_id = int(result['custom_id'].removeprefix('nft-'))
+                body = (result.get('response') or {}).get('body') or {}
+                choices = body.get('choices') or []
+                text = choices[0]['message'].get('content') if choices else None
+                if not text or len(text) < self.min_len:
+                    # Left without a description, so the next submission will pick it up
+                    continue
+
+                row = self.session.get(NFTMetadata, nft_id)
+                if row is None:
+                    continue
+                row.ai_image_description = text
+                saved += 1
+                if self.cache and cache_keys.get(nft_id):
+                    self.cache.put(cache_keys[nft_id], text)
+        self.session.commit()
+        print(f'Saved {saved} descriptions from the batch job {job.batch_id}')
+
+    def _update_job(self, job: AIBatchJob, status: str, output_file_id: Optional[str]):
+        job.status = status
+        job.output_file_id = output_file_id
+        job.updated_at = datetime.datetime.now(datetime.timezone.utc)
+        self.session.commit()
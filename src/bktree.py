@@ -0,0 +1,47 @@
+from typing import Any, List, Optional, Tuple
+
+def hamming_distance(a: int, b: int) -> int:
+    return (a ^ b).bit_count()
+
+class BKTree:
+    # Hashes within a Hamming distance of a query without comparing it to all of them.
+    # A node is [hash, items, {distance to the node: child}], equal hashes share a node
+    def __init__(self):
+        self.root: Optional[list] = None
+        self.size = 0
+
+    def __len__(self) -> int:
+        return self.size
+
+    def add(self, key: int, item: Any):
+        self.size += 1
+        if self.root is None:
+            self.root = [key, [item], {}]
+            return
+        node = self.root
+        while True:
+            distance = hamming_distance(key, node[0])
+            if distance == 0:
+                node[1].append(item)
+                return
+            child = node[2].get(distance)
+            if child is None:
+                node[2][distance] = [key, [item], {}]
+                return
+            node = child
+
+    def find(self, key: int, max_distance: int) -> List[Tuple[int, Any]]:
+        # (distance, item), the closest first
+        results = []
+        stack = [self.root] if self.root is not None else []
+        while stack:
+            node = stack.pop()
+            distance = hamming_distance(key, node[0])
+            if distance <= max_distance:
+                results.extend((distance, item) for item in node[1])
+            # The triangle inequality rules out the other subtrees
+            for child_distance, child in node[2].items():
+                if distance - max_distance <= child_distance <= distance + max_distance:
+                    stack.append(child)
+        results.sort(key=lambda result: result[0])
+        return results
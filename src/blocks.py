@@ -0,0 +1,102 @@
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, Iterable, List, Optional
+from web3 import Web3
+
+from src.config import get_app_config
+
+class BlockTimestampCache:
+    def __init__(self, web3: Web3, network: str):
+        self.web3 = web3
+        self.network = network
+        self.timestamps: Dict[int, int] = {}
+        self._lock = threading.Lock()
+
+        self.app_config = get_app_config()
+        self.batch_size = self.app_config.general.get('block_batch_size', 500)
+        self.workers = self.app_config.general.get('block_workers', 4)
+        self._load()
+
+    def get(self, block_number: int) -> Optional[int]:
+        timestamp = self.timestamps.get(block_number)
+        if timestamp is None:
+            self.fetch_missing([block_number])
+            timestamp = self.timestamps.get(block_number)
+        return timestamp
+
+    def fetch_missing(self, block_numbers: Iterable[int], skip_failed: bool = False):
+        # With `skip_failed` the blocks of a failed batch stay missing, `get` fetches them one by one later
+        with self._lock:
+            missing = sorted({n for n in block_numbers if n not in self.timestamps})
+            if not missing:
+                return
+
+            print(f'Getting timestamps of {len(missing)} blocks')
+            batches = [missing[i:i + self.batch_size] for i in range(0, len(missing), self.batch_size)]
+            # Concurrent batches are spread over the RPC endpoints of the chain
+            with ThreadPoolExecutor(max_workers=max(1, min(self.workers, len(batches)))) as executor:
+                fetched = {}
+                futures = [executor.submit(self._fetch_batch, batch) for batch in batches]
+                for batch, future in zip(batches, futures):
+                    try:
+                        fetched.update(future.result())
+                    except Exception as e:
+                        if not skip_failed:
+                            raise
+                        print(f'Failed to get the timestamps of blocks {batch[0]}-{batch[-1]}, '
+                              f'they will be fetched when needed: {e}')
+            self.timestamps.update(fetched)
+            self._append(fetched)
+
+    def _fetch_batch(self, block_numbers: List[int]) -> Dict[int, int]:
+        # `False`: only transaction hashes, not full transactions
+        responses = self.web3.provider.make_batch_request(
+            [('eth_getBlockByNumber', [hex(n), False]) for n in block_numbers]
+        )
+        if not isinstance(responses, list):
+            raise RuntimeError(f'Batch request for block timestamps failed: {responses.get("error")}')
+
+        timestamps = {}
+        for response in responses:
+            if 'error' in response or not response.get('result'):
+                raise RuntimeError(f'Failed to fetch a block: {response.get("error", "empty result")}')
+            block = response['result']
+            timestamps[int(block['number'], 16)] = int(block['timestamp'], 16)
+        return timestamps
+
+    def _get_cache_fname(self) -> str:
+        cache_dir = self.app_config.paths['cache']['event_logs']
+        os.makedirs(cache_dir, exist_ok=True)
+        return os.path.join(cache_dir, f'{self.network}_block_timestamps.txt')
+
+    def _load(self):
+        # "<block number> <timestamp>" lines; a line cut short by a crash is skipped
+        cache_fname = self._get_cache_fname()
+        if not os.path.exists(cache_fname):
+            return
+        with open(cache_fname, 'r') as f:
+            for line in f:
+                fields = line.split()
+                if len(fields) == 2 and line.endswith('\n'):
+                    self.timestamps[int(fields[0])] = int(fields[1])
+
+    def _append(self, timestamps: Dict[int, int]):
+        # Only the new blocks, in a single append: processes sharing the file don't overwrite each other's blocks
+        if not timestamps:
+            return
+        data = ''.join(f'{n} {timestamp}\n' for n, timestamp in sorted(timestamps.items())).encode()
+        fd = os.open(self._get_cache_fname(), os.O_WRONLY | os.O_CREAT | os.O_APPEND, 0o644)
+        try:
+            while data:
+                data = data[os.write(fd, data):]
+        finally:
+            os.close(fd)
+
+# Contracts on the same chain share one cache per run
+_caches: Dict[str, BlockTimestampCache] = {}
+
+def get_block_timestamp_cache(web3: Web3, network: str) -> BlockTimestampCache:
+    if network not in _caches:
+        _caches[network] = BlockTimestampCache(web3, network)
+    return _caches[network]
@@ -7,8 +7,6 @@ from typing import Dict, Any
 class EnvSettings:
     def __init__(self):
         # Required parameters
-        self.infura_api_key = os.getenv('INFURA_API_KEY')
-        self.drpc_api_key = os.getenv('DRPC_API_KEY')
         self.openai_api_key = os.getenv('OPENAI_API_KEY')
         self.db_uri = os.getenv('DB_URI')
 
@@ -22,8 +20,6 @@ class EnvSettings:
 
     def _validate_required(self):
         required = {
-            'INFURA_API_KEY': self.infura_api_key,
-            'DRPC_API_KEY': self.drpc_api_key,
             'OPENAI_API_KEY': self.openai_api_key,
             'DB_URI': self.db_uri,
         }
@@ -39,6 +35,12 @@ class AppConfig:
         self.database = config_data.get('database', {})
         self.paths = config_data.get('paths', {})
         self.openai = config_data.get('openai', {})
+        self.pipeline = config_data.get('pipeline', {})
+        self.ipfs = config_data.get('ipfs', {})
+        self.retry = config_data.get('retry', {})
+        self.queue = config_data.get('queue', {})
+        self.metrics = config_data.get('metrics', {})
+        self.near_duplicates = config_data.get('near_duplicates', {})
     
     @classmethod
     def from_yaml(cls, path: str):
@@ -1,14 +1,34 @@
-from sqlalchemy import create_engine, Column, String, Integer, Text, DateTime
+from sqlalchemy import create_engine, func, inspect, literal, literal_column, or_, select, Column, String, Integer, Text, \
+    DateTime, Float, ForeignKey, Index, Table
+from sqlalchemy.sql import column as sql_column, table as sql_table
+from sqlalchemy.engine import Connection, Engine
 from sqlalchemy.ext.declarative import declarative_base
-from sqlalchemy.orm import sessionmaker
-from sqlalchemy.exc import OperationalError
+from sqlalchemy.orm import sessionmaker, Session
+from sqlalchemy.exc import OperationalError, IntegrityError
+from sqlalchemy.dialects import postgresql, sqlite
+import datetime
 import os
+import re
+import time
+from typing import Dict, List, Optional
+
+from src.bktree import BKTree
+from src.metrics import get_metrics
 
 import logging
 logging.getLogger('sqlalchemy.engine').setLevel(logging.CRITICAL)
 
 Base = declarative_base()
 
+def utcnow() -> datetime.datetime:
+    # Naive UTC, as DateTime columns store it
+    return datetime.datetime.now(datetime.timezone.utc).replace(tzinfo=None)
+
+def to_naive_utc(value: Optional[datetime.datetime]) -> Optional[datetime.datetime]:
+    if value is None or value.tzinfo is None:
+        return value
+    return value.astimezone(datetime.timezone.utc).replace(tzinfo=None)
+
 class NFTMetadata(Base):
     __tablename__ = 'nft_metadata'
 
@@ -22,13 +42,147 @@ class NFTMetadata(Base):
     image_url = Column(String, nullable=True)
     mint_date = Column(DateTime, nullable=True)
     ai_image_description = Column(Text, nullable=True)
+    # Last write of the row, for incremental exports; empty for rows not changed since the column was added
+    updated_at = Column(DateTime, nullable=True, onupdate=utcnow)
+
+    __table_args__ = (
+        Index('ix_nft_metadata_token', 'network_name', 'contract_address', 'token_id', unique=True),
+        Index('ix_nft_metadata_updated_at', 'updated_at'),
+    )
+
+# Columns written by NFTMetadataStore
+NFT_METADATA_COLUMNS = [column.name for column in NFTMetadata.__table__.columns if column.name != 'id']
+NFT_METADATA_KEY = ['network_name', 'contract_address', 'token_id']
+
+# Bound parameters per statement, below the limit of 999 of SQLite before 3.32
+MAX_BIND_PARAMETERS = 900
+
+class AIBatchJob(Base):
+    __tablename__ = 'ai_batch_jobs'
+
+    id = Column(Integer, primary_key=True, autoincrement=True)
+    batch_id = Column(String, nullable=False, unique=True)
+    input_file_id = Column(String, nullable=False)
+    output_file_id = Column(String, nullable=True)
+    # OpenAI batch status, or `collected` once the results are saved
+    status = Column(String, nullable=False)
+    created_at = Column(DateTime, nullable=False)
+    updated_at = Column(DateTime, nullable=False)
+
+class AIBatchItem(Base):
+    __tablename__ = 'ai_batch_items'
+
+    id = Column(Integer, primary_key=True, autoincrement=True)
+    job_id = Column(Integer, ForeignKey('ai_batch_jobs.id'), nullable=False, index=True)
+    nft_id = Column(Integer, ForeignKey('nft_metadata.id'), nullable=False, index=True)
+    cache_key = Column(String, nullable=True)
+
+class DeadLetter(Base):
+    __tablename__ = 'dead_letters'
+
+    id = Column(Integer, primary_key=True, autoincrement=True)
+    network_name = Column(String, nullable=False)
+    contract_address = Column(String, nullable=False)
+    token_id = Column(Integer, nullable=False)
+    # metadata, image, description, or lease: the workers holding the token died or hung too many times
+    stage = Column(String, nullable=False)
+    error = Column(Text, nullable=True)
+    attempts = Column(Integer, nullable=False)
+    failed_at = Column(DateTime, nullable=False)
+
+    __table_args__ = (
+        Index('ix_dead_letters_token', 'network_name', 'contract_address', 'token_id', unique=True),
+    )
+
+DEAD_LETTER_STAGES = ('metadata', 'image', 'description', 'lease')
+
+class ContractState(Base):
+    __tablename__ = 'contract_states'
+
+    id = Column(Integer, primary_key=True, autoincrement=True)
+    network_name = Column(String, nullable=False)
+    contract_address = Column(String, nullable=False)
+    collection_name = Column(String, nullable=True)
+    next_token_id = Column(Integer, nullable=True)
+    # When `name()` and `nextTokenId()` were last read from the contract
+    checked_at = Column(DateTime, nullable=True)
+
+    __table_args__ = (
+        Index('ix_contract_states_contract', 'network_name', 'contract_address', unique=True),
+    )
+
+class FollowCheckpoint(Base):
+    __tablename__ = 'follow_checkpoints'
+
+    id = Column(Integer, primary_key=True, autoincrement=True)
+    network_name = Column(String, nullable=False)
+    contract_address = Column(String, nullable=False)
+    # Mint logs up to this block and tokens below `next_token_id` have been processed
+    last_block = Column(Integer, nullable=False)
+    next_token_id = Column(Integer, nullable=False)
+    updated_at = Column(DateTime, nullable=False)
+
+    __table_args__ = (
+        Index('ix_follow_checkpoints_contract', 'network_name', 'contract_address', unique=True),
+    )
+
+class TokenJob(Base):
+    __tablename__ = 'token_jobs'
+
+    id = Column(Integer, primary_key=True, autoincrement=True)
+    network_name = Column(String, nullable=False)
+    contract_address = Column(String, nullable=False)
+    token_id = Column(Integer, nullable=False)
+    # pending, leased, done or failed
+    status = Column(String, nullable=False)
+    attempts = Column(Integer, nullable=False, default=0)
+    # A pending job is not claimed before this time (retry backoff)
+    available_at = Column(DateTime, nullable=False)
+    lease_owner = Column(String, nullable=True)
+    lease_expires_at = Column(DateTime, nullable=True)
+    last_error = Column(Text, nullable=True)
+    created_at = Column(DateTime, nullable=False)
+    updated_at = Column(DateTime, nullable=False)
+
+    __table_args__ = (
+        Index('ix_token_jobs_token', 'network_name', 'contract_address', 'token_id', unique=True),
+        Index('ix_token_jobs_status', 'status', 'available_at'),
+    )
+
+class ImageHash(Base):
+    __tablename__ = 'image_hashes'
+
+    id = Column(Integer, primary_key=True, autoincrement=True)
+    network_name = Column(String, nullable=False)
+    contract_address = Column(String, nullable=False)
+    token_id = Column(Integer, nullable=False)
+    # 64-bit dHash of the described image as 16 hex digits
+    image_hash = Column(String(16), nullable=False)
+    updated_at = Column(DateTime, nullable=False)
+
+    __table_args__ = (
+        Index('ix_image_hashes_token', 'network_name', 'contract_address', 'token_id', unique=True),
+    )
+
+class ExportWatermark(Base):
+    __tablename__ = 'export_watermarks'
+
+    id = Column(Integer, primary_key=True, autoincrement=True)
+    # Chosen by the consumer of the incremental export
+    name = Column(String, nullable=False, unique=True)
+    # Rows changed before this time have been exported
+    watermark = Column(DateTime, nullable=False)
+    updated_at = Column(DateTime, nullable=False)
 
 class DatabaseManager:
     def __init__(self, db_uri: str):
         self.db_uri = db_uri
-        self.engine = create_engine(self.db_uri)
+        # SQLite is shared by worker processes, so a writer waits for the lock instead of failing
+        connect_args = {'timeout': 60} if db_uri.startswith('sqlite') else {}
+        self.engine = create_engine(self.db_uri, connect_args=connect_args)
         self.Session = sessionmaker(bind=self.engine)
-        
+        self._search_index: Optional['NFTSearchIndex'] = None
+
         self._create_database()
         db_path = self._get_db_file_path()
         if db_path and not os.path.exists(db_path):
@@ -42,8 +196,441 @@ class DatabaseManager:
     def _create_database(self):
         try:
             Base.metadata.create_all(self.engine)
+            self._add_missing_columns()
+            # create_all() doesn't add new indexes to existing tables
+            for index in NFTMetadata.__table__.indexes:
+                index.create(self.engine, checkfirst=True)
+        except IntegrityError as e:
+            raise RuntimeError(f'The `nft_metadata` table has duplicate tokens, remove them first: {e}')
         except OperationalError as e:
             raise RuntimeError(f'Error during database creation: {e}')
 
+    @property
+    def search_index(self) -> 'NFTSearchIndex':
+        return self.create_search_index()
+
+    def create_search_index(self) -> 'NFTSearchIndex':
+        # Not at startup: the first time it indexes every row. Once created, the database keeps it up to date
+        if self._search_index is None:
+            self._search_index = NFTSearchIndex(self.engine)
+            self._search_index.create()
+        return self._search_index
+
+    def _add_missing_columns(self):
+        # For new columns, which create_all() doesn't add either: only nullable ones, existing rows get NULL
+        table = NFTMetadata.__table__
+        existing = {column['name'] for column in inspect(self.engine).get_columns(table.name)}
+        with self.engine.begin() as connection:
+            for column in table.columns:
+                if column.name not in existing and column.nullable:
+                    column_type = column.type.compile(dialect=self.engine.dialect)
+                    connection.exec_driver_sql(f'ALTER TABLE {table.name} ADD COLUMN {column.name} {column_type}')
+
     def get_session(self):
         return self.Session()
+
+# Searched columns and their rank weights: a match in the name counts more than in a description
+SEARCH_COLUMNS = {'token_name': 10.0, 'description': 2.0, 'ai_image_description': 1.0}
+
+class NFTSearchIndex:
+    # Full-text index over `nft_metadata`: an FTS5 table kept in sync by triggers on SQLite,
+    # a generated `tsvector` column with a GIN index on PostgreSQL, a LIKE scan elsewhere
+    def __init__(self, engine: Engine):
+        self.engine = engine
+        self.dialect = engine.dialect.name
+        self.available = self.dialect in ('sqlite', 'postgresql')
+
+    def create(self):
+        # Also indexes the existing rows the first time
+        try:
+            with self.engine.begin() as connection:
+                if self.dialect == 'sqlite':
+                    self._create_sqlite(connection)
+                elif self.dialect == 'postgresql':
+                    self._create_postgresql(connection)
+        except OperationalError as e:
+            # E.g. SQLite built without FTS5
+            print(f'The full-text search index is not available, search will scan the table: {e}')
+            self.available = False
+
+    def _create_sqlite(self, connection: Connection):
+        exists = connection.exec_driver_sql(
+            "SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'nft_metadata_fts'"
+        ).first()
+        columns = ', '.join(SEARCH_COLUMNS)
+        new_columns = ', '.join(f'new.{column}' for column in SEARCH_COLUMNS)
+        old_columns = ', '.join(f'old.{column}' for column in SEARCH_COLUMNS)
+        # External content: the FTS table stores only the index, the text stays in `nft_metadata`
+        connection.exec_driver_sql(
+            f'CREATE VIRTUAL TABLE IF NOT EXISTS nft_metadata_fts USING fts5({columns}, '
+            "content='nft_metadata', content_rowid='id', tokenize='porter unicode61 remove_diacritics 2')"
+        )
+        insert_new = f'INSERT INTO nft_metadata_fts(rowid, {columns}) VALUES (new.id, {new_columns});'
+        delete_old = (f"INSERT INTO nft_metadata_fts(nft_metadata_fts, rowid, {columns}) "
+                      f"VALUES ('delete', old.id, {old_columns});")
+        changed = ' OR '.join(f'old.{column} IS NOT new.{column}' for column in SEARCH_COLUMNS)
+        connection.exec_driver_sql(
+            'CREATE TRIGGER IF NOT EXISTS nft_metadata_fts_insert AFTER INSERT ON nft_metadata '
+            f'BEGIN {insert_new} END'
+        )
+        connection.exec_driver_sql(
+            'CREATE TRIGGER IF NOT EXISTS nft_metadata_fts_delete AFTER DELETE ON nft_metadata '
+            f'BEGIN {delete_old} END'
+        )
+        # Upserts rewrite every column, so only changes of the searched text touch the index
+        connection.exec_driver_sql(
+            f'CREATE TRIGGER IF NOT EXISTS nft_metadata_fts_update AFTER UPDATE OF {columns} ON nft_metadata '
+            f'WHEN {changed} BEGIN {delete_old} {insert_new} END'
+        )
+        if not exists:
+            self._rebuild(connection)
+
+    def _create_postgresql(self, connection: Connection):
+        weights = dict(zip(SEARCH_COLUMNS, 'ABC'))
+        vector = ' || '.join(
+            f"setweight(to_tsvector('english', coalesce({column}, '')), '{weight}')"
+            for column, weight in weights.items()
+        )
+        # A generated column is computed for the existing rows when it is added
+        connection.exec_driver_sql(
+            'ALTER TABLE nft_metadata ADD COLUMN IF NOT EXISTS search_vector tsvector '
+            f'GENERATED ALWAYS AS ({vector}) STORED'
+        )
+        connection.exec_driver_sql(
+            'CREATE INDEX IF NOT EXISTS ix_nft_metadata_search ON nft_metadata USING GIN (search_vector)'
+        )
+
+    def rebuild(self):
+        with self.engine.begin() as connection:
+            self._rebuild(connection)
+
+    def _rebuild(self, connection: Connection):
+        if self.dialect == 'sqlite' and self.available:
+            print('Building the full-text search index')
+            connection.exec_driver_sql("INSERT INTO nft_metadata_fts(nft_metadata_fts) VALUES ('rebuild')")
+        elif self.dialect == 'postgresql':
+            connection.exec_driver_sql('REINDEX INDEX ix_nft_metadata_search')
+
+    def search(
+            self,
+            query: str,
+            limit: int = 20,
+            offset: int = 0,
+            network: Optional[str] = None,
+            contract_address: Optional[str] = None) -> Dict:
+        # {'results': rows with a `rank`, the best first; 'next_offset': None on the last page}
+        table = NFTMetadata.__table__
+        filters = []
+        if network:
+            filters.append(table.c.network_name == network)
+        if contract_address:
+            filters.append(table.c.contract_address == contract_address)
+
+        if self.dialect == 'sqlite' and self.available:
+            fts_query = self._get_fts5_query(query)
+            if not fts_query:
+                return {'results': [], 'next_offset': None}
+            fts = sql_table('nft_metadata_fts', sql_column('rowid'), sql_column('nft_metadata_fts'))
+            # bm25() is lower for better matches
+            bm25 = func.bm25(literal_column(fts.name), *SEARCH_COLUMNS.values())
+            stmt = select(table, (-bm25).label('rank')).join(fts, fts.c.rowid == table.c.id).where(
+                fts.c.nft_metadata_fts.match(fts_query), *filters
+            ).order_by(bm25)
+        elif self.dialect == 'postgresql' and self.available:
+            # Quotes, OR and -word as in web search engines
+            ts_query = func.websearch_to_tsquery(literal_column("'english'"), query)
+            search_vector = literal_column(f'{table.name}.search_vector')
+            rank = func.ts_rank_cd(search_vector, ts_query, type_=Float)
+            stmt = select(table, rank.label('rank')).where(
+                search_vector.op('@@')(ts_query), *filters
+            ).order_by(rank.desc(), table.c.id)
+        else:
+            terms = self._get_terms(query)
+            if not terms:
+                return {'results': [], 'next_offset': None}
+            for term in terms:
+                filters.append(or_(*(table.c[column].like(f'%{term}%') for column in SEARCH_COLUMNS)))
+            stmt = select(table, literal(0.0, Float).label('rank')).where(*filters).order_by(table.c.id)
+
+        with get_metrics().timer('nft_db_search_seconds'):
+            with self.engine.connect() as connection:
+                rows = [dict(row) for row in connection.execute(
+                    stmt.limit(limit + 1).offset(offset)
+                ).mappings()]
+        # One row more than asked tells whether there is a next page
+        next_offset = offset + limit if len(rows) > limit else None
+        return {'results': rows[:limit], 'next_offset': next_offset}
+
+    @staticmethod
+    def _get_terms(query: str) -> List[str]:
+        return re.findall(r'\w+\*?', query)
+
+    @classmethod
+    def _get_fts5_query(cls, query: str) -> str:
+        # Every word must match, `word*` matches by prefix; quoting keeps FTS5 operators out of user input
+        return ' '.join(
+            f'"{term[:-1]}"*' if term.endswith('*') else f'"{term}"'
+            for term in cls._get_terms(query)
+        )
+
+class NFTMetadataStore:
+    def __init__(
+            self,
+            session: Session,
+            network: str,
+            contract_address: str,
+            batch_size: int = 500,
+            flush_interval: float = 5.0):
+        self.session = session
+        self.network = network
+        self.contract_address = contract_address
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+
+        # Token ID -> row values
+        self.rows: Dict[int, Dict] = {}
+        self.pending: Dict[int, Dict] = {}
+        self.flushed_at = time.monotonic()
+        # Stores of the same contract whose staged rows are written and committed along with these
+        self.attached = []
+
+    def attach(self, *stores):
+        self.attached.extend(stores)
+
+    def load(self, token_ids: Optional[List[int]] = None):
+        # All rows of the contract, or only the given tokens (re-read, other workers may have changed them)
+        table = NFTMetadata.__table__
+        query = select(table).where(
+            table.c.network_name == self.network,
+            table.c.contract_address == self.contract_address
+        )
+        if token_ids is not None:
+            query = query.where(table.c.token_id.in_(token_ids))
+            rows = {row['token_id']: dict(row) for row in self.session.execute(query).mappings()}
+            for token_id in token_ids:
+                self.rows.pop(token_id, None)
+            self.rows.update(rows)
+            return
+        self.rows = {row['token_id']: dict(row) for row in self.session.execute(query).mappings()}
+
+    def get(self, token_id: int) -> Optional[Dict]:
+        return self.rows.get(token_id)
+
+    def save_token(
+            self,
+            token_id: int,
+            collection_name: str,
+            token: Optional[Dict],
+            ai_image_description: Optional[str]):
+        row = self.rows.get(token_id)
+        if row is None and not token:
+            # A new row needs metadata
+            return
+
+        row = dict(row) if row else {column: None for column in NFT_METADATA_COLUMNS}
+        row['network_name'] = self.network
+        row['contract_address'] = self.contract_address
+        row['token_id'] = token_id
+        if token:
+            row['collection_name'] = collection_name
+            row['token_name'] = token['name']
+            row['description'] = token['description']
+            row['image_url'] = token['image_url']
+            # As it comes back from the DB, so unchanged rows compare equal
+            row['mint_date'] = to_naive_utc(token['mint_date'])
+        if ai_image_description:
+            row['ai_image_description'] = ai_image_description
+        self._stage(token_id, row)
+
+    def update_mint_date(self, token_id: int, mint_date: Optional[datetime.datetime]):
+        row = self.rows.get(token_id)
+        if row is None:
+            return
+        row = dict(row)
+        row['mint_date'] = to_naive_utc(mint_date)
+        self._stage(token_id, row)
+
+    def _stage(self, token_id: int, row: Dict):
+        current = self.rows.get(token_id)
+        if current is not None and all(
+                current[column] == row[column] for column in NFT_METADATA_COLUMNS if column != 'updated_at'):
+            # Nothing to write, and `updated_at` stays as it is for incremental exports
+            return
+        self.rows[token_id] = row
+        self.pending[token_id] = row
+        if len(self.pending) >= self.batch_size or time.monotonic() - self.flushed_at >= self.flush_interval:
+            self.flush()
+
+    def flush(self):
+        self.flushed_at = time.monotonic()
+        if not self.pending and not any(store.pending for store in self.attached):
+            return
+        # Stamped at write time rather than when staged, so an export never misses a late commit by much
+        updated_at = utcnow()
+        for row in self.pending.values():
+            row['updated_at'] = updated_at
+        rows = [{column: row[column] for column in NFT_METADATA_COLUMNS} for row in self.pending.values()]
+        metrics = get_metrics()
+        with metrics.timer('nft_db_flush_seconds'):
+            upsert_rows(self.session, NFTMetadata.__table__, rows, NFT_METADATA_KEY)
+            for store in self.attached:
+                store.write_pending()
+            self.session.commit()
+        metrics.inc('nft_db_rows_written_total', len(rows))
+        self.pending = {}
+
+def upsert_rows(session: Session, table: Table, rows: List[Dict], key: List[str]):
+    # Inserts the rows, or updates the existing ones with the same key columns, in the session's transaction
+    if not rows:
+        return
+    dialect = session.get_bind().dialect.name
+    if dialect in ('sqlite', 'postgresql'):
+        insert = sqlite.insert if dialect == 'sqlite' else postgresql.insert
+        # Keep statements below the bound parameters limit of the database
+        chunk_size = max(1, MAX_BIND_PARAMETERS // len(rows[0]))
+        for i in range(0, len(rows), chunk_size):
+            stmt = insert(table).values(rows[i:i + chunk_size])
+            stmt = stmt.on_conflict_do_update(
+                index_elements=key,
+                set_={column: stmt.excluded[column] for column in rows[0] if column not in key}
+            )
+            session.execute(stmt)
+        return
+
+    # Other databases: update existing rows and insert the rest
+    for row in rows:
+        result = session.execute(table.update().where(
+            *(table.c[column] == row[column] for column in key)
+        ).values(**row))
+        if result.rowcount == 0:
+            session.execute(table.insert().values(**row))
+
+DEAD_LETTER_KEY = ['network_name', 'contract_address', 'token_id']
+
+class DeadLetterStore:
+    # Tokens that ran out of retries; normal runs skip them
+    def __init__(self, session: Session, network: str, contract_address: str):
+        self.session = session
+        self.network = network
+        self.contract_address = contract_address
+        # Token ID -> row values
+        self.rows: Dict[int, Dict] = {}
+        # Token ID -> row values to write, or None to delete the row; committed by NFTMetadataStore.flush()
+        self.pending: Dict[int, Optional[Dict]] = {}
+
+    def load(self, token_ids: Optional[List[int]] = None):
+        # All rows of the contract, or only the given tokens (re-read, other workers may have changed them)
+        table = DeadLetter.__table__
+        query = select(table).where(
+            table.c.network_name == self.network,
+            table.c.contract_address == self.contract_address
+        )
+        if token_ids is not None:
+            query = query.where(table.c.token_id.in_(token_ids))
+            for token_id in token_ids:
+                self.rows.pop(token_id, None)
+        else:
+            self.rows = {}
+        self.rows.update({row['token_id']: dict(row) for row in self.session.execute(query).mappings()})
+
+    def __contains__(self, token_id: int) -> bool:
+        return token_id in self.rows
+
+    def get_token_ids(self, stages: Optional[List[str]] = None) -> List[int]:
+        return sorted(token_id for token_id, row in self.rows.items() if not stages or row['stage'] in stages)
+
+    def add(self, token_id: int, stage: str, error: str, attempts: int):
+        row = {
+            'network_name': self.network,
+            'contract_address': self.contract_address,
+            'token_id': token_id,
+            'stage': stage,
+            'error': error,
+            'attempts': attempts,
+            'failed_at': utcnow(),
+        }
+        self.rows[token_id] = row
+        self.pending[token_id] = row
+        get_metrics().inc('nft_dead_letters_total', stage=stage)
+
+    def remove(self, token_id: int):
+        if self.rows.pop(token_id, None) is not None:
+            self.pending[token_id] = None
+
+    def write_pending(self):
+        # Within the transaction of the caller
+        if not self.pending:
+            return
+        table = DeadLetter.__table__
+        # Another worker may have added the token since it was loaded
+        upsert_rows(self.session, table, [row for row in self.pending.values() if row is not None], DEAD_LETTER_KEY)
+        removed = [token_id for token_id, row in self.pending.items() if row is None]
+        for i in range(0, len(removed), MAX_BIND_PARAMETERS):
+            self.session.execute(table.delete().where(
+                table.c.network_name == self.network,
+                table.c.contract_address == self.contract_address,
+                table.c.token_id.in_(removed[i:i + MAX_BIND_PARAMETERS])
+            ))
+        self.pending = {}
+
+IMAGE_HASH_KEY = ['network_name', 'contract_address', 'token_id']
+
+class ImageHashStore:
+    # Perceptual hashes of the described images of a collection, to find near-duplicates of new images
+    def __init__(
+            self,
+            session: Session,
+            network: str,
+            contract_address: str,
+            max_distance: int = 4,
+            reuse: bool = True):
+        self.session = session
+        self.network = network
+        self.contract_address = contract_address
+        self.max_distance = max_distance
+        # False: hashes are still recorded, but every token gets its own description
+        self.reuse = reuse
+        # Token ID -> hash as 16 hex digits
+        self.rows: Dict[int, str] = {}
+        # Token ID -> row values to write; committed by NFTMetadataStore.flush()
+        self.pending: Dict[int, Dict] = {}
+        self.tree = BKTree()
+
+    def load(self):
+        table = ImageHash.__table__
+        self.rows = dict(self.session.execute(select(table.c.token_id, table.c.image_hash).where(
+            table.c.network_name == self.network,
+            table.c.contract_address == self.contract_address
+        )).all())
+        self.tree = BKTree()
+        for token_id, hex_hash in self.rows.items():
+            self.tree.add(int(hex_hash, 16), (token_id, hex_hash))
+
+    def add(self, token_id: int, image_hash: int):
+        hex_hash = f'{image_hash:016x}'
+        if self.rows.get(token_id) == hex_hash:
+            return
+        self.rows[token_id] = hex_hash
+        self.pending[token_id] = {
+            'network_name': self.network,
+            'contract_address': self.contract_address,
+            'token_id': token_id,
+            'image_hash': hex_hash,
+            'updated_at': utcnow(),
+        }
+        # A changed image leaves its old hash in the tree, `find` skips it
+        self.tree.add(image_hash, (token_id, hex_hash))
+
+    def write_pending(self):
+        # Within the transaction of the caller
+        upsert_rows(self.session, ImageHash.__table__, list(self.pending.values()), IMAGE_HASH_KEY)
+        self.pending = {}
+
+    def find(self, image_hash: int) -> List[int]:
+        # Tokens with similar images, the closest first
+        if not self.reuse:
+            return []
+        return [
+            token_id for _, (token_id, hex_hash) in self.tree.find(image_hash, self.max_distance)
+            if self.rows[token_id] == hex_hash
+        ]
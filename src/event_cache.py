@@ -0,0 +1,184 @@
+import mmap
+import os
+import struct
+from array import array
+from bisect import bisect_left
+from typing import Dict, Iterable, Optional
+from hexbytes import HexBytes
+
+# magic, version, record count, last covered block
+HEADER = struct.Struct('<8sIxxxxQQ')
+MAGIC = b'NFTLOGS\0'
+VERSION = 1
+
+# Column type codes and item sizes; 8-byte columns go first to keep all of them aligned
+COLUMNS = (
+    ('block_numbers', 'Q', 8),
+    ('token_ids', 'Q', 8),
+    ('amounts', 'Q', 8),
+    ('log_indexes', 'I', 4),
+)
+TX_HASH_SIZE = 32
+MAX_VALUE = 2 ** 64 - 1
+
+def as_bytes(column) -> memoryview:
+    # `array.frombytes` only takes byte buffers
+    return memoryview(column).cast('B')
+
+class MintLogs:
+    # Mint logs of one contract in columns, sorted by (block number, log index).
+    # Columns are either arrays or memoryviews of a memory-mapped cache file.
+    def __init__(
+            self,
+            block_numbers=None,
+            token_ids=None,
+            amounts=None,
+            log_indexes=None,
+            tx_hashes=None,
+            last_block: int = -1,
+            mapping: Optional[mmap.mmap] = None):
+        self.block_numbers = block_numbers if block_numbers is not None else array('Q')
+        self.token_ids = token_ids if token_ids is not None else array('Q')
+        self.amounts = amounts if amounts is not None else array('Q')
+        self.log_indexes = log_indexes if log_indexes is not None else array('I')
+        # 32 bytes per record
+        self.tx_hashes = tx_hashes if tx_hashes is not None else bytearray()
+        self.last_block = last_block
+        self._mapping = mapping
+
+    def __len__(self) -> int:
+        return len(self.block_numbers)
+
+    def get(self, position: int) -> Dict:
+        offset = position * TX_HASH_SIZE
+        return {
+            'blockNumber': self.block_numbers[position],
+            'logIndex': self.log_indexes[position],
+            'transactionHash': '0x' + bytes(self.tx_hashes[offset:offset + TX_HASH_SIZE]).hex(),
+            'tokenId': self.token_ids[position],
+            'amount': self.amounts[position],
+        }
+
+    def before_block(self, block_number: int) -> 'MintLogs':
+        # Records are sorted by block, so this is a prefix and needs no copying
+        count = bisect_left(self.block_numbers, block_number)
+        if count == len(self):
+            return self
+        return MintLogs(
+            self.block_numbers[:count],
+            self.token_ids[:count],
+            self.amounts[:count],
+            self.log_indexes[:count],
+            self.tx_hashes[:count * TX_HASH_SIZE],
+            self.last_block,
+            self._mapping
+        )
+
+    def extend(self, other: 'MintLogs') -> 'MintLogs':
+        if not len(other):
+            return self
+        result = MintLogs()
+        for logs in (self, other):
+            for name, _, _ in COLUMNS:
+                getattr(result, name).frombytes(as_bytes(getattr(logs, name)))
+            result.tx_hashes += logs.tx_hashes
+        result.last_block = max(self.last_block, other.last_block)
+        return result
+
+    @classmethod
+    def from_logs(cls, logs: Iterable[Dict], last_block: int = -1) -> 'MintLogs':
+        # Raw `TransferSingle` receipts from the node or from the old JSON cache
+        result = cls(last_block=last_block)
+        for log in logs:
+            data = cls._to_hex(log['data'])
+            # data: id, value
+            token_id = int(data[:64], 16)
+            if token_id > MAX_VALUE:
+                # Such IDs are never reached by the sequential `nextTokenId` counter
+                continue
+            result.block_numbers.append(log['blockNumber'])
+            result.token_ids.append(token_id)
+            result.amounts.append(min(int(data[64:128] or '0', 16), MAX_VALUE))
+            result.log_indexes.append(log.get('logIndex', 0))
+            result.tx_hashes += bytes.fromhex(cls._to_hex(log.get('transactionHash', '')).rjust(64, '0'))
+        return result
+
+    @staticmethod
+    def _to_hex(value) -> str:
+        if isinstance(value, (bytes, HexBytes)):
+            return bytes(value).hex()
+        return value[2:] if value.startswith('0x') else value
+
+    def save(self, path: str):
+        tmp_path = f'{path}.{os.getpid()}.tmp'
+        with open(tmp_path, 'wb') as f:
+            f.write(HEADER.pack(MAGIC, VERSION, len(self), max(self.last_block, 0)))
+            for name, _, _ in COLUMNS:
+                f.write(getattr(self, name))
+            f.write(self.tx_hashes)
+        # The old mapping may point to the file being replaced
+        self.close()
+        os.replace(tmp_path, path)
+
+    @classmethod
+    def load(cls, path: str) -> 'MintLogs':
+        with open(path, 'rb') as f:
+            header = f.read(HEADER.size)
+            if len(header) < HEADER.size:
+                raise ValueError(f'Truncated event log cache: {path}')
+            magic, version, count, last_block = HEADER.unpack(header)
+            if magic != MAGIC or version != VERSION:
+                raise ValueError(f'Unknown event log cache format: {path}')
+            if count == 0:
+                return cls(last_block=last_block)
+            mapping = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+        expected_size = HEADER.size + count * (sum(size for _, _, size in COLUMNS) + TX_HASH_SIZE)
+        if len(mapping) != expected_size:
+            mapping.close()
+            raise ValueError(f'Corrupted event log cache: {path}')
+
+        view = memoryview(mapping)
+        columns = {}
+        offset = HEADER.size
+        for name, type_code, size in COLUMNS:
+            columns[name] = view[offset:offset + count * size].cast(type_code)
+            offset += count * size
+        columns['tx_hashes'] = view[offset:offset + count * TX_HASH_SIZE]
+        return cls(**columns, last_block=last_block, mapping=mapping)
+
+    def close(self):
+        if self._mapping is None:
+            return
+        for name in ('block_numbers', 'token_ids', 'amounts', 'log_indexes', 'tx_hashes'):
+            column = getattr(self, name)
+            if isinstance(column, memoryview):
+                # Copied, so the object stays usable once the file is unmapped
+                if column.format == 'B':
+                    copy = bytearray(column)
+                else:
+                    copy = array(column.format)
+                    copy.frombytes(as_bytes(column))
+                setattr(self, name, copy)
+        try:
+            self._mapping.close()
+        except BufferError:
+            # Other objects still look into it, the mapping goes away with them
+            pass
+        self._mapping = None
+
+    def update_last_block(self, path: str, last_block: int):
+        # Nothing new was found: only the covered block range changes, rewritten in place
+        self.last_block = last_block
+        with open(path, 'r+b') as f:
+            f.write(HEADER.pack(MAGIC, VERSION, len(self), last_block))
+
+def build_first_mint_index(logs: MintLogs, index: Optional[Dict[int, int]] = None) -> Dict[int, int]:
+    # Token ID -> position of its very first mint. Positions follow the mint order,
+    # so the reversed pairs leave the earliest position of each token in the dict.
+    first_positions = dict(zip(reversed(logs.token_ids), reversed(range(len(logs)))))
+    if index is None:
+        return first_positions
+    for token_id, position in first_positions.items():
+        index.setdefault(token_id, position)
+    return index
@@ -0,0 +1,80 @@
+import datetime
+from sqlalchemy.orm import Session
+from typing import Callable, List, Optional
+
+from src.db import FollowCheckpoint, NFTMetadataStore
+from src.log import log
+from src.nft import NFTMetadataFetcher
+from src.planner import WorkPlanner
+from src.retry import RetryQueue
+
+class ContractFollower:
+    # Tails one contract after the catch-up run: new mint logs and new token IDs
+    def __init__(
+            self,
+            session: Session,
+            planner: WorkPlanner,
+            nft_fetcher: NFTMetadataFetcher,
+            store: NFTMetadataStore,
+            process_tokens: Callable[[List[int]], None],
+            retry_queue: Optional[RetryQueue] = None):
+        self.session = session
+        self.planner = planner
+        self.nft_fetcher = nft_fetcher
+        self.store = store
+        self.process_tokens = process_tokens
+        # The failed tokens `process_tokens` retries on the later polls
+        self.retry_queue = retry_queue
+
+        self.checkpoint = self.session.query(FollowCheckpoint).filter(
+            FollowCheckpoint.network_name == nft_fetcher.network,
+            FollowCheckpoint.contract_address == nft_fetcher.contract_address
+        ).one_or_none()
+        if self.checkpoint is None:
+            self.checkpoint = FollowCheckpoint(network_name=nft_fetcher.network,
+                                               contract_address=nft_fetcher.contract_address)
+            self.session.add(self.checkpoint)
+        # Everything the catch-up run has seen is done, except the blocks without enough confirmations yet
+        self.checkpoint.last_block = max(self.checkpoint.last_block or -1,
+                                         nft_fetcher.event_logs.last_block - nft_fetcher.confirmations)
+        self.checkpoint.next_token_id = max(self.checkpoint.next_token_id or 0, nft_fetcher.next_token_id)
+        self._save_checkpoint()
+
+    def poll(self) -> int:
+        # Returns the number of new tokens. A failed poll leaves the checkpoint as it was,
+        # the next one fetches the same blocks again and replaces their logs.
+        log.set_params(network=self.nft_fetcher.network, contract_address=self.nft_fetcher.contract_address)
+        web3 = self.nft_fetcher.web3
+        to_block = web3.eth.block_number - self.nft_fetcher.confirmations
+
+        first_minted = []
+        if to_block > self.checkpoint.last_block:
+            first_minted = self.nft_fetcher.follow_event_logs(self.checkpoint.last_block + 1, to_block)
+
+        next_token_id = self.nft_fetcher.contract.functions.nextTokenId().call()
+        new_token_ids = list(range(self.checkpoint.next_token_id, next_token_id))
+        if new_token_ids:
+            self.nft_fetcher.next_token_id = next_token_id
+            self.planner.save_state(self.nft_fetcher.network, self.nft_fetcher.contract_address,
+                                    self.nft_fetcher.collection_name, next_token_id)
+            log.set_params(token_last_id=next_token_id - 1)
+            print(f'`{self.nft_fetcher.network}` {self.nft_fetcher.contract_address}: '
+                  f'{len(new_token_ids)} new tokens')
+        if new_token_ids or (self.retry_queue is not None and self.retry_queue.is_due()):
+            self.process_tokens(new_token_ids)
+
+        # Tokens created before their first mint were saved without a mint date
+        for token_id in first_minted:
+            row = self.store.get(token_id)
+            if token_id < self.checkpoint.next_token_id and row and row['mint_date'] is None:
+                self.store.update_mint_date(token_id, self.nft_fetcher.get_mint_date(token_id))
+        self.store.flush()
+
+        self.checkpoint.last_block = max(self.checkpoint.last_block, to_block)
+        self.checkpoint.next_token_id = max(self.checkpoint.next_token_id, next_token_id)
+        self._save_checkpoint()
+        return len(new_token_ids)
+
+    def _save_checkpoint(self):
+        self.checkpoint.updated_at = datetime.datetime.now(datetime.timezone.utc)
+        self.session.commit()
@@ -0,0 +1,172 @@
+import threading
+import time
+import requests
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED, Future
+from requests.adapters import HTTPAdapter
+from typing import Dict, List, Optional
+from urllib.parse import urlsplit
+
+from src.config import get_app_config
+from src.metrics import get_metrics
+
+DEFAULT_GATEWAYS = ['https://ipfs.io/ipfs/']
+
+# These answers say nothing about the content, another gateway may do better
+RETRY_STATUSES = {408, 429, 500, 502, 503, 504}
+
+class GatewayClient:
+    def __init__(
+            self,
+            gateways: List[str],
+            hedge_delay: float = 1.0,
+            timeout: float = 30,
+            pool_size: int = 32,
+            max_callers: int = 32):
+        self.gateways = [gateway.rstrip('/') + '/' for gateway in gateways]
+        self.hedge_delay = hedge_delay
+        self.timeout = timeout
+        self.pool_size = pool_size
+
+        self._lock = threading.Lock()
+        self._sessions: Dict[str, requests.Session] = {}
+        # Moving averages per gateway; unknown gateways are ranked in the configured order
+        self._latency = {gateway: hedge_delay for gateway in self.gateways}
+        self._error_rate = {gateway: 0.0 for gateway in self.gateways}
+        # Every caller may have a request in flight at every gateway. A smaller pool would queue the primary
+        # requests, the queueing would count towards the hedge delay and fire even more hedges into the same pool.
+        # Threads are only started when needed
+        self._executor = ThreadPoolExecutor(max_workers=max_callers * len(self.gateways))
+
+    def to_http(self, url: str) -> str:
+        path = self.get_ipfs_path(url)
+        if path is None:
+            return url
+        return self.gateways[0] + path
+
+    @staticmethod
+    def get_ipfs_path(url: str) -> Optional[str]:
+        if url.startswith('ipfs://'):
+            path = url[len('ipfs://'):]
+            return path[len('ipfs/'):] if path.startswith('ipfs/') else path
+        if '/ipfs/' in url:
+            return url.split('/ipfs/', 1)[1]
+        return None
+
+    def get(self, url: str, stream: bool = False, headers: Optional[Dict] = None) -> requests.Response:
+        path = self.get_ipfs_path(url)
+        if path is None:
+            return self._get_session(url).get(url, stream=stream, headers=headers, timeout=self.timeout)
+        return self._hedged_get(path, stream, headers)
+
+    def _hedged_get(self, path: str, stream: bool, headers: Optional[Dict]) -> requests.Response:
+        candidates = self._rank_gateways()
+        running: Dict[Future, str] = {}
+        last_error: Optional[Exception] = None
+        last_response: Optional[requests.Response] = None
+
+        def start_next():
+            gateway = candidates.pop(0)
+            running[self._executor.submit(self._request, gateway, path, stream, headers)] = gateway
+
+        start_next()
+        while running:
+            # Fire a hedged request if the fastest gateway is slow to answer
+            timeout = self.hedge_delay if candidates else None
+            done, _ = wait(running, timeout=timeout, return_when=FIRST_COMPLETED)
+            if not done:
+                get_metrics().inc('nft_gateway_hedged_requests_total')
+                start_next()
+                continue
+
+            for future in done:
+                running.pop(future)
+                try:
+                    response = future.result()
+                except requests.RequestException as e:
+                    last_error = e
+                    continue
+                if response.status_code in RETRY_STATUSES:
+                    response.close()
+                    last_response = response
+                    continue
+
+                # The rest are not needed anymore
+                for other in running:
+                    other.add_done_callback(self._close_response)
+                return response
+
+            if not running and candidates:
+                start_next()
+
+        if last_response is not None:
+            return last_response
+        raise last_error
+
+    def _request(self, gateway: str, path: str, stream: bool, headers: Optional[Dict]) -> requests.Response:
+        url = gateway + path
+        metrics = get_metrics()
+        name = urlsplit(gateway).netloc
+        started_at = time.monotonic()
+        try:
+            response = self._get_session(url).get(url, stream=stream, headers=headers, timeout=self.timeout)
+        except requests.RequestException:
+            self._record(gateway, time.monotonic() - started_at, failed=True)
+            metrics.inc('nft_gateway_errors_total', gateway=name)
+            raise
+        latency = time.monotonic() - started_at
+        failed = response.status_code in RETRY_STATUSES
+        self._record(gateway, latency, failed=failed)
+        # Until the headers; the body of a streamed image is read later
+        metrics.observe('nft_gateway_request_seconds', latency, gateway=name)
+        if failed:
+            metrics.inc('nft_gateway_errors_total', gateway=name)
+        return response
+
+    def _record(self, gateway: str, latency: float, failed: bool, alpha: float = 0.2):
+        with self._lock:
+            self._latency[gateway] += alpha * (latency - self._latency[gateway])
+            self._error_rate[gateway] += alpha * ((1.0 if failed else 0.0) - self._error_rate[gateway])
+
+    def _rank_gateways(self) -> List[str]:
+        with self._lock:
+            return sorted(
+                self.gateways,
+                key=lambda gateway: self._latency[gateway] * (1 + 4 * self._error_rate[gateway])
+            )
+
+    def _get_session(self, url: str) -> requests.Session:
+        # One keep-alive connection pool per host
+        host = urlsplit(url).netloc
+        with self._lock:
+            session = self._sessions.get(host)
+            if session is None:
+                session = requests.Session()
+                adapter = HTTPAdapter(pool_connections=1, pool_maxsize=self.pool_size)
+                session.mount('http://', adapter)
+                session.mount('https://', adapter)
+                self._sessions[host] = session
+            return session
+
+    @staticmethod
+    def _close_response(future: Future):
+        if not future.exception():
+            future.result().close()
+
+_client: Optional[GatewayClient] = None
+_client_lock = threading.Lock()
+
+def get_gateway_client() -> GatewayClient:
+    global _client
+    with _client_lock:
+        if _client is None:
+            config = get_app_config()
+            ipfs = config.ipfs
+            _client = GatewayClient(
+                ipfs.get('gateways', DEFAULT_GATEWAYS),
+                hedge_delay=ipfs.get('hedge_delay', 1.0),
+                timeout=ipfs.get('timeout', 30),
+                pool_size=ipfs.get('pool_size', 32),
+                # Metadata and image threads of the pipeline, the most concurrent callers
+                max_callers=config.pipeline.get('metadata_workers', 32) + config.pipeline.get('image_workers', 16)
+            )
+        return _client
@@ -1,55 +1,180 @@
-import time
+import math
 
+import openai
 from openai import OpenAI
-from typing import Dict
+from typing import Dict, List, Optional
 
+from src.ai_cache import get_description_cache
 from src.config import get_app_config
 from src.log import log
+from src.metrics import get_metrics
+from src.ratelimit import TokenBucket, parse_duration
+from src.retry import CircuitOpenError, get_circuit_breaker
+
+# Errors worth retrying; the others (bad request, auth, etc.) won't go away by themselves
+RETRYABLE_ERRORS = (
+    openai.RateLimitError,
+    openai.APIConnectionError,
+    openai.APITimeoutError,
+    openai.InternalServerError,
+    openai.ConflictError,
+)
 
 class OpenAIImageToText:
     def __init__(self, api_key: str, model: str):
-        self.client = OpenAI(api_key=api_key)
+        config = get_app_config()
+
+        # Failed requests are retried by the retry queue, which reschedules the token instead of waiting here
+        self.client = OpenAI(api_key=api_key, base_url=config.openai.get('base_url'), max_retries=0)
         self.model = model
 
-        config = get_app_config()
         self.min_len = config.openai.get('description_min_len', 100)
         self.max_attempts = config.openai.get('max_attempts', 5)
-        self.timeout = config.openai.get('error_timeout', 10)
+        self.image_resolution = config.openai.get('image_resolution', [512, 512])
+        self.cache = get_description_cache()
+        self.breaker = get_circuit_breaker('openai')
+
+        # Shared by all threads that use this client
+        self.requests_per_minute = config.openai.get('requests_per_minute', 500)
+        self.tokens_per_minute = config.openai.get('tokens_per_minute', 200_000)
+        self.requests_bucket = TokenBucket(self.requests_per_minute)
+        self.tokens_bucket = TokenBucket(self.tokens_per_minute)
 
     def get_text_from_image(self, image_base64: str, image_type: str, prompt: str) -> Dict:
+        cache_key = None
+        if self.cache:
+            cache_key = self.cache.make_key(image_base64, prompt, self.model)
+            text = self.cache.get(cache_key)
+            if text is not None:
+                get_metrics().inc('nft_openai_cache_hits_total')
+                log.print('Using a cached description')
+                return {
+                    'response': text
+                }
+
+        messages = self.build_messages(image_base64, image_type, prompt)
+        estimated_tokens = self._estimate_tokens(prompt)
         attempt_num = self.max_attempts
+        metrics = get_metrics()
         while True:
             try:
-                response = self.client.chat.completions.create(
-                    model=self.model,
-                    messages=[
-                        {
-                            'role': 'user',
-                            'content': [
-                                {'type': 'text', 'text': prompt},
-                                {
-                                    'type': 'image_url',
-                                    'image_url': {'url': f'data:{image_type};base64,{image_base64}'}
-                                }
-                            ]
-                        }
-                ])
-                text = response.choices[0].message.content
-                if len(text) < self.min_len:
-                    if attempt_num > 0:
-                        attempt_num -= 1
-                        log.print(f'Got a text length of {len(text)} characters')
-                        log.print(f'Trying again. Attempts left: {attempt_num}')
-                        continue
-                    else:
-                        return {
-                            'error': 'Text is too short'
-                        }
-                
+                self.breaker.check()
+            except CircuitOpenError as e:
                 return {
-                    'response': text
+                    'error': str(e),
+                    'transient': True
+                }
+            self.requests_bucket.acquire()
+            self.tokens_bucket.acquire(estimated_tokens)
+            try:
+                with metrics.timer('nft_openai_request_seconds', model=self.model):
+                    raw_response = self.client.chat.completions.with_raw_response.create(
+                        model=self.model,
+                        messages=messages
+                    )
+            except RETRYABLE_ERRORS as e:
+                self.breaker.record_failure()
+                metrics.inc('nft_openai_retries_total', error=type(e).__name__)
+                self._apply_retry_after(e)
+                return {
+                    'error': str(e),
+                    'transient': True
                 }
-            except Exception as e:
-                log.print(f'OpenAI API Error: {e}')
-                log.print(f'Try again in {self.timeout} seconds')
-                time.sleep(self.timeout)
\ No newline at end of file
+            except openai.OpenAIError as e:
+                self.breaker.record_success()
+                return {
+                    'error': str(e)
+                }
+
+            self.breaker.record_success()
+            response = raw_response.parse()
+            self._update_limits(raw_response.headers, response, estimated_tokens)
+
+            text = response.choices[0].message.content or ''
+            if len(text) < self.min_len:
+                if attempt_num > 0:
+                    attempt_num -= 1
+                    log.print(f'Got a text length of {len(text)} characters')
+                    log.print(f'Trying again. Attempts left: {attempt_num}')
+                    continue
+                else:
+                    return {
+                        'error': 'Text is too short'
+                    }
+
+            if cache_key:
+                self.cache.put(cache_key, text)
+            return {
+                'response': text
+            }
+
+    @staticmethod
+    def build_messages(image_base64: str, image_type: str, prompt: str) -> List[Dict]:
+        return [
+            {
+                'role': 'user',
+                'content': [
+                    {'type': 'text', 'text': prompt},
+                    {
+                        'type': 'image_url',
+                        'image_url': {'url': f'data:{image_type};base64,{image_base64}'}
+                    }
+                ]
+            }
+        ]
+
+    def _estimate_tokens(self, prompt: str) -> int:
+        # A rough estimate: ~4 characters per text token, 170 tokens per 512px image tile
+        # plus the base 85, and room for the answer
+        width, height = self.image_resolution
+        image_tokens = 85 + 170 * math.ceil(width / 512) * math.ceil(height / 512)
+        return len(prompt) // 4 + image_tokens + 300
+
+    def _apply_retry_after(self, error: Exception):
+        response = getattr(error, 'response', None)
+        if response is None:
+            return
+        self._update_rates(response.headers)
+        retry_after_ms = parse_duration(response.headers.get('retry-after-ms'))
+        if retry_after_ms is not None:
+            retry_after = retry_after_ms / 1000
+        else:
+            retry_after = parse_duration(response.headers.get('retry-after'))
+        if retry_after is not None:
+            # Everybody waits, including the token once the retry queue brings it back
+            self.requests_bucket.pause(retry_after)
+            self.tokens_bucket.pause(retry_after)
+
+    def _update_limits(self, headers, response, estimated_tokens: int):
+        usage = getattr(response, 'usage', None)
+        if usage and usage.total_tokens:
+            self.tokens_bucket.consume(usage.total_tokens - estimated_tokens)
+        self._update_rates(headers)
+
+        for bucket, kind in ((self.requests_bucket, 'requests'), (self.tokens_bucket, 'tokens')):
+            remaining = self._parse_number(headers.get(f'x-ratelimit-remaining-{kind}'))
+            if remaining is None:
+                continue
+            bucket.limit_remaining(remaining)
+            if remaining <= 0:
+                reset = parse_duration(headers.get(f'x-ratelimit-reset-{kind}'))
+                if reset:
+                    bucket.pause(reset)
+
+    def _update_rates(self, headers):
+        # The account limits announced by the API, when they are lower than the configured ones
+        for bucket, kind, configured in ((self.requests_bucket, 'requests', self.requests_per_minute),
+                                         (self.tokens_bucket, 'tokens', self.tokens_per_minute)):
+            limit = self._parse_number(headers.get(f'x-ratelimit-limit-{kind}'))
+            if limit is None or limit <= 0:
+                continue
+            rate = min(limit, configured)
+            if rate != bucket.rate * 60:
+                bucket.set_rate(rate)
+
+    @staticmethod
+    def _parse_number(value: Optional[str]) -> Optional[float]:
+        try:
+            return float(value) if value is not None else None
+        except ValueError:
+            return None
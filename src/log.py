@@ -1,15 +1,36 @@
-from typing import Optional
+from contextvars import ContextVar
+from typing import Optional, Dict
 
 class Log:
     def __init__(self, overwrite_width: int = 80, address_chars_num: int = 4):
-        self.network = 'N/A'
-        self.contract_address = 'N/A'
-        self.token_id = 0
-        self.token_last_id = 0
+        # Kept in a context variable so that concurrently processed tokens
+        # (asyncio tasks and the threads they start) don't mix up their parameters
+        self._params: ContextVar[Dict] = ContextVar('log_params', default={
+            'network': 'N/A',
+            'contract_address': 'N/A',
+            'token_id': 0,
+            'token_last_id': 0,
+        })
 
         self.overwrite_width = overwrite_width
         self.address_chars_num = address_chars_num
 
+    @property
+    def network(self) -> str:
+        return self._params.get()['network']
+
+    @property
+    def contract_address(self) -> str:
+        return self._params.get()['contract_address']
+
+    @property
+    def token_id(self) -> int:
+        return self._params.get()['token_id']
+
+    @property
+    def token_last_id(self) -> int:
+        return self._params.get()['token_last_id']
+
     def format_address(self, address: str) -> str:
         if address.startswith('0x'):
             address = address[2:]
@@ -17,21 +38,23 @@ class Log:
             return address
         result = address[:self.address_chars_num] + '…' + address[-self.address_chars_num:]
         return result
-    
+
     def set_params(
             self,
             network: Optional[str] = None,
             contract_address: Optional[str] = None,
             token_id: Optional[int] = None,
             token_last_id: Optional[int] = None):
+        params = dict(self._params.get())
         if network:
-            self.network = network
+            params['network'] = network
         if contract_address:
-            self.contract_address = contract_address
+            params['contract_address'] = contract_address
         if token_id:
-            self.token_id = token_id
+            params['token_id'] = token_id
         if token_last_id:
-            self.token_last_id = token_last_id
+            params['token_last_id'] = token_last_id
+        self._params.set(params)
 
     def print(
             self,
@@ -41,7 +64,7 @@ class Log:
             token_id: Optional[int] = None,
             token_last_id: Optional[int] = None,
             overwrite: bool = False):
-        
+
         if not network:
             network = self.network
         if not contract_address:
@@ -51,8 +74,8 @@ class Log:
         if not token_last_id:
             token_last_id = self.token_last_id
 
-        output = '[' + self.network + ' ' + self.format_address(self.contract_address) + \
-            ' NFT ' + str(self.token_id) + '/' + str(self.token_last_id) + '] ' + msg
+        output = '[' + network + ' ' + self.format_address(contract_address) + \
+            ' NFT ' + str(token_id) + '/' + str(token_last_id) + '] ' + msg
         if overwrite:
             if len(output) < self.overwrite_width:
                 output += ' ' * (self.overwrite_width - len(output))
@@ -60,4 +83,4 @@ class Log:
         else:
             print(output)
 
-log = Log()
\ No newline at end of file
+log = Log()
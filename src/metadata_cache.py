@@ -0,0 +1,111 @@
+import atexit
+import os
+import sqlite3
+import threading
+import time
+import zlib
+from typing import Dict, Optional
+
+from src.config import get_app_config
+
+# Hits whose `used_at` is updated with a single statement
+TOUCH_BATCH_SIZE = 500
+
+class MetadataCache:
+    def __init__(self, path: str, max_bytes: int = 0):
+        self.max_bytes = max_bytes
+        self._lock = threading.Lock()
+        # Key -> time of the last hit, written with the next put or once there are enough of them
+        self._touched: Dict[str, float] = {}
+
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        self.conn = sqlite3.connect(path, check_same_thread=False)
+        self.conn.execute('''
+            CREATE TABLE IF NOT EXISTS metadata (
+                key TEXT PRIMARY KEY,
+                content BLOB NOT NULL,
+                size INTEGER NOT NULL,
+                etag TEXT,
+                last_modified TEXT,
+                used_at REAL NOT NULL
+            )
+        ''')
+        self.conn.execute('CREATE INDEX IF NOT EXISTS metadata_used_at ON metadata (used_at)')
+        self.conn.commit()
+        self.total_size = self.conn.execute('SELECT COALESCE(SUM(size), 0) FROM metadata').fetchone()[0]
+
+    def get(self, key: str) -> Optional[Dict]:
+        with self._lock:
+            row = self.conn.execute(
+                'SELECT content, etag, last_modified FROM metadata WHERE key = ?', (key,)
+            ).fetchone()
+            if row is None:
+                return None
+            self._touched[key] = time.time()
+            if len(self._touched) >= TOUCH_BATCH_SIZE:
+                self._write_touched()
+                self.conn.commit()
+        content, etag, last_modified = row
+        return {
+            'content': zlib.decompress(content),
+            'etag': etag,
+            'last_modified': last_modified,
+        }
+
+    def put(self, key: str, content: bytes, etag: Optional[str] = None, last_modified: Optional[str] = None):
+        compressed = zlib.compress(content)
+        with self._lock:
+            self._touched.pop(key, None)
+            # Eviction goes by `used_at`, so the hits are written first
+            self._write_touched()
+            old = self.conn.execute('SELECT size FROM metadata WHERE key = ?', (key,)).fetchone()
+            if old:
+                self.total_size -= old[0]
+            self.total_size += len(compressed)
+            self.conn.execute(
+                'INSERT OR REPLACE INTO metadata (key, content, size, etag, last_modified, used_at) '
+                'VALUES (?, ?, ?, ?, ?, ?)',
+                (key, compressed, len(compressed), etag, last_modified, time.time())
+            )
+            if self.max_bytes and self.total_size > self.max_bytes:
+                self._evict()
+            self.conn.commit()
+
+    def flush(self):
+        with self._lock:
+            if self._touched:
+                self._write_touched()
+                self.conn.commit()
+
+    def _write_touched(self):
+        if self._touched:
+            self.conn.executemany('UPDATE metadata SET used_at = ? WHERE key = ?',
+                                  [(used_at, key) for key, used_at in self._touched.items()])
+            self._touched.clear()
+
+    def _evict(self):
+        # Drop the least recently used entries until the store fits
+        keys = []
+        for key, size in self.conn.execute('SELECT key, size FROM metadata ORDER BY used_at'):
+            if self.total_size <= self.max_bytes:
+                break
+            keys.append((key,))
+            self.total_size -= size
+        self.conn.executemany('DELETE FROM metadata WHERE key = ?', keys)
+
+_cache: Optional[MetadataCache] = None
+_cache_lock = threading.Lock()
+
+def get_metadata_cache() -> Optional[MetadataCache]:
+    global _cache
+    config = get_app_config()
+    path = config.paths.get('cache', {}).get('metadata')
+    if not path:
+        return None
+    with _cache_lock:
+        if _cache is None:
+            _cache = MetadataCache(path, max_bytes=config.ipfs.get('metadata_cache_max_bytes', 0))
+            atexit.register(_cache.flush)
+        return _cache
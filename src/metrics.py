@@ -0,0 +1,336 @@
+import atexit
+import bisect
+import datetime
+import json
+import os
+import threading
+import time
+from collections import deque
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Callable, Dict, Iterator, Optional, Tuple
+
+from src.config import get_app_config
+from src.log import log
+
+# Seconds, from a fast RPC call to a slow OpenAI answer
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 120.0)
+
+LabelKey = Tuple[Tuple[str, str], ...]
+
+def _escape(value) -> str:
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+class Histogram:
+    def __init__(self, buckets: Tuple[float, ...]):
+        self.buckets = buckets
+        # The last one is +Inf
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value: float):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+class Progress:
+    # Throughput over a sliding window and the time left for the planned tokens
+    def __init__(self, window: float = 60):
+        self.window = window
+        self.planned = 0
+        self.done = 0
+        self.started_at = time.monotonic()
+        self._finished_at: deque = deque()
+        self._lock = threading.Lock()
+
+    def plan(self, count: int):
+        with self._lock:
+            self.planned += count
+
+    def advance(self, count: int = 1):
+        now = time.monotonic()
+        with self._lock:
+            self.done += count
+            self._finished_at.extend([now] * count)
+
+    def get_rate(self) -> float:
+        # Tokens per second
+        now = time.monotonic()
+        with self._lock:
+            while self._finished_at and self._finished_at[0] < now - self.window:
+                self._finished_at.popleft()
+            span = min(self.window, now - self.started_at)
+            return len(self._finished_at) / span if span > 0 else 0.0
+
+    def get_eta(self) -> Optional[float]:
+        rate = self.get_rate()
+        left = self.planned - self.done
+        if left <= 0:
+            return 0.0
+        return left / rate if rate > 0 else None
+
+    def format(self) -> str:
+        eta = self.get_eta()
+        eta_text = str(datetime.timedelta(seconds=round(eta))) if eta is not None else 'unknown'
+        total = f'/{self.planned}' if self.planned else ''
+        return f'Progress: {self.done}{total} tokens, {self.get_rate():.2f} tokens/s, ETA {eta_text}'
+
+class Metrics:
+    # Counters, histograms and gauges in the Prometheus text format; every call is a no-op when disabled
+    def __init__(self, enabled: bool = True, trace_path: Optional[str] = None):
+        self.enabled = enabled
+        self.counters: Dict[str, Dict[LabelKey, float]] = {}
+        self.histograms: Dict[str, Dict[LabelKey, Histogram]] = {}
+        # Sampled at export time, e.g. queue sizes
+        self.gauges: Dict[str, Dict[LabelKey, Callable[[], float]]] = {}
+        self.progress = Progress()
+        self._lock = threading.Lock()
+
+        self._trace = None
+        if enabled and trace_path:
+            os.makedirs(os.path.dirname(trace_path) or '.', exist_ok=True)
+            self._trace = open(trace_path, 'a', encoding='utf-8')
+
+    def inc(self, name: str, amount: float = 1, **labels: str):
+        if not self.enabled:
+            return
+        key = tuple(sorted(labels.items()))
+        with self._lock:
+            series = self.counters.setdefault(name, {})
+            series[key] = series.get(key, 0) + amount
+
+    def observe(self, name: str, seconds: float, **labels: str):
+        if not self.enabled:
+            return
+        key = tuple(sorted(labels.items()))
+        with self._lock:
+            series = self.histograms.setdefault(name, {})
+            histogram = series.get(key)
+            if histogram is None:
+                histogram = series[key] = Histogram(DEFAULT_BUCKETS)
+            histogram.observe(seconds)
+
+    def set_gauge(self, name: str, callback: Callable[[], float], **labels: str):
+        if not self.enabled:
+            return
+        with self._lock:
+            self.gauges.setdefault(name, {})[tuple(sorted(labels.items()))] = callback
+
+    def remove_gauge(self, name: str, **labels: str):
+        with self._lock:
+            self.gauges.get(name, {}).pop(tuple(sorted(labels.items())), None)
+
+    def finish_token(self, status: str = 'done'):
+        # The token reached its final state in this run: processed or moved to the dead letters
+        if not self.enabled:
+            return
+        self.progress.advance()
+        self.inc('nft_tokens_processed_total', status=status)
+
+    @contextmanager
+    def timer(self, name: str, **labels: str) -> Iterator[None]:
+        # A histogram of the block duration, an error counter and a trace line
+        if not self.enabled:
+            yield
+            return
+        started_at = time.perf_counter()
+        error = None
+        try:
+            yield
+        except BaseException as e:
+            error = type(e).__name__
+            raise
+        finally:
+            seconds = time.perf_counter() - started_at
+            self.observe(name, seconds, **labels)
+            if error:
+                self.inc('nft_errors_total', operation=name, error=error)
+            if self._trace:
+                self.trace(name, seconds, error, **labels)
+
+    def trace(self, span: str, seconds: float, error: Optional[str] = None, **labels: str):
+        # One JSON line per span, tagged with the token being processed in this context
+        if not self._trace:
+            return
+        line = json.dumps({
+            'time': datetime.datetime.now(datetime.timezone.utc).isoformat(),
+            'network': log.network,
+            'contract_address': log.contract_address,
+            'token_id': log.token_id,
+            'span': span,
+            'seconds': round(seconds, 6),
+            'error': error,
+            **labels,
+        })
+        with self._lock:
+            self._trace.write(line + '\n')
+
+    def render(self) -> str:
+        lines = []
+        with self._lock:
+            counters = {name: dict(series) for name, series in self.counters.items()}
+            histograms = {
+                name: {key: (list(h.counts), h.sum, h.count) for key, h in series.items()}
+                for name, series in self.histograms.items()
+            }
+            gauges = {name: dict(series) for name, series in self.gauges.items()}
+
+        for name, series in sorted(counters.items()):
+            lines.append(f'# TYPE {name} counter')
+            lines.extend(f'{name}{self._format_labels(key)} {value}' for key, value in sorted(series.items()))
+
+        for name, series in sorted(histograms.items()):
+            lines.append(f'# TYPE {name} histogram')
+            for key, (counts, total, count) in sorted(series.items()):
+                cumulative = 0
+                for bound, bucket_count in zip(DEFAULT_BUCKETS + (float('inf'),), counts):
+                    cumulative += bucket_count
+                    le = '+Inf' if bound == float('inf') else repr(bound)
+                    lines.append(f'{name}_bucket{self._format_labels(key, le=le)} {cumulative}')
+                lines.append(f'{name}_sum{self._format_labels(key)} {total}')
+                lines.append(f'{name}_count{self._format_labels(key)} {count}')
+
+        gauges['nft_tokens_per_second'] = {(): self.progress.get_rate}
+        gauges['nft_tokens_planned'] = {(): lambda: self.progress.planned}
+        eta = self.progress.get_eta()
+        if eta is not None:
+            gauges['nft_eta_seconds'] = {(): lambda: eta}
+        for name, series in sorted(gauges.items()):
+            if not series:
+                continue
+            lines.append(f'# TYPE {name} gauge')
+            for key, callback in sorted(series.items()):
+                try:
+                    value = callback()
+                except Exception:
+                    continue
+                lines.append(f'{name}{self._format_labels(key)} {value}')
+        return '\n'.join(lines) + '\n'
+
+    @staticmethod
+    def _format_labels(key: LabelKey, **extra: str) -> str:
+        pairs = list(key) + list(extra.items())
+        if not pairs:
+            return ''
+        return '{' + ','.join(f'{name}="{_escape(value)}"' for name, value in pairs) + '}'
+
+    def flush(self):
+        if self._trace:
+            with self._lock:
+                self._trace.flush()
+
+    def close(self):
+        if self._trace:
+            with self._lock:
+                self._trace.close()
+                self._trace = None
+
+class MetricsExporter:
+    # Writes the metrics to a file for the node_exporter textfile collector and/or serves them over HTTP
+    def __init__(
+            self,
+            metrics: Metrics,
+            textfile: Optional[str] = None,
+            port: Optional[int] = None,
+            interval: float = 15,
+            report_interval: float = 60):
+        self.metrics = metrics
+        self.textfile = textfile
+        self.port = port
+        self.interval = interval
+        self.report_interval = report_interval
+        self.server: Optional[ThreadingHTTPServer] = None
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+
+    def start(self):
+        if self.port:
+            metrics = self.metrics
+
+            class Handler(BaseHTTPRequestHandler):
+                def do_GET(self):
+                    if self.path.split('?')[0] != '/metrics':
+                        self.send_error(404)
+                        return
+                    content = metrics.render().encode()
+                    self.send_response(200)
+                    self.send_header('Content-Type', 'text/plain; version=0.0.4')
+                    self.send_header('Content-Length', str(len(content)))
+                    self.end_headers()
+                    self.wfile.write(content)
+
+                def log_message(self, format, *args):
+                    pass
+
+            self.server = ThreadingHTTPServer(('0.0.0.0', self.port), Handler)
+            self.server.daemon_threads = True
+            threading.Thread(target=self.server.serve_forever, daemon=True).start()
+            print(f'Serving the metrics on http://localhost:{self.port}/metrics')
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        self._thread.join()
+        if self.server:
+            self.server.shutdown()
+        self.export()
+
+    def export(self):
+        self.metrics.flush()
+        if not self.textfile:
+            return
+        os.makedirs(os.path.dirname(self.textfile) or '.', exist_ok=True)
+        tmp_path = f'{self.textfile}.{os.getpid()}.tmp'
+        with open(tmp_path, 'w') as f:
+            f.write(self.metrics.render())
+        # The collector never sees a half-written file
+        os.replace(tmp_path, self.textfile)
+
+    def _run(self):
+        reported_at = time.monotonic()
+        while not self._stop.wait(self.interval):
+            try:
+                self.export()
+            except Exception as e:
+                print(f'Failed to export the metrics: {e}')
+            if self.report_interval and time.monotonic() - reported_at >= self.report_interval:
+                reported_at = time.monotonic()
+                if self.metrics.progress.done:
+                    print(self.metrics.progress.format())
+
+_metrics: Optional[Metrics] = None
+_metrics_lock = threading.Lock()
+_exporter: Optional[MetricsExporter] = None
+
+def get_metrics() -> Metrics:
+    global _metrics
+    if _metrics is None:
+        with _metrics_lock:
+            if _metrics is None:
+                config = get_app_config().metrics
+                _metrics = Metrics(enabled=config.get('enabled', True), trace_path=config.get('trace'))
+    return _metrics
+
+def start_metrics_exporter() -> Optional[MetricsExporter]:
+    global _exporter
+    metrics = get_metrics()
+    if not metrics.enabled or _exporter is not None:
+        return _exporter
+    config = get_app_config().metrics
+    _exporter = MetricsExporter(
+        metrics,
+        textfile=config.get('textfile'),
+        port=config.get('port'),
+        interval=config.get('interval', 15),
+        report_interval=config.get('report_interval', 60)
+    )
+    _exporter.start()
+    # The last values are written on exit, also after an error
+    atexit.register(_stop_exporter)
+    return _exporter
+
+def _stop_exporter():
+    if _exporter is not None:
+        _exporter.stop()
+    get_metrics().close()
@@ -1,16 +1,23 @@
 from web3 import Web3
-import requests
 import datetime
 import json
 import os
-import time
-from typing import List, Dict, Optional
+import threading
+from typing import List, Dict, Iterable, Optional, Union
 from web3.types import LogReceipt
-from web3.datastructures import AttributeDict
+from web3.contract import Contract
 from hexbytes import HexBytes
 
-from src.config import get_env_settings, get_app_config
+from src.abi import MULTICALL3_ADDRESS, MULTICALL3_ABI
+from src.blocks import BlockTimestampCache, get_block_timestamp_cache
+from src.config import get_app_config
+from src.event_cache import MintLogs, build_first_mint_index
+from src.gateway import get_gateway_client
+from src.metadata_cache import get_metadata_cache
 from src.log import log
+from src.retry import get_circuit_breaker, get_upstream_name
+from src.rpc import get_rpc_provider
+from src.scanner import LogScanner
 
 class NFTMetadataFetcher:
     def __init__(
@@ -21,38 +28,33 @@ class NFTMetadataFetcher:
             mint_event_signature: str,
             first_id: int = 1,
             from_block: int = 0,
-            use_cache: bool = True):
-        networks = {
-            'ethereum': f'https://mainnet.infura.io/v3',
-            'zora': f'https://lb.drpc.org/ogrpc?network=zora&dkey=',
-        }
-        if network not in networks:
-            raise ValueError(f'Unsupported network: {network}')
-        
-        env = get_env_settings()
-        
-        provider = networks[network].rstrip('/')
-        if network == 'ethereum':
-            provider += f'/{env.infura_api_key}'
-        else:
-            provider += env.drpc_api_key
-        
-        self.web3 = Web3(Web3.HTTPProvider(provider))
-        if not self.web3.is_connected():
-            raise ConnectionError('Failed to connect to the blockchain network.')
-        
+            confirmations: int = 12,
+            use_cache: bool = True,
+            collection_name: Optional[str] = None,
+            next_token_id: Optional[int] = None):
+        self.web3 = Web3(get_rpc_provider(network))
         self.contract = self.web3.eth.contract(address=self.web3.to_checksum_address(contract_address), abi=abi)
-        
-        try:
-            self.collection_name = self.contract.functions.name().call()
-        except Exception as e:
-            raise RuntimeError(f'Failed to fetch collection name: {e}')
-        
-        try:
-            self.next_token_id = self.contract.functions.nextTokenId().call()
-        except Exception as e:
-            raise RuntimeError(f'Failed to fetch nextTokenId: {e}')
-        
+
+        # Known values come from the DB, so the contract is not asked again
+        self.collection_name = collection_name
+        self.next_token_id = next_token_id
+        if collection_name is None or next_token_id is None:
+            if not self.web3.is_connected():
+                raise ConnectionError('Failed to connect to the blockchain network.')
+
+            try:
+                self.collection_name = self.contract.functions.name().call()
+            except Exception as e:
+                raise RuntimeError(f'Failed to fetch collection name: {e}')
+
+            try:
+                self.next_token_id = self.contract.functions.nextTokenId().call()
+            except Exception as e:
+                raise RuntimeError(f'Failed to fetch nextTokenId: {e}')
+
+        # Created with the event logs, only needed for mint dates
+        self.block_timestamps: Optional[BlockTimestampCache] = None
+
         self.current_token_id = first_id
 
         self.network = network
@@ -60,10 +62,18 @@ class NFTMetadataFetcher:
         self.event_signature = mint_event_signature
         self.first_id = first_id
         self.from_block = from_block
+        self.confirmations = confirmations
         self.use_cache = use_cache
-        self.event_logs: Optional[List[Dict]] = None
+        self.event_logs: Optional[MintLogs] = None
+        self.token_uris: Dict[int, Optional[str]] = {}
+        self._uri_lock = threading.Lock()
+        # None: not checked yet, False: not deployed
+        self.multicall: Union[Contract, bool, None] = None
+        # Token ID -> position of its very first mint in `event_logs`
+        self.mint_index: Dict[int, int] = {}
 
         self.app_config = get_app_config()
+        self.uri_batch_size = self.app_config.general.get('uri_batch_size', 300)
 
     def __iter__(self):
         self.current_token_id = self.first_id
@@ -83,126 +93,277 @@ class NFTMetadataFetcher:
         if not self.event_logs:
             raise RuntimeError(f'Event logs are empty.')
         
-        while True:
-            try:
-                token_uri = self.contract.functions.uri(token_id).call()
-                metadata = self._fetch_ipfs_metadata(token_uri)
-                mint_date = self._get_mint_date(token_id)
-            
-                return {
-                    'token_id': token_id,
-                    'name': metadata.get('name', 'N/A'),
-                    'description': metadata.get('description', 'N/A'),
-                    'image_url': self._convert_ipfs_to_http(metadata.get('image', 'N/A')),
-                    'mint_date': mint_date,
-                }
-            except Exception as e:
-                log.print(f'NFT metadata retrieval error: {e}')
-                timeout = self.app_config.general.get('fetch_metadata_timeout', 60)
-                log.print(f'Try again in {timeout} seconds')
-                time.sleep(timeout)
-        
+        # One attempt: failed tokens are retried by the caller while others go on
+        rpc = get_circuit_breaker(f'rpc:{self.network}')
+        token_uri = rpc.call(self.get_token_uri, token_id)
+        metadata = get_circuit_breaker(get_upstream_name(token_uri)).call(self._fetch_ipfs_metadata, token_uri)
+        mint_date = rpc.call(self.get_mint_date, token_id)
+
+        return {
+            'token_id': token_id,
+            'name': metadata.get('name', 'N/A'),
+            'description': metadata.get('description', 'N/A'),
+            'image_url': self._convert_ipfs_to_http(metadata.get('image', 'N/A')),
+            'mint_date': mint_date,
+        }
+
+    def get_token_uri(self, token_id: int) -> str:
+        with self._uri_lock:
+            if token_id not in self.token_uris:
+                # Read the URIs of the following tokens in the same request
+                last_id = min(token_id + self.uri_batch_size, self.next_token_id)
+                self.token_uris.update(self.fetch_token_uris(range(token_id, last_id)))
+            token_uri = self.token_uris.pop(token_id, None)
+
+        if token_uri is None:
+            token_uri = self.contract.functions.uri(token_id).call()
+        return token_uri
+
+    def fetch_token_uris(self, token_ids: Iterable[int]) -> Dict[int, Optional[str]]:
+        token_ids = list(token_ids)
+        uris = {}
+        for i in range(0, len(token_ids), self.uri_batch_size):
+            chunk = token_ids[i:i + self.uri_batch_size]
+            call_data = [self.contract.encode_abi('uri', args=[token_id]) for token_id in chunk]
+            results = None
+            if self._get_multicall() is not None:
+                try:
+                    results = self._multicall_uris(call_data)
+                except Exception as e:
+                    # E.g. the node's gas or response limits; separate calls in a batch don't hit them
+                    print(f'Multicall3 failed, using a JSON-RPC batch: {e}')
+            if results is None:
+                results = self._batch_call_uris(call_data)
+            uris.update(zip(chunk, results))
+        return uris
+
+    def _get_multicall(self) -> Optional[Contract]:
+        if self.multicall is None:
+            chain_config = self.app_config.blockchains.get(self.network, {})
+            address = self.web3.to_checksum_address(chain_config.get('multicall_address', MULTICALL3_ADDRESS))
+            if self.web3.eth.get_code(address):
+                self.multicall = self.web3.eth.contract(address=address, abi=MULTICALL3_ABI)
+            else:
+                print(f'Multicall3 is not deployed at {address}, using JSON-RPC batches')
+                self.multicall = False
+        return self.multicall or None
+
+    def _multicall_uris(self, call_data: List[str]) -> List[Optional[str]]:
+        calls = [(self.contract.address, True, data) for data in call_data]
+        results = self._get_multicall().functions.aggregate3(calls).call()
+        return [self._decode_uri(return_data) if success else None for success, return_data in results]
+
+    def _batch_call_uris(self, call_data: List[str]) -> List[Optional[str]]:
+        responses = self.web3.provider.make_batch_request([
+            ('eth_call', [{'to': self.contract.address, 'data': data}, 'latest']) for data in call_data
+        ])
+        if not isinstance(responses, list):
+            raise RuntimeError(f'Batch eth_call failed: {responses.get("error")}')
+        return [
+            self._decode_uri(HexBytes(response['result'])) if response.get('result') else None
+            for response in responses
+        ]
+
+    def _decode_uri(self, return_data: bytes) -> Optional[str]:
+        try:
+            return self.web3.codec.decode(['string'], return_data)[0]
+        except Exception:
+            return None
+
     def fetch_event_logs(self):
         if self.event_logs:
             return
-        
-        if self.use_cache:
-            cache_fname = self._get_cache_fname()
-            if os.path.exists(cache_fname):
-                print(f'Loading event logs from the cache: {cache_fname}')
-                self.event_logs =  self._load_from_cache()
-                return
 
         start_block = self.from_block
+        cached_logs = MintLogs()
+        if self.use_cache:
+            cached_logs = self._load_from_cache()
+            cached_count = len(cached_logs)
+            if cached_logs.last_block >= 0:
+                # Re-fetch the trailing blocks in case of a chain reorganization
+                start_block = max(self.from_block, cached_logs.last_block - self.confirmations + 1)
+                cached_logs = cached_logs.before_block(start_block)
+
         latest_block = self.web3.eth.block_number
-        all_logs = []
-        
+        new_logs = MintLogs()
+        if start_block <= latest_block:
+            if start_block > self.from_block:
+                print(f'Getting the logs of the mint events from block #{start_block}')
+            else:
+                print('Getting the logs of the mint events. This could take a while…')
+            new_logs = MintLogs.from_logs(self._get_logs(start_block, latest_block))
+            print(f'Received {len(new_logs)} records')
+
+        all_logs = cached_logs.extend(new_logs)
+        if len(all_logs) == 0:
+            raise RuntimeError('No logs were found for the mint event')
+
+        if self.use_cache:
+            # Without new or dropped records only the covered block range has to be updated
+            self._save_to_cache(all_logs, latest_block, changed=len(all_logs) != cached_count or len(new_logs) > 0)
+            print(f'The logs have been saved to the cache: {self._get_cache_fname()}')
+
+        self.event_logs = all_logs
+        # Also without the cache: the follow mode and the workers go on from here
+        self.event_logs.last_block = latest_block
+        self.mint_index = build_first_mint_index(all_logs)
+        self.block_timestamps = get_block_timestamp_cache(self.web3, self.network)
+        self._prefetch_mint_timestamps()
+
+    def _get_logs(self, from_block: int, to_block: int) -> List[LogReceipt]:
         event_signature_hash_bytes32 = '0x' + self.web3.keccak(text=self.event_signature).hex()
         zero_address_bytes32 = '0x' + '0' * 64
 
-        print('Getting the logs of the mint events. This could take a while…')
-
-        while True:
-            logs = self.web3.eth.get_logs({
-                'fromBlock': start_block,
-                'toBlock': latest_block,
+        general = self.app_config.general
+        scanner = LogScanner(
+            self.web3,
+            {
                 'address': self.contract_address,
                 # signature, operator, from, to
                 'topics': [event_signature_hash_bytes32, None, zero_address_bytes32, None]
-            })
-            if len(logs) == 0:
-                break
-            all_logs.extend(logs)
-            start_block = logs[-1]['blockNumber'] + 1
-            if start_block > latest_block:
-                break
-
-        if len(all_logs) > 0:
-            print(f'Received {len(all_logs)} records')
-            if self.use_cache:
-                self._save_to_cache(all_logs)
-                print(f'The logs have been saved to the cache: {self._get_cache_fname()}')
-
-            self.event_logs = all_logs
-            return
-        else:
-            raise RuntimeError('No logs were found for the mint event')
-        
-    def _get_mint_date(self, token_id: int) -> Optional[datetime.datetime]:
-        for log in self.event_logs:
-            data = log['data']
-            if isinstance(data, HexBytes):
-                data = data.hex()
-            data_token_id = int(data[:64], 16)
-            if token_id != data_token_id:
-                continue
-
-            block = self.web3.eth.get_block(log['blockNumber'])
-            timestamp = block['timestamp']
-            mint_date = datetime.datetime.fromtimestamp(timestamp, datetime.timezone.utc)
-            return mint_date
-        return None
-        
-    def _get_cache_fname(self) -> str:
+            },
+            workers=general.get('logs_workers', 4),
+            window_size=general.get('logs_window_size', 10_000),
+            max_window_size=general.get('logs_max_window_size', 1_000_000),
+        )
+        return scanner.scan(from_block, to_block)
+
+    def get_mint_date(self, token_id: int) -> Optional[datetime.datetime]:
+        mint_log = self.get_mint_log(token_id)
+        if mint_log is None:
+            return None
+
+        timestamp = self.block_timestamps.get(mint_log['blockNumber'])
+        if timestamp is None:
+            return None
+        mint_date = datetime.datetime.fromtimestamp(timestamp, datetime.timezone.utc)
+        return mint_date
+
+    def get_mint_log(self, token_id: int) -> Optional[Dict]:
+        position = self.mint_index.get(token_id)
+        if position is None:
+            return None
+        return self.event_logs.get(position)
+
+    def append_event_logs(self, logs: List[Dict], from_block: Optional[int] = None) -> List[int]:
+        # Returns the tokens minted for the first time by these logs.
+        # The logs already kept from `from_block` on are replaced, so the same blocks can be fetched again.
+        new_logs = MintLogs.from_logs(logs)
+        if self.event_logs is None:
+            self.event_logs = MintLogs()
+        if self.block_timestamps is None:
+            self.block_timestamps = get_block_timestamp_cache(self.web3, self.network)
+        kept_logs = self.event_logs if from_block is None else self.event_logs.before_block(from_block)
+        mint_index = {token_id: position for token_id, position in self.mint_index.items()
+                      if position < len(kept_logs)}
+        first_mints = {token_id: position for token_id, position in build_first_mint_index(new_logs).items()
+                       if token_id not in mint_index}
+        # Before anything changes: after a failure the logs are as they were
+        self.block_timestamps.fetch_missing(new_logs.block_numbers[position] for position in first_mints.values())
+
+        offset = len(kept_logs)
+        self.event_logs = kept_logs.extend(new_logs)
+        for token_id, position in first_mints.items():
+            mint_index[token_id] = offset + position
+        self.mint_index = mint_index
+        return sorted(first_mints)
+
+    def follow_event_logs(self, from_block: int, to_block: int) -> List[int]:
+        # The cache file is not rewritten: the next full load fetches the blocks after it
+        first_minted = self.append_event_logs(self._get_logs(from_block, to_block), from_block)
+        self.event_logs.last_block = to_block
+        return first_minted
+
+    def refresh_event_logs(self) -> List[int]:
+        # Catches up with the chain after `fetch_event_logs`, for tokens minted since then
+        latest_block = self.web3.eth.block_number
+        if latest_block <= self.event_logs.last_block:
+            return []
+        return self.follow_event_logs(self.event_logs.last_block + 1, latest_block)
+
+    def _prefetch_mint_timestamps(self):
+        block_numbers = self.event_logs.block_numbers
+        # Only a speed-up: the mint dates of a failed batch are fetched per token, under the retry policy
+        self.block_timestamps.fetch_missing((block_numbers[position] for position in self.mint_index.values()),
+                                            skip_failed=True)
+
+    def _get_cache_fname(self, extension: str = 'bin') -> str:
         cache_dir = self.app_config.paths['cache']['event_logs']
         os.makedirs(cache_dir, exist_ok=True)
-        cache_fname = os.path.join(cache_dir, f'{self.network}_{self.contract_address}.json')
+        cache_fname = os.path.join(cache_dir, f'{self.network}_{self.contract_address}.{extension}')
         return cache_fname
-        
-    def _save_to_cache(self, logs: List[LogReceipt]):
-        with open(self._get_cache_fname(), 'w') as f:
-            serializable_logs = [self._to_serializable(log) for log in logs]
-            json.dump(serializable_logs, f)
-
-    def _load_from_cache(self) -> List[Dict]:
-        with open(self._get_cache_fname(), 'r') as f:
-            return json.load(f)
-    
-    def _to_serializable(self, value):
-        if isinstance(value, AttributeDict):
-            return {key: self._to_serializable(val) for key, val in value.items()}
-        elif isinstance(value, HexBytes):
-            return value.hex()
-        elif isinstance(value, list):
-            return [self._to_serializable(item) for item in value]
+
+    def _save_to_cache(self, logs: MintLogs, last_block: int, changed: bool = True):
+        cache_fname = self._get_cache_fname()
+        if not changed and os.path.exists(cache_fname):
+            logs.update_last_block(cache_fname, last_block)
+            return
+        logs.last_block = last_block
+        logs.save(cache_fname)
+
+    def _load_from_cache(self) -> MintLogs:
+        cache_fname = self._get_cache_fname()
+        if os.path.exists(cache_fname):
+            print(f'Loading event logs from the cache: {cache_fname}')
+            try:
+                return MintLogs.load(cache_fname)
+            except ValueError as e:
+                print(f'{e}, the logs will be fetched again')
+                return MintLogs()
+
+        json_fname = self._get_cache_fname('json')
+        if os.path.exists(json_fname):
+            return self._migrate_json_cache(json_fname, cache_fname)
+        return MintLogs()
+
+    def _migrate_json_cache(self, json_fname: str, cache_fname: str) -> MintLogs:
+        print(f'Converting the event log cache to the new format: {json_fname}')
+        with open(json_fname, 'r') as f:
+            data = json.load(f)
+        if isinstance(data, list):
+            # Oldest format: a bare list of logs without the covered block range
+            last_block = max((log['blockNumber'] for log in data), default=self.from_block - 1)
+            logs = MintLogs.from_logs(data, last_block)
         else:
-            return value
+            logs = MintLogs.from_logs(data['logs'], data['last_block'])
+        logs.save(cache_fname)
+        os.remove(json_fname)
+        return logs
 
     @staticmethod
     def _fetch_ipfs_metadata(ipfs_url) -> Dict:
-        if ipfs_url.startswith('ipfs://'):
-            ipfs_url = ipfs_url.replace('ipfs://', 'https://ipfs.io/ipfs/')
-        
-        response = requests.get(ipfs_url)
+        client = get_gateway_client()
+        cache = get_metadata_cache()
+
+        # IPFS content never changes, other URLs are revalidated
+        ipfs_path = client.get_ipfs_path(ipfs_url)
+        cache_key = f'ipfs:{ipfs_path}' if ipfs_path is not None else ipfs_url
+        cached = cache.get(cache_key) if cache else None
+        if cached and ipfs_path is not None:
+            return json.loads(cached['content'])
+
+        headers = {}
+        if cached:
+            if cached['etag']:
+                headers['If-None-Match'] = cached['etag']
+            if cached['last_modified']:
+                headers['If-Modified-Since'] = cached['last_modified']
+
+        response = client.get(ipfs_url, headers=headers)
+        if response.status_code == 304 and cached:
+            return json.loads(cached['content'])
         if response.status_code == 410:
             log.print(f'This URI no longer contains any data: {ipfs_url}')
             return {}
         response.raise_for_status()
-        
-        return response.json()
+
+        metadata = response.json()
+        if cache:
+            cache.put(cache_key, response.content,
+                      etag=response.headers.get('ETag'),
+                      last_modified=response.headers.get('Last-Modified'))
+        return metadata
 
     @staticmethod
     def _convert_ipfs_to_http(ipfs_url):
-        if ipfs_url.startswith('ipfs://'):
-            return ipfs_url.replace('ipfs://', 'https://ipfs.io/ipfs/')
-        return ipfs_url
\ No newline at end of file
+        return get_gateway_client().to_http(ipfs_url)
\ No newline at end of file
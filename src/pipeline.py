@@ -0,0 +1,212 @@
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, Iterable, Optional
+
+from src.config import get_app_config
+from src.db import NFTMetadataStore, DeadLetterStore, ImageHashStore
+from src.gpt import OpenAIImageToText
+from src.log import log
+from src.metrics import get_metrics
+from src.nft import NFTMetadataFetcher
+from src.retry import RetryQueue, TransientError, PermanentError, get_retry_policy
+from src.utils import download_image, get_duplicate_description, get_token_tasks
+
+class TokenPipeline:
+    def __init__(
+            self,
+            store: NFTMetadataStore,
+            nft_fetcher: NFTMetadataFetcher,
+            gpt: OpenAIImageToText,
+            dead_letters: DeadLetterStore,
+            image_hashes: ImageHashStore,
+            retry_queue: Optional[RetryQueue] = None):
+        self.store = store
+        self.nft_fetcher = nft_fetcher
+        self.gpt = gpt
+        self.dead_letters = dead_letters
+        self.image_hashes = image_hashes
+        self.retry_policy = get_retry_policy()
+        # Given: failed tokens wait there for a later run instead of keeping this one going
+        self.retry_queue = retry_queue
+
+        self.config = get_app_config()
+        self.metadata_workers = self.config.pipeline.get('metadata_workers', 32)
+        self.image_workers = self.config.pipeline.get('image_workers', 16)
+        self.gpt_workers = self.config.pipeline.get('gpt_workers', 4)
+        self.queue_size = self.config.pipeline.get('queue_size', 64)
+        self.description_min_len = self.config.openai.get('description_min_len', 100)
+        self.metrics = get_metrics()
+
+    def run(self, token_ids: Iterable[int]):
+        asyncio.run(self._run(token_ids))
+
+    async def _run(self, token_ids: Iterable[int]):
+        # Blocking calls run in threads, enough of them for every stage worker
+        asyncio.get_running_loop().set_default_executor(
+            ThreadPoolExecutor(max_workers=self.metadata_workers + self.image_workers + self.gpt_workers)
+        )
+
+        # Bounded queues keep memory flat: a stage waits while the next one is busy
+        self.metadata_queue = asyncio.Queue(self.queue_size)
+        self.image_queue = asyncio.Queue(self.queue_size)
+        self.gpt_queue = asyncio.Queue(self.queue_size)
+        self.db_queue = asyncio.Queue(self.queue_size)
+
+        # Failed jobs waiting for their next attempt
+        self.retry_tasks = set()
+
+        stages = [
+            (self.metadata_queue, self._fetch_metadata, 'metadata', self.metadata_workers),
+            (self.image_queue, self._download_image, 'image', self.image_workers),
+            (self.gpt_queue, self._describe_image, 'description', self.gpt_workers),
+            # The DB session is not thread-safe, so there is a single writer
+            (self.db_queue, self._save, None, 1),
+        ]
+        workers = [
+            asyncio.create_task(self._worker(queue, handler, stage))
+            for queue, handler, stage, workers_num in stages
+            for _ in range(workers_num)
+        ]
+        for queue, _, stage, _ in stages:
+            self.metrics.set_gauge('nft_pipeline_queue_size', queue.qsize, stage=stage or 'db')
+        self.metrics.set_gauge('nft_pipeline_waiting_retries', lambda: len(self.retry_tasks))
+
+        if self.retry_queue is None:
+            jobs = ((token_id, 1) for token_id in token_ids)
+        else:
+            jobs = self.retry_queue.iterate(token_ids, wait=False)
+        for token_id, attempt in jobs:
+            job = self._plan(token_id, attempt)
+            if job:
+                await self.metadata_queue.put(job)
+
+        while True:
+            for queue, _, _, _ in stages:
+                await queue.join()
+            if not self.retry_tasks:
+                break
+            await asyncio.wait(self.retry_tasks)
+        for worker in workers:
+            worker.cancel()
+        await asyncio.gather(*workers, return_exceptions=True)
+        for _, _, stage, _ in stages:
+            self.metrics.remove_gauge('nft_pipeline_queue_size', stage=stage or 'db')
+        self.metrics.remove_gauge('nft_pipeline_waiting_retries')
+
+    def _plan(self, token_id: int, attempt: int = 1) -> Optional[Dict]:
+        log.set_params(token_id=token_id)
+        nft_row = self.store.get(token_id)
+
+        fetch_metadata, generate_description = get_token_tasks(nft_row, self.description_min_len)
+        if not fetch_metadata and not generate_description:
+            log.print('Skipping')
+            self.metrics.finish_token('skipped')
+            return None
+
+        return {
+            'token_id': token_id,
+            'fetch_metadata': fetch_metadata,
+            'generate_description': generate_description,
+            'token': None,
+            'image_url': nft_row['image_url'] if nft_row else None,
+            'ai_desc': None,
+            'image_hash': None,
+            'attempt': attempt,
+        }
+
+    async def _worker(self, queue: asyncio.Queue, handler, stage: Optional[str]):
+        while True:
+            job = await queue.get()
+            try:
+                log.set_params(token_id=job['token_id'])
+                await handler(job)
+            except Exception as e:
+                if stage is None:
+                    log.print(f'Token processing error: {e}')
+                else:
+                    self._fail(job, stage, e)
+            finally:
+                queue.task_done()
+
+    def _fail(self, job: Dict, stage: str, error: Exception):
+        # Whatever was done before the failure is kept, the retry goes on from there
+        self.store.save_token(job['token_id'], self.nft_fetcher.collection_name, job['token'], job['ai_desc'])
+
+        if self.retry_queue is None:
+            delay = self.retry_policy.next_delay(error, job['attempt'])
+        else:
+            delay = self.retry_queue.schedule(job['token_id'], job['attempt'], error)
+        if delay is None:
+            log.print(f"Can't get the {stage}: {error}. Moving to the dead letters")
+            self.dead_letters.add(job['token_id'], stage, str(error), job['attempt'])
+            self.metrics.finish_token('failed')
+            return
+
+        log.print(f"Can't get the {stage}: {error}. Try again in {delay:.0f} seconds")
+        if self.retry_queue is not None:
+            return
+        task = asyncio.create_task(self._retry_later(job['token_id'], job['attempt'] + 1, delay))
+        self.retry_tasks.add(task)
+        task.add_done_callback(self.retry_tasks.discard)
+
+    async def _retry_later(self, token_id: int, attempt: int, delay: float):
+        # Other tokens keep going while this one waits
+        await asyncio.sleep(delay)
+        job = self._plan(token_id, attempt)
+        if job:
+            await self.metadata_queue.put(job)
+
+    async def _fetch_metadata(self, job: Dict):
+        if job['fetch_metadata']:
+            log.print('Getting NFT metadata')
+            with self.metrics.timer('nft_token_stage_seconds', stage='metadata'):
+                token = await asyncio.to_thread(self.nft_fetcher.fetch_metadata_for_token, job['token_id'])
+            job['token'] = token
+            job['image_url'] = token['image_url']
+
+        if job['generate_description'] and job['image_url']:
+            await self.image_queue.put(job)
+        else:
+            await self.db_queue.put(job)
+
+    async def _download_image(self, job: Dict):
+        with self.metrics.timer('nft_token_stage_seconds', stage='image'):
+            job['image_base64'], job['image_type'], job['image_hash'] = await asyncio.to_thread(
+                download_image,
+                job['image_url'],
+                self.config.paths.get('nft_images_dir'),
+                self.config.openai.get('image_resolution', [512, 512])
+            )
+        await self.gpt_queue.put(job)
+
+    async def _describe_image(self, job: Dict):
+        if job['image_hash'] is not None:
+            duplicate = get_duplicate_description(self.store, self.image_hashes, job['token_id'],
+                                                  job['image_hash'], self.description_min_len)
+            if duplicate:
+                log.print(f'Using the description of the similar token #{duplicate[0]}')
+                self.metrics.inc('nft_near_duplicate_descriptions_total')
+                del job['image_base64']
+                job['ai_desc'] = duplicate[1]
+                await self.db_queue.put(job)
+                return
+
+        log.print(f'Generating a description via `{self.config.openai["model"]}` model')
+        with self.metrics.timer('nft_token_stage_seconds', stage='description'):
+            gpt_resp = await asyncio.to_thread(
+                self.gpt.get_text_from_image, job['image_base64'], job['image_type'], self.config.openai['prompt']
+            )
+        # The image is not needed anymore
+        del job['image_base64']
+        if 'error' in gpt_resp:
+            error_class = TransientError if gpt_resp.get('transient') else PermanentError
+            raise error_class(f'OpenAI API Error: {gpt_resp["error"]}')
+        job['ai_desc'] = gpt_resp['response']
+        await self.db_queue.put(job)
+
+    async def _save(self, job: Dict):
+        self.store.save_token(job['token_id'], self.nft_fetcher.collection_name, job['token'], job['ai_desc'])
+        self.dead_letters.remove(job['token_id'])
+        if job['ai_desc'] and job['image_hash'] is not None:
+            self.image_hashes.add(job['token_id'], job['image_hash'])
+        self.metrics.finish_token()
@@ -0,0 +1,100 @@
+import datetime
+from sqlalchemy import func, or_, select
+from sqlalchemy.orm import Session
+from typing import Dict, Iterable, List, Optional
+
+from src.db import NFTMetadata, ContractState
+
+class ContractPlan:
+    def __init__(
+            self,
+            needs_metadata: List[int],
+            needs_description: List[int],
+            complete: int):
+        self.needs_metadata = needs_metadata
+        self.needs_description = needs_description
+        self.complete = complete
+
+    @property
+    def token_ids(self) -> List[int]:
+        return sorted(self.needs_metadata + self.needs_description)
+
+    def __bool__(self) -> bool:
+        return bool(self.needs_metadata or self.needs_description)
+
+class WorkPlanner:
+    # Decides what has to be done for a contract from the DB alone, before any network call
+    def __init__(self, session: Session, description_min_len: int, state_ttl: float):
+        self.session = session
+        self.description_min_len = description_min_len
+        self.state_ttl = state_ttl
+        # (network, contract address) -> state
+        self.states: Dict[tuple, ContractState] = {}
+
+    def load_states(self):
+        self.states = {
+            (state.network_name, state.contract_address): state
+            for state in self.session.query(ContractState)
+        }
+
+    def get_state(self, network: str, contract_address: str) -> Optional[ContractState]:
+        # None when the contract has to be asked again
+        state = self.states.get((network, contract_address))
+        if state is None or state.checked_at is None:
+            return None
+        checked_at = state.checked_at
+        if checked_at.tzinfo is None:
+            checked_at = checked_at.replace(tzinfo=datetime.timezone.utc)
+        age = datetime.datetime.now(datetime.timezone.utc) - checked_at
+        if age.total_seconds() > self.state_ttl:
+            return None
+        return state
+
+    def save_state(
+            self,
+            network: str,
+            contract_address: str,
+            collection_name: str,
+            next_token_id: int) -> ContractState:
+        state = self.states.get((network, contract_address))
+        if state is None:
+            state = ContractState(network_name=network, contract_address=contract_address)
+            self.session.add(state)
+            self.states[(network, contract_address)] = state
+        state.collection_name = collection_name
+        state.next_token_id = next_token_id
+        state.checked_at = datetime.datetime.now(datetime.timezone.utc)
+        self.session.commit()
+        return state
+
+    def plan(
+            self,
+            network: str,
+            contract_address: str,
+            token_ids: Iterable[int],
+            describe: bool = True) -> ContractPlan:
+        # The same rules as `get_token_tasks`, evaluated by the database
+        table = NFTMetadata.__table__
+        missing_metadata = or_(*(
+            func.coalesce(table.c[column], '') == ''
+            for column in ('collection_name', 'token_name', 'description', 'image_url')
+        ))
+        missing_description = func.coalesce(func.length(table.c.ai_image_description), 0) < self.description_min_len
+        result = self.session.execute(select(table.c.token_id, missing_metadata, missing_description).where(
+            table.c.network_name == network,
+            table.c.contract_address == contract_address
+        ))
+        rows = {token_id: (bool(metadata), bool(description)) for token_id, metadata, description in result}
+
+        needs_metadata = []
+        needs_description = []
+        complete = 0
+        for token_id in token_ids:
+            fetch_metadata, generate_description = rows.get(token_id, (True, True))
+            if fetch_metadata:
+                needs_metadata.append(token_id)
+            elif generate_description and describe:
+                needs_description.append(token_id)
+            else:
+                complete += 1
+        return ContractPlan(needs_metadata, needs_description, complete)
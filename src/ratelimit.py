@@ -0,0 +1,79 @@
+import re
+import threading
+import time
+from typing import Optional
+
+class TokenBucket:
+    def __init__(self, rate_per_minute: float, burst_seconds: float = 10):
+        self.rate = rate_per_minute / 60
+        self.burst_seconds = burst_seconds
+        self.capacity = max(1.0, self.rate * burst_seconds)
+        self.tokens = self.capacity
+        self.updated_at = time.monotonic()
+        self.paused_until = 0.0
+        self._lock = threading.Lock()
+
+    def acquire(self, amount: float = 1):
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                self._refill(now)
+                wait = self.paused_until - now
+                if wait <= 0:
+                    # Requests bigger than the bucket wait for a full bucket and go into debt
+                    needed = min(amount, self.capacity)
+                    if self.tokens >= needed:
+                        self.tokens -= amount
+                        return
+                    wait = (needed - self.tokens) / self.rate
+            time.sleep(wait)
+
+    def try_acquire(self, amount: float = 1) -> bool:
+        with self._lock:
+            now = time.monotonic()
+            self._refill(now)
+            if self.paused_until > now or self.tokens < amount:
+                return False
+            self.tokens -= amount
+            return True
+
+    def consume(self, amount: float):
+        with self._lock:
+            self._refill(time.monotonic())
+            self.tokens = min(self.capacity, self.tokens - amount)
+
+    def limit_remaining(self, remaining: float):
+        with self._lock:
+            self._refill(time.monotonic())
+            self.tokens = min(self.tokens, remaining)
+
+    def set_rate(self, rate_per_minute: float):
+        with self._lock:
+            self._refill(time.monotonic())
+            self.rate = rate_per_minute / 60
+            self.capacity = max(1.0, self.rate * self.burst_seconds)
+            self.tokens = min(self.tokens, self.capacity)
+
+    def pause(self, seconds: float):
+        with self._lock:
+            self.paused_until = max(self.paused_until, time.monotonic() + seconds)
+
+    def _refill(self, now: float):
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated_at) * self.rate)
+        self.updated_at = now
+
+DURATION_RE = re.compile(r'(\d+(?:\.\d+)?)(ms|h|m|s)')
+DURATION_UNITS = {'h': 3600, 'm': 60, 's': 1, 'ms': 0.001}
+
+def parse_duration(value: Optional[str]) -> Optional[float]:
+    # Formats: "20", "1.5", "20ms", "6m0s", "1h2m3.5s"
+    if not value:
+        return None
+    try:
+        return float(value)
+    except ValueError:
+        pass
+    parts = DURATION_RE.findall(value)
+    if not parts:
+        return None
+    return sum(float(number) * DURATION_UNITS[unit] for number, unit in parts)
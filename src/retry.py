@@ -0,0 +1,193 @@
+import heapq
+import itertools
+import random
+import threading
+import time
+import requests
+from typing import Any, Callable, Dict, Iterable, Iterator, List, Optional, Tuple
+from urllib.parse import urlsplit
+
+from src.config import get_app_config
+from src.gateway import GatewayClient, RETRY_STATUSES
+from src.metrics import get_metrics
+
+TRANSIENT = 'transient'
+PERMANENT = 'permanent'
+
+class TransientError(Exception):
+    pass
+
+class PermanentError(Exception):
+    pass
+
+class CircuitOpenError(TransientError):
+    def __init__(self, upstream: str, retry_after: float):
+        super().__init__(f'`{upstream}` is failing, calls are paused for {retry_after:.0f} seconds')
+        self.upstream = upstream
+        self.retry_after = retry_after
+
+class StageError(Exception):
+    # A token failed at one of its processing stages: metadata, image or description
+    def __init__(self, stage: str, error: Exception):
+        super().__init__(f'{stage}: {error}')
+        self.stage = stage
+        self.error = error
+
+def classify_error(error: Exception) -> str:
+    if isinstance(error, StageError):
+        return classify_error(error.error)
+    if isinstance(error, TransientError):
+        return TRANSIENT
+    if isinstance(error, PermanentError):
+        return PERMANENT
+    if isinstance(error, requests.HTTPError) and error.response is not None:
+        # 404, 403, 400 and alike won't change by themselves
+        return TRANSIENT if error.response.status_code in RETRY_STATUSES else PERMANENT
+    if isinstance(error, (requests.ConnectionError, requests.Timeout)):
+        return TRANSIENT
+    # Broken JSON or images, reverted contract calls.
+    # web3 is imported here: it takes a second, and runs that find no work never load it
+    from web3.exceptions import ContractLogicError
+    if isinstance(error, (ValueError, KeyError, TypeError, ContractLogicError)):
+        return PERMANENT
+    return TRANSIENT
+
+def get_upstream_name(url: str) -> str:
+    if GatewayClient.get_ipfs_path(url) is not None:
+        # Gateways are balanced by the gateway client, so IPFS is a single upstream here
+        return 'ipfs'
+    return urlsplit(url).netloc or url
+
+class RetryPolicy:
+    def __init__(self, max_attempts: int = 5, base_delay: float = 10, max_delay: float = 600):
+        self.max_attempts = max_attempts
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+
+    def get_delay(self, attempt: int) -> float:
+        # Exponential backoff with full jitter
+        return random.uniform(0, min(self.max_delay, self.base_delay * 2 ** (attempt - 1)))
+
+    def next_delay(self, error: Exception, attempt: int) -> Optional[float]:
+        # None: give up on this item
+        if classify_error(error) == PERMANENT or attempt >= self.max_attempts:
+            return None
+        get_metrics().inc('nft_retries_total', stage=error.stage if isinstance(error, StageError) else 'unknown')
+        delay = self.get_delay(attempt)
+        inner = error.error if isinstance(error, StageError) else error
+        if isinstance(inner, CircuitOpenError):
+            delay = max(delay, inner.retry_after)
+        return delay
+
+class CircuitBreaker:
+    def __init__(self, upstream: str, failure_threshold: int = 5, reset_timeout: float = 60):
+        self.upstream = upstream
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.failures = 0
+        self.opened_until = 0.0
+        # After the pause a single trial call decides whether the upstream is back
+        self.trial_running = False
+        self._lock = threading.Lock()
+
+    def check(self):
+        with self._lock:
+            if self.failures < self.failure_threshold:
+                return
+            now = time.monotonic()
+            if now < self.opened_until or self.trial_running:
+                raise CircuitOpenError(self.upstream, max(self.opened_until - now, 1.0))
+            self.trial_running = True
+
+    def record_success(self):
+        with self._lock:
+            self.failures = 0
+            self.trial_running = False
+
+    def record_failure(self):
+        with self._lock:
+            self.failures += 1
+            self.trial_running = False
+            if self.failures >= self.failure_threshold:
+                if self.failures == self.failure_threshold:
+                    get_metrics().inc('nft_circuit_opened_total', upstream=self.upstream)
+                    print(f'`{self.upstream}` keeps failing, pausing calls for {self.reset_timeout} seconds')
+                self.opened_until = time.monotonic() + self.reset_timeout
+
+    def call(self, func: Callable, *args, **kwargs) -> Any:
+        self.check()
+        try:
+            result = func(*args, **kwargs)
+        except Exception as e:
+            # A permanent error is still an answer from a working upstream
+            if classify_error(e) == TRANSIENT:
+                self.record_failure()
+            else:
+                self.record_success()
+            raise
+        self.record_success()
+        return result
+
+class RetryQueue:
+    # Items that failed wait here while the caller moves on to the next ones
+    def __init__(self, policy: RetryPolicy):
+        self.policy = policy
+        self._heap: List[Tuple[float, int, Any, int]] = []
+        self._counter = itertools.count()
+        get_metrics().set_gauge('nft_retry_queue_size', self.__len__)
+
+    def __len__(self) -> int:
+        return len(self._heap)
+
+    def schedule(self, item: Any, attempt: int, error: Exception) -> Optional[float]:
+        # The delay, or None when the item has to go to the dead letters
+        delay = self.policy.next_delay(error, attempt)
+        if delay is not None:
+            heapq.heappush(self._heap, (time.monotonic() + delay, next(self._counter), item, attempt + 1))
+        return delay
+
+    def is_due(self) -> bool:
+        return bool(self._heap) and self._heap[0][0] <= time.monotonic()
+
+    def iterate(self, items: Iterable[Any], wait: bool = True) -> Iterator[Tuple[Any, int]]:
+        # Yields (item, attempt): new items, with due retries in between.
+        # Without `wait` the retries that are not due yet stay queued for the next call.
+        for item in items:
+            yield from self._pop_due()
+            yield item, 1
+        if not wait:
+            yield from self._pop_due()
+            return
+        while self._heap:
+            wait = self._heap[0][0] - time.monotonic()
+            if wait > 0:
+                print(f'Waiting {wait:.0f} seconds to retry {len(self._heap)} failed items')
+                time.sleep(wait)
+            yield from self._pop_due()
+
+    def _pop_due(self) -> Iterator[Tuple[Any, int]]:
+        while self._heap and self._heap[0][0] <= time.monotonic():
+            _, _, item, attempt = heapq.heappop(self._heap)
+            yield item, attempt
+
+_breakers: Dict[str, CircuitBreaker] = {}
+_breakers_lock = threading.Lock()
+
+def get_circuit_breaker(upstream: str) -> CircuitBreaker:
+    with _breakers_lock:
+        if upstream not in _breakers:
+            config = get_app_config().retry
+            _breakers[upstream] = CircuitBreaker(
+                upstream,
+                failure_threshold=config.get('breaker_failure_threshold', 5),
+                reset_timeout=config.get('breaker_reset_timeout', 60)
+            )
+        return _breakers[upstream]
+
+def get_retry_policy() -> RetryPolicy:
+    config = get_app_config().retry
+    return RetryPolicy(
+        max_attempts=config.get('max_attempts', 5),
+        base_delay=config.get('base_delay', 10),
+        max_delay=config.get('max_delay', 600)
+    )
@@ -0,0 +1,199 @@
+import os
+import threading
+import time
+import requests
+from typing import Any, Dict, List, Optional, Tuple
+from urllib.parse import urlsplit
+from web3 import HTTPProvider
+from web3.providers import JSONBaseProvider
+from web3.types import RPCEndpoint, RPCResponse
+
+from src.config import get_app_config
+from src.metrics import get_metrics
+from src.ratelimit import TokenBucket
+from src.retry import RetryPolicy
+
+# JSON-RPC errors that are about the endpoint, not about the request
+ENDPOINT_ERROR_MARKERS = ('rate limit', 'too many requests', 'capacity', 'unavailable', 'overloaded')
+# In batch responses: -32005 is "limit exceeded" (EIP-1474), 429 is passed on by some providers.
+# Not for single calls: eth_getLogs gets -32005 for too large block ranges, the log scanner splits them
+BATCH_ENDPOINT_ERROR_CODES = (-32005, 429)
+
+class RPCEndpointState:
+    def __init__(self, url: str, rate_limit: Optional[float], timeout: float, latency: float):
+        self.url = url
+        # No retries inside, a failed call goes to another endpoint instead
+        self.provider = HTTPProvider(url, request_kwargs={'timeout': timeout}, exception_retry_configuration=None)
+        self.bucket = TokenBucket(rate_limit) if rate_limit else None
+        self.latency = latency
+        self.in_flight = 0
+        self.cooldown_until = 0.0
+
+    @property
+    def name(self) -> str:
+        # Without the path and query, they usually contain API keys
+        return urlsplit(self.url).netloc
+
+class PooledHTTPProvider(JSONBaseProvider):
+    def __init__(
+            self,
+            endpoints: List[Dict],
+            cooldown: float = 30,
+            timeout: float = 30,
+            passes: int = 3,
+            backoff: float = 1,
+            **kwargs: Any):
+        super().__init__(**kwargs)
+        if not endpoints:
+            raise ValueError('At least one RPC endpoint is required')
+        self.cooldown = cooldown
+        # When every endpoint failed the call, the whole pool is tried again after a pause, up to `passes` times
+        self.passes = RetryPolicy(max_attempts=passes, base_delay=backoff, max_delay=backoff * 8)
+        # Unknown endpoints are ranked in the configured order
+        self.endpoints = [
+            RPCEndpointState(endpoint['url'], endpoint.get('rate_limit'), timeout, latency=0.5 + 0.01 * i)
+            for i, endpoint in enumerate(endpoints)
+        ]
+        self._lock = threading.Lock()
+
+    def __str__(self) -> str:
+        return f'RPC pool of {", ".join(endpoint.name for endpoint in self.endpoints)}'
+
+    def make_request(self, method: RPCEndpoint, params: Any) -> RPCResponse:
+        return self._call(lambda provider: provider.make_request(method, params), method)
+
+    def make_batch_request(self, batch_requests: List[Tuple[RPCEndpoint, Any]]) -> List[RPCResponse]:
+        get_metrics().inc('nft_rpc_batched_calls_total', len(batch_requests))
+        method = f'batch:{batch_requests[0][0]}' if batch_requests else 'batch'
+        return self._call(lambda provider: provider.make_batch_request(batch_requests), method)
+
+    def _call(self, request, method: str):
+        last_error: Optional[Exception] = None
+        for pass_num in range(1, self.passes.max_attempts + 1):
+            if pass_num > 1:
+                delay = self.passes.get_delay(pass_num - 1)
+                print(f'Every RPC endpoint failed `{method}`, trying again in {delay:.1f} seconds')
+                time.sleep(delay)
+            response, last_error = self._call_pool(request, method)
+            if last_error is None:
+                return response
+        raise last_error
+
+    def _call_pool(self, request, method: str) -> Tuple[Any, Optional[Exception]]:
+        # A pass over the endpoints: (response, None), or (None, the last error) when all of them failed
+        metrics = get_metrics()
+        tried = set()
+        last_error: Optional[Exception] = None
+        while len(tried) < len(self.endpoints):
+            endpoint = self._acquire(tried)
+            tried.add(endpoint.url)
+            started_at = time.monotonic()
+            try:
+                response = request(endpoint.provider)
+            except (requests.RequestException, ValueError) as e:
+                # Connection problems, HTTP errors (429, 5xx) and garbage instead of JSON
+                self._release(endpoint, time.monotonic() - started_at, failed=True)
+                metrics.inc('nft_rpc_errors_total', method=method, endpoint=endpoint.name)
+                print(f'RPC endpoint {endpoint.name} failed: {e}')
+                last_error = e
+                continue
+
+            error = self._get_endpoint_error(response)
+            if error is not None:
+                # A batch is sent again as a whole, the other answers in it are usually throttled too
+                self._release(endpoint, time.monotonic() - started_at, failed=True)
+                metrics.inc('nft_rpc_errors_total', method=method, endpoint=endpoint.name)
+                print(f'RPC endpoint {endpoint.name} is busy: {error}')
+                last_error = RuntimeError(f'RPC endpoint {endpoint.name} is busy: {error}')
+                continue
+
+            latency = time.monotonic() - started_at
+            self._release(endpoint, latency, failed=False)
+            metrics.observe('nft_rpc_request_seconds', latency, method=method, endpoint=endpoint.name)
+            return response, None
+        return None, last_error
+
+    def _acquire(self, tried: set) -> RPCEndpointState:
+        with self._lock:
+            now = time.monotonic()
+            candidates = [endpoint for endpoint in self.endpoints if endpoint.url not in tried]
+            healthy = [endpoint for endpoint in candidates if endpoint.cooldown_until <= now]
+            if healthy:
+                # Expected time to get an answer: queued calls make an endpoint slower
+                ranked = sorted(healthy, key=lambda endpoint: endpoint.latency * (1 + endpoint.in_flight))
+            else:
+                # Everything is cooling down: the one that comes back first
+                ranked = sorted(candidates, key=lambda endpoint: endpoint.cooldown_until)
+
+            # The fastest endpoint with a free rate limit slot, so bulk work spreads over all of them
+            chosen = next(
+                (endpoint for endpoint in ranked if endpoint.bucket is None or endpoint.bucket.try_acquire()),
+                None
+            )
+            reserved = chosen is not None
+            if chosen is None:
+                chosen = ranked[0]
+            chosen.in_flight += 1
+
+        if not reserved:
+            chosen.bucket.acquire()
+        return chosen
+
+    def _release(self, endpoint: RPCEndpointState, latency: float, failed: bool, alpha: float = 0.2):
+        with self._lock:
+            endpoint.in_flight -= 1
+            if failed:
+                endpoint.cooldown_until = time.monotonic() + self.cooldown
+            else:
+                endpoint.latency += alpha * (latency - endpoint.latency)
+
+    @staticmethod
+    def _get_endpoint_error(response) -> Optional[Any]:
+        # The first error about the endpoint in a response or in any item of a batch response
+        is_batch = isinstance(response, list)
+        for item in response if is_batch else [response]:
+            error = item.get('error') if isinstance(item, dict) else None
+            if not error:
+                continue
+            if is_batch and isinstance(error, dict) and error.get('code') in BATCH_ENDPOINT_ERROR_CODES:
+                return error
+            message = str(error.get('message', error) if isinstance(error, dict) else error).lower()
+            if any(marker in message for marker in ENDPOINT_ERROR_MARKERS):
+                return error
+        return None
+
+def _expand_endpoints(network: str, endpoints: List[Dict]) -> List[Dict]:
+    expanded = []
+    for endpoint in endpoints:
+        if isinstance(endpoint, str):
+            endpoint = {'url': endpoint}
+        url = os.path.expandvars(endpoint['url'])
+        if '$' in url:
+            # The API key of this provider is not set
+            print(f'Skipping an RPC endpoint of {network} with unset variables: {endpoint["url"]}')
+            continue
+        expanded.append({**endpoint, 'url': url})
+    return expanded
+
+# Contracts on the same chain share the endpoint statistics and rate limits
+_providers: Dict[str, PooledHTTPProvider] = {}
+_providers_lock = threading.Lock()
+
+def get_rpc_provider(network: str) -> PooledHTTPProvider:
+    with _providers_lock:
+        if network not in _providers:
+            config = get_app_config()
+            chain_config = config.blockchains.get(network)
+            if chain_config is None:
+                raise ValueError(f'Unsupported network: {network}')
+            endpoints = _expand_endpoints(network, chain_config.get('rpc', []))
+            if not endpoints:
+                raise ValueError(f'No RPC endpoints are configured for {network}')
+            _providers[network] = PooledHTTPProvider(
+                endpoints,
+                cooldown=config.general.get('rpc_cooldown', 30),
+                timeout=config.general.get('rpc_timeout', 30),
+                passes=config.general.get('rpc_passes', 3),
+                backoff=config.general.get('rpc_backoff', 1)
+            )
+        return _providers[network]
@@ -0,0 +1,117 @@
+import heapq
+import time
+import requests
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from typing import Dict, List, Tuple
+from web3 import Web3
+from web3.types import LogReceipt
+
+from src.retry import RetryPolicy
+
+# Provider errors that mean "ask for a smaller block range"
+SPLIT_ERROR_MARKERS = (
+    'block range', 'range is too large', 'range too large', 'is limited to', 'response size',
+    'query returned more than', 'too many results', 'max results', 'timeout', 'timed out',
+)
+# Throttling: the same window is asked again later, a smaller one wouldn't help
+RATE_LIMIT_MARKERS = ('429', 'rate limit', 'too many requests')
+
+class LogScanner:
+    def __init__(
+            self,
+            web3: Web3,
+            log_filter: Dict,
+            workers: int = 4,
+            window_size: int = 10_000,
+            max_window_size: int = 1_000_000,
+            sparse_logs: int = 1000,
+            max_attempts: int = 3,
+            retry_delay: float = 1):
+        self.web3 = web3
+        self.log_filter = log_filter
+        self.workers = workers
+        self.window_size = window_size
+        self.max_window_size = max_window_size
+        self.sparse_logs = sparse_logs
+        self.max_attempts = max_attempts
+        self.retry_policy = RetryPolicy(max_attempts=max_attempts, base_delay=retry_delay, max_delay=retry_delay * 16)
+
+    def scan(self, from_block: int, to_block: int) -> List[LogReceipt]:
+        all_logs = []
+        cursor = from_block
+        # Windows that have to be requested before moving the cursor: (from, to, attempt)
+        retry_windows: deque = deque()
+        # Failed windows waiting for their next attempt: (time, from, to, attempt)
+        delayed_windows: List[Tuple[float, int, int, int]] = []
+        running = {}
+        scanned_blocks = 0
+        total_blocks = to_block - from_block + 1
+
+        with ThreadPoolExecutor(max_workers=self.workers) as executor:
+            while cursor <= to_block or retry_windows or delayed_windows or running:
+                while delayed_windows and delayed_windows[0][0] <= time.monotonic():
+                    retry_windows.append(heapq.heappop(delayed_windows)[1:])
+                while len(running) < self.workers and (retry_windows or cursor <= to_block):
+                    if retry_windows:
+                        window = retry_windows.popleft()
+                    else:
+                        window_to = min(cursor + self.window_size - 1, to_block)
+                        window = (cursor, window_to, 1)
+                        cursor = window_to + 1
+                    running[executor.submit(self._get_logs, window[0], window[1])] = window
+
+                next_retry = max(delayed_windows[0][0] - time.monotonic(), 0) if delayed_windows else None
+                if not running:
+                    time.sleep(next_retry)
+                    continue
+                done, _ = wait(running, timeout=next_retry, return_when=FIRST_COMPLETED)
+                for future in done:
+                    window_from, window_to, attempt = running.pop(future)
+                    window_len = window_to - window_from + 1
+                    try:
+                        logs = future.result()
+                    except Exception as e:
+                        if self._should_split(e) and window_len > 1:
+                            middle = window_from + window_len // 2
+                            retry_windows.appendleft((middle, window_to, 1))
+                            retry_windows.appendleft((window_from, middle - 1, 1))
+                            self.window_size = max(1, min(self.window_size, window_len // 2))
+                        elif attempt < self.max_attempts:
+                            retry_at = time.monotonic() + self.retry_policy.get_delay(attempt)
+                            heapq.heappush(delayed_windows, (retry_at, window_from, window_to, attempt + 1))
+                        else:
+                            raise RuntimeError(f'Failed to get logs for blocks {window_from}-{window_to}: {e}')
+                        continue
+
+                    all_logs.extend(logs)
+                    scanned_blocks += window_len
+                    if len(logs) < self.sparse_logs and window_len >= self.window_size:
+                        self.window_size = min(self.window_size * 2, self.max_window_size)
+                    print(f'Scanned {scanned_blocks}/{total_blocks} blocks, found {len(all_logs)} records',
+                          end='\r', flush=True)
+
+        if total_blocks > 0:
+            print()
+        all_logs.sort(key=self._log_position)
+        return all_logs
+
+    def _get_logs(self, from_block: int, to_block: int) -> List[LogReceipt]:
+        return self.web3.eth.get_logs({
+            **self.log_filter,
+            'fromBlock': from_block,
+            'toBlock': to_block,
+        })
+
+    @staticmethod
+    def _should_split(error: Exception) -> bool:
+        if isinstance(error, requests.exceptions.Timeout):
+            return True
+        message = str(error).lower()
+        if any(marker in message for marker in RATE_LIMIT_MARKERS):
+            return False
+        return any(marker in message for marker in SPLIT_ERROR_MARKERS)
+
+    @staticmethod
+    def _log_position(log: LogReceipt) -> Tuple[int, int]:
+        return log['blockNumber'], log['logIndex']
@@ -0,0 +1,52 @@
+import argparse
+import json
+import os
+import sys
+
+from dotenv import load_dotenv
+
+from src.db import DatabaseManager
+
+# Keyword search over the collected tokens:
+# python -m src.search <query> [--network NAME] [--contract ADDRESS] [--limit 20] [--page 1] [--json]
+
+def main():
+    parser = argparse.ArgumentParser(description='Search the collected tokens by name, description and AI description')
+    parser.add_argument('query', nargs='?', default='',
+                        help='words that must all match; `word*` matches by prefix')
+    parser.add_argument('--network', help='only tokens of this blockchain from config.yaml')
+    parser.add_argument('--contract', help='only tokens of this contract address')
+    parser.add_argument('--limit', type=int, default=20, help='results per page')
+    parser.add_argument('--page', type=int, default=1)
+    parser.add_argument('--json', action='store_true', help='print a JSON line per result')
+    parser.add_argument('--rebuild', action='store_true', help='index all rows again, e.g. after a bulk import')
+    args = parser.parse_args()
+    if not args.query and not args.rebuild:
+        parser.error('a query or --rebuild is required')
+
+    load_dotenv()
+    db_uri = os.getenv('DB_URI')
+    if not db_uri:
+        parser.error('the DB_URI environment variable is not set')
+    search_index = DatabaseManager(db_uri).search_index
+
+    if args.rebuild:
+        search_index.rebuild()
+        if not args.query:
+            return
+
+    page = search_index.search(args.query, limit=args.limit, offset=(max(args.page, 1) - 1) * args.limit,
+                               network=args.network, contract_address=args.contract)
+    for row in page['results']:
+        if args.json:
+            print(json.dumps(row, default=str))
+            continue
+        print(f'{row["network_name"]} {row["contract_address"]} #{row["token_id"]} '
+              f'{row["token_name"] or ""} ({row["rank"]:.2f})')
+        if row['ai_image_description']:
+            print(f'    {row["ai_image_description"][:200]}')
+    if page['next_offset'] is not None:
+        print(f'More results: --page {args.page + 1}', file=sys.stderr)
+
+if __name__ == '__main__':
+    main()
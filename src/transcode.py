@@ -0,0 +1,178 @@
+import argparse
+import multiprocessing
+import os
+import threading
+from concurrent.futures import ProcessPoolExecutor
+from functools import partial
+from io import BytesIO
+from typing import Dict, Iterator, List, Optional
+from PIL import Image
+
+from src.config import get_app_config
+
+IMAGE_FORMATS = {
+    # format: (Pillow format, MIME type, file extension)
+    'jpeg': ('JPEG', 'image/jpeg', 'jpg'),
+    'webp': ('WEBP', 'image/webp', 'webp'),
+    'png': ('PNG', 'image/png', 'png'),
+}
+
+def is_svg(data: bytes) -> bool:
+    head = data[:1024].lstrip().lower()
+    return head.startswith(b'<svg') or (head.startswith(b'<?xml') and b'<svg' in head)
+
+def get_dhash(image: Image.Image, hash_size: int = 8) -> int:
+    # Difference hash: brightness gradients of a tiny grayscale copy. Resizing, recompression
+    # and small marks like a watermark or an edition number change only a few of the 64 bits
+    small = image.convert('L').resize((hash_size + 1, hash_size), Image.Resampling.LANCZOS)
+    pixels = small.tobytes()
+    value = 0
+    for row in range(hash_size):
+        offset = row * (hash_size + 1)
+        for col in range(hash_size):
+            value = value << 1 | (pixels[offset + col] > pixels[offset + col + 1])
+    return value
+
+def get_image_dhash(data: bytes) -> Optional[int]:
+    try:
+        return get_dhash(Image.open(BytesIO(data)))
+    except (OSError, ValueError, Image.DecompressionBombError):
+        return None
+
+def transcode_image(data: bytes, resolution: List[int], image_format: str, quality: int) -> Dict:
+    # Runs in worker processes, so it only takes and returns picklable values
+    if image_format not in IMAGE_FORMATS:
+        return {'error': f'Unsupported image format: {image_format}'}
+    pil_format, mime_type, _ = IMAGE_FORMATS[image_format]
+
+    if is_svg(data):
+        return {'error': 'SVG images are not supported'}
+
+    max_size = (resolution[0], resolution[1])
+    try:
+        image = Image.open(BytesIO(data))
+        if getattr(image, 'is_animated', False):
+            # Only the first frame of animated GIF/WebP/PNG
+            image.seek(0)
+            image = image.convert('RGBA')
+        else:
+            # JPEG can be decoded at a reduced scale right away, without decoding the full original
+            image.draft('RGB', max_size)
+        image.thumbnail(max_size, Image.Resampling.LANCZOS)
+
+        if pil_format == 'JPEG' and image.mode != 'RGB':
+            if image.mode in ('RGBA', 'LA', 'P', 'PA'):
+                # JPEG has no transparency: put the image on a white background
+                image = image.convert('RGBA')
+                background = Image.new('RGB', image.size, (255, 255, 255))
+                background.paste(image, mask=image.getchannel('A'))
+                image = background
+            else:
+                image = image.convert('RGB')
+        elif image.mode not in ('RGB', 'RGBA', 'L', 'LA', 'P'):
+            image = image.convert('RGBA')
+
+        buffer = BytesIO()
+        if pil_format == 'PNG':
+            image.save(buffer, format=pil_format, optimize=True)
+        else:
+            image.save(buffer, format=pil_format, quality=quality)
+    except (OSError, ValueError, Image.DecompressionBombError) as e:
+        return {'error': f"Can't process the image: {e}"}
+
+    return {
+        'data': buffer.getvalue(),
+        'width': image.width,
+        'height': image.height,
+        'mime_type': mime_type,
+        'dhash': get_dhash(image),
+    }
+
+def transcode_file(src_path: str, dst_dir: str, resolution: List[int], image_format: str, quality: int) -> Dict:
+    # Workers read and write the files themselves, so only paths go through the process pipes
+    with open(src_path, 'rb') as f:
+        result = transcode_image(f.read(), resolution, image_format, quality)
+    if 'error' in result:
+        return {'path': src_path, 'error': result['error']}
+
+    name = os.path.splitext(os.path.basename(src_path))[0]
+    dst_path = os.path.join(dst_dir, f'{name}.{IMAGE_FORMATS[image_format][2]}')
+    with open(dst_path, 'wb') as f:
+        f.write(result['data'])
+    return {'path': dst_path, 'width': result['width'], 'height': result['height']}
+
+class ImageTranscoder:
+    # Starts all its processes right away. Create it before any other thread starts: a fork copies the locks
+    # held by other threads, e.g. of open HTTP sessions, but not the threads that would release them.
+    # Spawned processes would run the main module again instead
+    def __init__(self, processes: Optional[int] = None, chunk_size: int = 16):
+        self.chunk_size = chunk_size
+        context = multiprocessing.get_context('fork') if 'fork' in multiprocessing.get_all_start_methods() else None
+        self.executor = ProcessPoolExecutor(max_workers=processes, mp_context=context)
+        # With fork, the first task launches the whole pool
+        self.executor.submit(int).result()
+
+    def transcode(self, data: bytes, resolution: List[int], image_format: str, quality: int) -> Dict:
+        return self.executor.submit(transcode_image, data, resolution, image_format, quality).result()
+
+    def transcode_directory(
+            self,
+            src_dir: str,
+            dst_dir: str,
+            resolution: List[int],
+            image_format: str,
+            quality: int) -> Iterator[Dict]:
+        os.makedirs(dst_dir, exist_ok=True)
+        paths = sorted(
+            os.path.join(src_dir, name) for name in os.listdir(src_dir)
+            if os.path.isfile(os.path.join(src_dir, name))
+        )
+        return self.executor.map(
+            partial(transcode_file, dst_dir=dst_dir, resolution=resolution,
+                    image_format=image_format, quality=quality),
+            paths,
+            chunksize=self.chunk_size
+        )
+
+    def close(self):
+        self.executor.shutdown()
+
+_transcoder: Optional[ImageTranscoder] = None
+_transcoder_lock = threading.Lock()
+
+def get_image_transcoder() -> Optional[ImageTranscoder]:
+    # None when images have to be transcoded in the calling thread. The first call starts the pool, see ImageTranscoder;
+    # if other threads run by then, there is no pool
+    global _transcoder
+    processes = get_app_config().general.get('transcode_processes')
+    if processes == 0:
+        return None
+    with _transcoder_lock:
+        if _transcoder is None:
+            if threading.active_count() > 1:
+                # Too late to fork safely, see ImageTranscoder
+                return None
+            _transcoder = ImageTranscoder(processes)
+    return _transcoder
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Resize and re-encode all images of a directory')
+    parser.add_argument('src_dir')
+    parser.add_argument('dst_dir')
+    parser.add_argument('--resolution', type=int, nargs=2, default=[512, 512], metavar=('WIDTH', 'HEIGHT'))
+    parser.add_argument('--format', choices=list(IMAGE_FORMATS), default='jpeg')
+    parser.add_argument('--quality', type=int, default=85)
+    parser.add_argument('--processes', type=int, default=None)
+    args = parser.parse_args()
+
+    transcoder = ImageTranscoder(args.processes)
+    done = failed = 0
+    for result in transcoder.transcode_directory(args.src_dir, args.dst_dir, args.resolution,
+                                                 args.format, args.quality):
+        if 'error' in result:
+            failed += 1
+            print(f'{result["path"]}: {result["error"]}')
+        else:
+            done += 1
+    transcoder.close()
+    print(f'Transcoded {done} images, failed {failed}')
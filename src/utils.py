@@ -1,77 +1,120 @@
-import datetime
 import os
 import base64
-import requests
-import time
-from PIL import Image
+import hashlib
 from io import BytesIO
 
-from typing import Optional, List
-from sqlalchemy.orm import Session
-from src.db import NFTMetadata
+from typing import Optional, List, Dict, Tuple
 from src.log import log
 from src.config import get_app_config
+from src.db import ImageHashStore, NFTMetadataStore
+from src.gateway import GatewayClient, get_gateway_client
+from src.metrics import get_metrics
+from src.retry import PermanentError, get_circuit_breaker, get_upstream_name
+from src.transcode import IMAGE_FORMATS, get_image_dhash, get_image_transcoder, transcode_image
 
-def add_ntf_to_db(
-        session: Session,
-        network: str,
-        contract_address: str,
-        collection_name: str,
+def get_token_tasks(nft_row: Optional[Dict], description_min_len: int) -> Tuple[bool, bool]:
+    # (fetch_metadata, generate_description) according to the token's DB row
+    if not nft_row:
+        return True, True
+
+    generate_description = not nft_row['ai_image_description'] or \
+        len(nft_row['ai_image_description']) < description_min_len
+    fetch_metadata = not nft_row['collection_name'] or not nft_row['token_name'] or \
+        not nft_row['description'] or not nft_row['image_url']
+    return fetch_metadata, generate_description
+
+def get_duplicate_description(
+        store: NFTMetadataStore,
+        image_hashes: ImageHashStore,
         token_id: int,
-        token_name: Optional[str],
-        description: Optional[str],
-        image_url: Optional[str],
-        mint_date: Optional[datetime.datetime],
-        ai_image_description: Optional[str]):
-    
-    new_nft = NFTMetadata(
-        network_name=network,
-        contract_address=contract_address,
-        collection_name=collection_name,
-        token_id=token_id,
-        token_name=token_name,
-        description=description,
-        image_url=image_url,
-        mint_date=mint_date,
-        ai_image_description=ai_image_description
-    )
-    
-    session.add(new_nft)
-    session.commit()
+        image_hash: int,
+        description_min_len: int) -> Optional[Tuple[int, str]]:
+    # (token ID, description) of an already described token with a nearly identical image
+    for other_id in image_hashes.find(image_hash):
+        if other_id == token_id:
+            continue
+        row = store.get(other_id)
+        if row is None:
+            # Described by another worker
+            store.load([other_id])
+            row = store.get(other_id)
+        description = row['ai_image_description'] if row else None
+        if description and len(description) >= description_min_len:
+            return other_id, description
+    return None
+
+def download_image(
+        image_url: str,
+        directory: Optional[str],
+        resolution: List[int]) -> Tuple[str, str, Optional[int]]:
+    # Returns the resized image as (base64, MIME type, perceptual hash)
+    config = get_app_config()
+    image_format = config.openai.get('image_format', 'jpeg').lower()
+    quality = config.openai.get('image_quality', 85)
+    if image_format not in IMAGE_FORMATS:
+        raise ValueError(f'Unsupported image format: {image_format}')
+    _, mime_type, extension = IMAGE_FORMATS[image_format]
 
-def download_image(image_url: str, directory: str, resolution: List[int]) -> str:
-    hash = image_url.rstrip('/').split('/')[-1]
-    image_path = os.path.join(directory, f'{hash}.png')
-    if not os.path.exists(image_path):
+    image_path = None
+    if directory:
+        cache_key = f'{get_content_key(image_url)}|{resolution[0]}x{resolution[1]}|{image_format}|{quality}'
+        image_name = hashlib.sha256(cache_key.encode()).hexdigest()
+        image_path = os.path.join(directory, f'{image_name}.{extension}')
+
+    if image_path and os.path.exists(image_path):
+        log.print(f'Using a saved image: {image_path}')
+        with open(image_path, 'rb') as image_file:
+            image_data = image_file.read()
+        image_hash = get_image_dhash(image_data)
+    else:
         log.print(f'Downloading the image: {image_url}')
+        metrics = get_metrics()
+        with metrics.timer('nft_image_download_seconds'):
+            original = _fetch_image_bytes(image_url, config.openai.get('image_max_bytes', 50 * 1024 * 1024))
 
-        while True:
-            response = requests.get(image_url)
-            if response.status_code != 200:
-                log.print(f'Failed to download image. Status code: {response.status_code}')
+        log.print(f'Converting the image to the maximum size of {resolution[0]}x{resolution[1]}')
+        transcoder = get_image_transcoder()
+        with metrics.timer('nft_image_transcode_seconds'):
+            if transcoder:
+                result = transcoder.transcode(original, resolution, image_format, quality)
+            else:
+                result = transcode_image(original, resolution, image_format, quality)
+        if 'error' in result:
+            raise ValueError(result['error'])
+        image_data = result['data']
+        image_hash = result['dhash']
 
-                config = get_app_config()
-                timeout = config.general.get('download_image_timeout', 5)
-                log.print(f'Try again in {timeout} seconds')
-                time.sleep(timeout)
-                continue
-            break
+        if image_path:
+            os.makedirs(directory, exist_ok=True)
+            tmp_path = f'{image_path}.{os.getpid()}.tmp'
+            with open(tmp_path, 'wb') as image_file:
+                image_file.write(image_data)
+            os.replace(tmp_path, image_path)
 
-        if not os.path.exists(directory):
-            os.makedirs(directory)
+    return base64.b64encode(image_data).decode('utf-8'), mime_type, image_hash
 
-        image = Image.open(BytesIO(response.content))
+def get_content_key(url: str) -> str:
+    # IPFS content is addressed by its CID, so the same file from any gateway gets one key
+    return GatewayClient.get_ipfs_path(url) or url
 
-        # Resize the image
-        log.print(f'Converting the image to the maximum size of {resolution[0]}x{resolution[1]}')
-        max_size = (resolution[0], resolution[1])
-        image.thumbnail(max_size, Image.Resampling.LANCZOS)
+def _fetch_image_bytes(image_url: str, max_bytes: int) -> bytes:
+    # One attempt: the caller decides whether the error is worth a retry
+    return get_circuit_breaker(get_upstream_name(image_url)).call(_download, image_url, max_bytes)
 
-        image.save(image_path)
-    else:
-        log.print(f'Using a saved image: {image_path}')
+def _download(image_url: str, max_bytes: int) -> bytes:
+    with get_gateway_client().get(image_url, stream=True) as response:
+        if response.status_code != 200:
+            log.print(f'Failed to download image. Status code: {response.status_code}')
+            response.raise_for_status()
+            raise PermanentError(f'Unexpected status code: {response.status_code}')
 
-    with open(image_path, 'rb') as image_file:
-        base64_image = base64.b64encode(image_file.read()).decode('utf-8')
+        content_length = int(response.headers.get('Content-Length') or 0)
+        if content_length > max_bytes:
+            raise ValueError(f'The image is too large: {content_length} bytes')
 
-    return str(base64_image)
\ No newline at end of file
+        buffer = BytesIO()
+        for chunk in response.iter_content(chunk_size=64 * 1024):
+            buffer.write(chunk)
+            if buffer.tell() > max_bytes:
+                raise ValueError(f'The image is larger than {max_bytes} bytes')
+        return buffer.getvalue()
@@ -0,0 +1,210 @@
+import datetime
+import os
+import socket
+import threading
+from sqlalchemy import and_, func, or_, select, update
+from sqlalchemy.dialects import postgresql, sqlite
+from sqlalchemy.orm import Session, sessionmaker
+from typing import Dict, Iterable, List, Optional
+
+from src.db import DEAD_LETTER_KEY, MAX_BIND_PARAMETERS, DeadLetter, TokenJob, upsert_rows
+
+def _utcnow() -> datetime.datetime:
+    # Naive UTC: lease times are compared inside the database, which may not keep time zones
+    return datetime.datetime.now(datetime.timezone.utc).replace(tzinfo=None)
+
+def get_worker_id() -> str:
+    return f'{socket.gethostname()}:{os.getpid()}'
+
+class WorkQueue:
+    # Per-token jobs shared by any number of worker processes through the database.
+    # Every operation uses its own short session, so a heartbeat thread can share the queue.
+    def __init__(
+            self,
+            session_factory: sessionmaker,
+            worker_id: Optional[str] = None,
+            lease_seconds: float = 300,
+            max_attempts: int = 5):
+        self.session_factory = session_factory
+        self.worker_id = worker_id or get_worker_id()
+        self.lease_seconds = lease_seconds
+        self.max_attempts = max_attempts
+
+    def enqueue(self, network: str, contract_address: str, token_ids: Iterable[int]) -> int:
+        table = TokenJob.__table__
+        now = _utcnow()
+        rows = [
+            {
+                'network_name': network,
+                'contract_address': contract_address,
+                'token_id': token_id,
+                'status': 'pending',
+                'attempts': 0,
+                'available_at': now,
+                'created_at': now,
+                'updated_at': now,
+            }
+            for token_id in token_ids
+        ]
+        with self.session_factory() as session:
+            dialect = session.get_bind().dialect.name
+            # Keep statements below the bound parameters limit of the database
+            chunk_size = max(1, MAX_BIND_PARAMETERS // len(rows[0])) if rows else 1
+            for i in range(0, len(rows), chunk_size):
+                chunk = rows[i:i + chunk_size]
+                if dialect in ('sqlite', 'postgresql'):
+                    insert = sqlite.insert if dialect == 'sqlite' else postgresql.insert
+                    stmt = insert(table).values(chunk)
+                    # Finished jobs are queued again, queued and running ones are left alone
+                    stmt = stmt.on_conflict_do_update(
+                        index_elements=['network_name', 'contract_address', 'token_id'],
+                        set_={'status': 'pending', 'attempts': 0, 'last_error': None,
+                              'available_at': now, 'updated_at': now},
+                        where=table.c.status.in_(('done', 'failed'))
+                    )
+                    session.execute(stmt)
+                    continue
+
+                # Other databases: one row at a time
+                for row in chunk:
+                    result = session.execute(update(table).where(
+                        table.c.network_name == network,
+                        table.c.contract_address == contract_address,
+                        table.c.token_id == row['token_id'],
+                    ).values(status='pending', attempts=0, last_error=None, available_at=now, updated_at=now))
+                    if result.rowcount == 0:
+                        session.execute(table.insert().values(**row))
+            session.commit()
+        return len(rows)
+
+    def claim(self, limit: int) -> List[Dict]:
+        table = TokenJob.__table__
+        now = _utcnow()
+        with self.session_factory() as session:
+            # Workers that died too many times on the same token don't get it again
+            self._fail_expired(session, now)
+
+            claimable = select(table.c.id).where(or_(
+                and_(table.c.status == 'pending', table.c.available_at <= now),
+                # Expired leases of dead or stuck workers
+                and_(table.c.status == 'leased', table.c.lease_expires_at < now)
+            )).order_by(table.c.id).limit(limit).with_for_update(skip_locked=True)
+
+            values = {
+                'status': 'leased',
+                'lease_owner': self.worker_id,
+                'lease_expires_at': now + datetime.timedelta(seconds=self.lease_seconds),
+                'attempts': table.c.attempts + 1,
+                'updated_at': now,
+            }
+            columns = (table.c.id, table.c.network_name, table.c.contract_address, table.c.token_id,
+                       table.c.attempts)
+            if session.get_bind().dialect.update_returning:
+                # A single statement: SQLite runs it under its write lock, Postgres skips locked rows
+                result = session.execute(
+                    update(table).where(table.c.id.in_(claimable.scalar_subquery())).values(**values)
+                    .returning(*columns)
+                )
+                jobs = [dict(row) for row in result.mappings()]
+            else:
+                ids = list(session.execute(claimable).scalars())
+                if ids:
+                    session.execute(update(table).where(table.c.id.in_(ids)).values(**values))
+                jobs = [dict(row) for row in session.execute(select(*columns).where(table.c.id.in_(ids))).mappings()]
+            session.commit()
+        return sorted(jobs, key=lambda job: job['id'])
+
+    def _fail_expired(self, session: Session, now: datetime.datetime):
+        table = TokenJob.__table__
+        error = 'The lease expired too many times'
+        expired = and_(
+            table.c.status == 'leased',
+            table.c.lease_expires_at < now,
+            table.c.attempts >= self.max_attempts
+        )
+        columns = (table.c.network_name, table.c.contract_address, table.c.token_id, table.c.attempts)
+        values = {'status': 'failed', 'last_error': error, 'lease_owner': None, 'updated_at': now}
+        if session.get_bind().dialect.update_returning:
+            jobs = session.execute(update(table).where(expired).values(**values).returning(*columns)).mappings().all()
+        else:
+            jobs = session.execute(select(*columns).where(expired)).mappings().all()
+            if jobs:
+                session.execute(update(table).where(expired).values(**values))
+        if not jobs:
+            return
+        # Like the tokens that ran out of retries, so `--retry-dead-letters lease` brings them back
+        upsert_rows(session, DeadLetter.__table__, [
+            {**job, 'stage': 'lease', 'error': error, 'failed_at': now} for job in jobs
+        ], DEAD_LETTER_KEY)
+
+    def heartbeat(self, job_ids: List[int]):
+        if not job_ids:
+            return
+        table = TokenJob.__table__
+        now = _utcnow()
+        with self.session_factory() as session:
+            session.execute(update(table).where(
+                table.c.id.in_(job_ids),
+                table.c.status == 'leased',
+                table.c.lease_owner == self.worker_id
+            ).values(lease_expires_at=now + datetime.timedelta(seconds=self.lease_seconds), updated_at=now))
+            session.commit()
+
+    def complete(self, job_ids: List[int]):
+        self._finish(job_ids, status='done')
+
+    def release(self, job_id: int, error: Optional[str] = None, delay: float = 0):
+        # Back to the queue, available again after the delay
+        self._finish([job_id], status='pending', last_error=error,
+                     available_at=_utcnow() + datetime.timedelta(seconds=delay))
+
+    def fail(self, job_id: int, error: str):
+        self._finish([job_id], status='failed', last_error=error)
+
+    def _finish(self, job_ids: List[int], status: str, **values):
+        if not job_ids:
+            return
+        table = TokenJob.__table__
+        with self.session_factory() as session:
+            # A job whose lease was taken over by another worker is not ours anymore
+            session.execute(update(table).where(
+                table.c.id.in_(job_ids),
+                table.c.lease_owner == self.worker_id
+            ).values(status=status, lease_owner=None, lease_expires_at=None, updated_at=_utcnow(), **values))
+            session.commit()
+
+    def has_open_jobs(self) -> bool:
+        table = TokenJob.__table__
+        with self.session_factory() as session:
+            return session.execute(
+                select(table.c.id).where(table.c.status.in_(('pending', 'leased'))).limit(1)
+            ).first() is not None
+
+    def get_counts(self) -> Dict[str, int]:
+        table = TokenJob.__table__
+        with self.session_factory() as session:
+            return dict(session.execute(select(table.c.status, func.count()).group_by(table.c.status)).all())
+
+class LeaseHeartbeat:
+    # Extends the leases of the jobs in hand until stopped
+    def __init__(self, queue: WorkQueue, interval: float):
+        self.queue = queue
+        self.interval = interval
+        self.job_ids: List[int] = []
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+
+    def __enter__(self) -> 'LeaseHeartbeat':
+        self._thread.start()
+        return self
+
+    def __exit__(self, *exc_info):
+        self._stop.set()
+        self._thread.join()
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            try:
+                self.queue.heartbeat(list(self.job_ids))
+            except Exception as e:
+                print(f'Lease heartbeat failed: {e}')
@@ -0,0 +1,68 @@
+from typing import Tuple
+
+import pytest
+
+from bench.fakes import FakeCollection, FakeRPCNode
+from src import rpc
+from src.abi import TRANSFERSINGLE_EVENT_SIGNATURE, ZORA1155_ABI
+from src.config import get_app_config
+from src.nft import NFTMetadataFetcher
+
+CONTRACT_ADDRESS = '0x' + '42' * 20
+
+@pytest.fixture
+def collection() -> FakeCollection:
+    return FakeCollection(size=10)
+
+def make_fetcher(monkeypatch, node: FakeRPCNode) -> NFTMetadataFetcher:
+    # A network of its own, so the provider is built for the stand-in node
+    monkeypatch.setitem(get_app_config().blockchains, 'test', {'rpc': [{'url': node.url}]})
+    monkeypatch.setattr(rpc, '_providers', {})
+    return NFTMetadataFetcher(
+        'test', CONTRACT_ADDRESS, ZORA1155_ABI, TRANSFERSINGLE_EVENT_SIGNATURE, use_cache=False,
+        collection_name=node.collection.name, next_token_id=node.collection.size + 1
+    )
+
+@pytest.fixture
+def serve(monkeypatch, collection):
+    nodes = []
+
+    def start(**kwargs) -> Tuple[NFTMetadataFetcher, FakeRPCNode]:
+        node = FakeRPCNode(collection, **kwargs).start()
+        nodes.append(node)
+        return make_fetcher(monkeypatch, node), node
+
+    yield start
+    for node in nodes:
+        node.stop()
+
+def test_aggregate3(serve, collection):
+    fetcher, node = serve(multicall=True)
+    uris = fetcher.fetch_token_uris(range(1, collection.size + 1))
+    assert uris == {token_id: collection.get_token_uri(token_id) for token_id in range(1, collection.size + 1)}
+    assert node.counts['aggregate3'] == 1
+    assert node.counts['eth_call'] == 1
+
+def test_aggregate3_failed_call(serve, collection):
+    # A reverted uri() leaves its own token without a URI, not the whole batch
+    fetcher, _ = serve(multicall=True)
+    uris = fetcher.fetch_token_uris([collection.size - 1, collection.size, collection.size + 1])
+    assert uris == {
+        collection.size - 1: collection.get_token_uri(collection.size - 1),
+        collection.size: collection.get_token_uri(collection.size),
+        collection.size + 1: None,
+    }
+
+def test_aggregate3_error_falls_back_to_batch(serve, collection):
+    fetcher, node = serve(multicall=True, multicall_error=True)
+    uris = fetcher.fetch_token_uris([1, 2, collection.size + 1])
+    assert uris == {1: collection.get_token_uri(1), 2: collection.get_token_uri(2), collection.size + 1: None}
+    assert node.counts['aggregate3'] == 1
+    # Later chunks still try Multicall3 first
+    assert fetcher.multicall
+
+def test_no_multicall(serve, collection):
+    fetcher, node = serve()
+    assert fetcher.fetch_token_uris([1, collection.size + 1]) == {1: collection.get_token_uri(1), collection.size + 1: None}
+    assert fetcher.multicall is False
+    assert node.counts['aggregate3'] == 0
@@ -0,0 +1,92 @@
+import multiprocessing
+import random
+import time
+from typing import List
+
+from sqlalchemy import select
+
+from src.db import DatabaseManager, DeadLetter
+from src.workqueue import WorkQueue
+
+NETWORK = 'test'
+CONTRACT_ADDRESS = '0x' + '42' * 20
+
+def make_queue(db_uri: str, worker_id: str, **kwargs) -> WorkQueue:
+    return WorkQueue(DatabaseManager(db_uri).Session, worker_id=worker_id, **kwargs)
+
+def run_worker(db_uri: str, worker_num: int) -> List[int]:
+    # Claims small batches until the queue is drained, like `--role worker`
+    queue = make_queue(db_uri, f'worker-{worker_num}')
+    completed = []
+    while True:
+        jobs = queue.claim(3)
+        if not jobs:
+            if not queue.has_open_jobs():
+                return completed
+            time.sleep(0.01)
+            continue
+        time.sleep(random.random() * 0.01)
+        queue.complete([job['id'] for job in jobs])
+        completed.extend(job['token_id'] for job in jobs)
+
+def test_workers_complete_every_job_once(tmp_path):
+    db_uri = f'sqlite:///{tmp_path / "queue.db"}'
+    queue = make_queue(db_uri, 'coordinator')
+    queue.enqueue(NETWORK, CONTRACT_ADDRESS, range(1, 201))
+
+    workers = 4
+    with multiprocessing.get_context('fork').Pool(workers) as pool:
+        results = pool.starmap(run_worker, [(db_uri, i) for i in range(workers)])
+
+    completed = [token_id for result in results for token_id in result]
+    assert sorted(completed) == list(range(1, 201))
+    assert queue.get_counts() == {'done': 200}
+
+def test_expired_lease_is_claimed_by_another_worker(tmp_path):
+    db_uri = f'sqlite:///{tmp_path / "queue.db"}'
+    first = make_queue(db_uri, 'first', lease_seconds=0.5)
+    second = make_queue(db_uri, 'second')
+    first.enqueue(NETWORK, CONTRACT_ADDRESS, [1])
+
+    [job] = first.claim(1)
+    # Nothing to claim while the lease holds
+    assert second.claim(1) == []
+    time.sleep(0.6)
+    [taken] = second.claim(1)
+    assert taken['id'] == job['id'] and taken['attempts'] == 2
+
+    # The first worker lost the job, its result doesn't count
+    first.complete([job['id']])
+    assert first.get_counts() == {'leased': 1}
+    second.complete([job['id']])
+    assert first.get_counts() == {'done': 1}
+
+def test_lease_expired_too_many_times_goes_to_dead_letters(tmp_path):
+    db_uri = f'sqlite:///{tmp_path / "queue.db"}'
+    queue = make_queue(db_uri, 'worker', lease_seconds=0, max_attempts=2)
+    queue.enqueue(NETWORK, CONTRACT_ADDRESS, [1, 2])
+
+    assert len(queue.claim(2)) == 2
+    time.sleep(0.01)
+    assert [job['attempts'] for job in queue.claim(2)] == [2, 2]
+    time.sleep(0.01)
+    assert queue.claim(2) == []
+    assert queue.get_counts() == {'failed': 2}
+
+    with queue.session_factory() as session:
+        dead_letters = session.execute(select(DeadLetter.token_id, DeadLetter.stage, DeadLetter.attempts)).all()
+    assert sorted(dead_letters) == [(1, 'lease', 2), (2, 'lease', 2)]
+
+def test_released_job_is_claimed_again(tmp_path):
+    db_uri = f'sqlite:///{tmp_path / "queue.db"}'
+    queue = make_queue(db_uri, 'worker')
+    queue.enqueue(NETWORK, CONTRACT_ADDRESS, [1, 2])
+
+    first, second = queue.claim(2)
+    queue.release(first['id'], error='Timed out')
+    queue.release(second['id'], error='Timed out', delay=60)
+
+    # Only the job without a delay is due
+    [job] = queue.claim(2)
+    assert job['id'] == first['id'] and job['attempts'] == 2
+    assert queue.get_counts() == {'leased': 1, 'pending': 1}